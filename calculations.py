@@ -7,8 +7,9 @@ from Bio.Align import MultipleSeqAlignment
 from Bio.Data import CodonTable
 from divergence import find_cogs_in_sequence_records, parse_options, create_directory, extract_archive_of_files, \
     concatenate, CODON_TABLE_ID, get_most_recent_gene_name
-from divergence.run_codeml import run_codeml, parse_codeml_output
-from divergence.run_phipack import run_phipack
+from divergence.result_cache import get_cache
+from divergence.run_codeml import get_codeml_values_for_alignments, BACKENDS
+from divergence.run_phipack import run_phipack, read_phipack_stats
 from divergence.select_taxa import select_genomes_by_ids
 from itertools import product
 from operator import itemgetter
@@ -111,23 +112,31 @@ def _every_other_codon_alignments(alignment):
     return ali_odd, ali_even
 
 
-def _phipack_values_for_sicos(orth_files):
-    """Calculate PhiPack values for each ortholog and return a dictionary mapping ortholog to the PhiPack values."""
+def _phipack_values_for_sicos(orth_files, native_phi=False, phipack_stats=None):
+    """Calculate PhiPack values for each ortholog and return a dictionary mapping ortholog to the PhiPack values.
+    Values for orthologs in phipack_stats, as read from an earlier run_phipack stats file, are reused as is."""
+    phipack_stats = phipack_stats or {}
     #Create temporary folder for PhiPack files
     phipack_dir = tempfile.mkdtemp(prefix='phipack_')
-    values_per_orth = dict((ortholog, run_phipack(phipack_dir, sico_file)) for ortholog, sico_file in orth_files)
+    values_per_orth = dict((ortholog, dict(phipack_stats[ortholog]) if ortholog in phipack_stats
+                            else run_phipack(phipack_dir, sico_file, native_phi))
+                           for ortholog, sico_file in orth_files)
     #Remove phipack directory
     shutil.rmtree(phipack_dir)
     return values_per_orth
 
 
-def calculate_tables(genome_ids_a, genome_ids_b, sico_files, oddeven=False):
-    """Compute a spreadsheet of data points each for A and B based the SICO files, without duplicating computations."""
+def calculate_tables(genome_ids_a, genome_ids_b, sico_files, oddeven=False, backend='codeml', native_phi=False,
+                     phipack_stats=None):
+    """Compute a spreadsheet of data points each for A and B based the SICO files, without duplicating computations.
+    Divergence values are calculated with codeml, or with yn00 when backend is 'yn00'. PhiPack values are calculated
+    in process rather than through the PhiPack binary when native_phi is True, or taken from phipack_stats for the
+    full alignments of orthologs already tested by run_phipack."""
     #Convert file names into identifiers while preserving filenames, as filenames are used both for BioPython & PhiPack
     orth_files = [(os.path.split(sico_file)[1].split('.')[0], sico_file) for sico_file in sico_files]
 
     #Find PhiPack values for each sico file
-    orth_phipack_values = _phipack_values_for_sicos(orth_files)
+    orth_phipack_values = _phipack_values_for_sicos(orth_files, native_phi, phipack_stats)
 
     #Convert list of sico files into ortholog name mapped to BioPython Alignment object
     sico_alignments = [(ortholog, AlignIO.read(sico_file, 'fasta'))
@@ -151,7 +160,8 @@ def calculate_tables(genome_ids_a, genome_ids_b, sico_files, oddeven=False):
 
     #Calculate tables for normal sico alignments
     log.info('Starting calculations for full alignments')
-    table_a, table_b = _tables_for_split_alignments(split_alignments, ortholog_gene_names, orth_phipack_values)
+    table_a, table_b = _tables_for_split_alignments(split_alignments, ortholog_gene_names, orth_phipack_values,
+                                                    backend)
 
     if not oddeven:
         return table_a, table_b
@@ -175,12 +185,13 @@ def calculate_tables(genome_ids_a, genome_ids_b, sico_files, oddeven=False):
                      for ortholog, odd_x, odd_y in odd_split_alignments)
     for ortholog, odd_x, odd_y in odd_split_alignments:
         AlignIO.write([odd_x, odd_y], odd_files[ortholog], 'fasta')
-    odd_phipack_vals = _phipack_values_for_sicos(odd_files.items())
+    odd_phipack_vals = _phipack_values_for_sicos(odd_files.items(), native_phi)
     shutil.rmtree(odd_alignments_dir)
 
     #Calculate tables for odd codon sico alignments
     log.info('Starting calculations for odd alignments')
-    table_a_odd, table_b_odd = _tables_for_split_alignments(odd_split_alignments, ortholog_gene_names, odd_phipack_vals)
+    table_a_odd, table_b_odd = _tables_for_split_alignments(odd_split_alignments, ortholog_gene_names, odd_phipack_vals,
+                                                            backend)
 
     #Recover even alignments as second from each pair of alignments
     even_split_alignments = [(orthologname,
@@ -194,14 +205,15 @@ def calculate_tables(genome_ids_a, genome_ids_b, sico_files, oddeven=False):
                      for ortholog, even_x, even_y in even_split_alignments)
     for ortholog, even_x, even_y in even_split_alignments:
         AlignIO.write([even_x, even_y], even_files[ortholog], 'fasta')
-    even_phipack_vals = _phipack_values_for_sicos(even_files.items())
+    even_phipack_vals = _phipack_values_for_sicos(even_files.items(), native_phi)
     shutil.rmtree(even_alignments_dir)
 
     #Calculate tables for even codon sico alignments
     log.info('Starting calculations for even alignments')
     table_a_even, table_b_even = _tables_for_split_alignments(even_split_alignments,
                                                               ortholog_gene_names,
-                                                              even_phipack_vals)
+                                                              even_phipack_vals,
+                                                              backend)
 
     #Concatenate tables and return their values
     table_a_full = tempfile.mkstemp(suffix='.tsv', prefix='table_a_full_')[1]
@@ -211,25 +223,13 @@ def calculate_tables(genome_ids_a, genome_ids_b, sico_files, oddeven=False):
     return table_a_full, table_b_full
 
 
-def _codeml_values_for_alignments(codeml_dir, ali_x, ali_y):
-    """Calculate codeml values for sico files for full alignment, and alignments of even and odd codons."""
-    #Run codeml to calculate values for dn & ds
-    subdir = tempfile.mkdtemp(dir=codeml_dir)
-    codeml_file = run_codeml(subdir, ali_x, ali_y)
-    codeml_values_dict = parse_codeml_output(codeml_file)
-    return codeml_values_dict
-
-
-def _tables_for_split_alignments(split_ortholog_alignments, ortholog_gene_names, orth_phipack_values):
+def _tables_for_split_alignments(split_ortholog_alignments, ortholog_gene_names, orth_phipack_values, backend='codeml'):
     """Calculate full tables of values for """
-    #Create temporary folder for codeml files
-    codeml_dir = tempfile.mkdtemp(prefix='codeml_')
-    #Run codeml calculations per sico
-    for ortholog, alignx, aligny in split_ortholog_alignments:
-        values = _codeml_values_for_alignments(codeml_dir, alignx, aligny)
+    #Run codeml calculations for all sicos in batches, reusing cached values for alignments run through codeml before
+    all_values = get_codeml_values_for_alignments([(alignx, aligny) for _, alignx, aligny in split_ortholog_alignments],
+                                                  backend=backend)
+    for (ortholog, _, _), values in zip(split_ortholog_alignments, all_values):
         orth_phipack_values[ortholog].update(values)
-    #Remove codeml_dir
-    shutil.rmtree(codeml_dir)
 
     #Extract ortholog name and correct alignments from split_alignments
     alignments_a = [itemgetter(0, 1)(split_alignment) for split_alignment in split_ortholog_alignments]
@@ -687,9 +687,16 @@ Usage: calculations.py
 --table-a=FILE       destination file path for summary statistics table based on orthologs in taxon A
 --table-b=FILE       destination file path for summary statistics table based on orthologs in taxon B
 --append-odd-even    append separate tables calculated for odd and even codons of ortholog alignments [OPTIONAL]
+--backend=NAME       program to calculate divergence with: codeml (default) or the faster yn00 [OPTIONAL]
+--native-phi         calculate PhiPack values in process instead of running the PhiPack binary [OPTIONAL]
+--phipack-stats=FILE reuse PhiPack values per SICO gene from the stats file produced by run_phipack [OPTIONAL]
 """
-    options = ['genomes-a', 'genomes-b', 'sico-zip', 'table-a', 'table-b', 'append-odd-even?']
-    genome_a_ids_file, genome_b_ids_file, sico_zip, table_a, table_b, oddeven = parse_options(usage, options, args)
+    options = ['genomes-a', 'genomes-b', 'sico-zip', 'table-a', 'table-b', 'append-odd-even?', 'backend=?',
+               'native-phi?', 'phipack-stats=?']
+    genome_a_ids_file, genome_b_ids_file, sico_zip, table_a, table_b, oddeven, backend, native_phi, \
+    phipack_stats_file = parse_options(usage, options, args)
+    backend = backend or 'codeml'
+    assert backend in BACKENDS, 'Backend should be one of {0}, not {1}'.format(', '.join(sorted(BACKENDS)), backend)
 
     #Parse file containing GenBank GenBank Project IDs to extract GenBank Project IDs
     with open(genome_a_ids_file) as read_handle:
@@ -712,7 +719,11 @@ Usage: calculations.py
     sico_files = extract_archive_of_files(sico_zip, create_directory('sicos', inside_dir=run_dir))
 
     #Actually do calculations
-    tmp_table_tuple = calculate_tables(genome_ids_a, genome_ids_b, sico_files, oddeven)
+    phipack_stats = read_phipack_stats(phipack_stats_file) if phipack_stats_file else None
+    tmp_table_tuple = calculate_tables(genome_ids_a, genome_ids_b, sico_files, oddeven, backend, native_phi,
+                                       phipack_stats)
+    get_cache('codeml').flush()
+    get_cache('phipack').flush()
 
     #Write the produced files to command line argument filenames
     with open(table_a, mode='ab') as append_handle:
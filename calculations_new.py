@@ -17,8 +17,9 @@ from argparse import ArgumentParser, RawDescriptionHelpFormatter, ArgumentTypeEr
 from collections import Counter, defaultdict
 from divergence import CODON_TABLE_ID, find_cogs_in_sequence_records, get_most_recent_gene_name, \
     extract_archive_of_files, create_directory
-from divergence.run_codeml import run_codeml, parse_codeml_output
-from divergence.run_phipack import run_phipack
+from divergence.result_cache import get_cache
+from divergence.run_codeml import get_codeml_values_for_alignments, BACKENDS
+from divergence.run_phipack import run_phipack, read_phipack_stats
 from divergence.select_taxa import select_genomes_by_ids
 from itertools import product
 from numpy import mean
@@ -211,19 +212,17 @@ def _extract_cog_digits_and_letters(clade_calcs):
     clade_calcs.values[COG_LETTERS] = ','.join(cog_letters)
 
 
-def _get_codeml_values(alignment_a, alignment_b):
-    '''Get the codeml values for running the first sequences of both alignment a & b through codeml and return dict.'''
-    # Run codeml to calculate values for dn & ds
-    subdir = tempfile.mkdtemp(prefix='codeml_')
-    codeml_file = run_codeml(subdir, alignment_a, alignment_b)
-    codeml_values_dict = parse_codeml_output(codeml_file)
-    shutil.rmtree(subdir)
+def _get_codeml_values(alignment_pairs, backend='codeml'):
+    '''Get the codeml values for running the first sequences of each alignment a & b pair through codeml as dicts.'''
+    # Run codeml (or yn00) in batches to calculate values for dn & ds, or retrieve them from cache when run before
+    codeml_values_dicts = get_codeml_values_for_alignments(alignment_pairs, backend=backend)
 
     # convert poorly legible keys to better ones
-    codeml_values_dict[NON_SYNONYMOUS_SITES] = codeml_values_dict['N']
-    codeml_values_dict[SYNONYMOUS_SITES] = codeml_values_dict['S']
+    for codeml_values_dict in codeml_values_dicts:
+        codeml_values_dict[NON_SYNONYMOUS_SITES] = codeml_values_dict['N']
+        codeml_values_dict[SYNONYMOUS_SITES] = codeml_values_dict['S']
 
-    return codeml_values_dict
+    return codeml_values_dicts
 
 
 def _calc_pi(nr_of_strains, nr_of_sites, site_freq_spec):
@@ -571,25 +570,26 @@ class clade_calcs(object):
         self.values[PRODUCT] = get_most_recent_gene_name(genomes, self.alignment)
 
 
-def _table_calculations(genome_ids_a, genome_ids_b, sico_files, phipack_values):
+def _table_calculations(genome_ids_a, genome_ids_b, sico_files, phipack_values, backend='codeml'):
     '''Perform calculations for comparsion of genome_ids_a with genome_ids_b.'''
     # retrieve genomes once for both
     genomes_a = select_genomes_by_ids(genome_ids_a).values()
 
-    # dictionary to hold the values calculated per file
-    calculations = []
-    # loop over orthologs
+    # parse and split alignments
+    split_alignments = []
     for sico_file in sico_files:
-        # parse alignment
         alignment = AlignIO.read(sico_file, 'fasta')
-
-        # split alignments
         alignment_a = MultipleSeqAlignment(seqr for seqr in alignment if seqr.id.split('|')[0] in genome_ids_a)
         alignment_b = MultipleSeqAlignment(seqr for seqr in alignment if seqr.id.split('|')[0] in genome_ids_b)
+        split_alignments.append((sico_file, alignment_a, alignment_b))
 
-        # calculate codeml values
-        codeml_values = _get_codeml_values(alignment_a, alignment_b)
+    # calculate codeml values for all orthologs at once, so codeml can be run in batches
+    all_codeml_values = _get_codeml_values([(split_a, split_b) for _, split_a, split_b in split_alignments], backend)
 
+    # dictionary to hold the values calculated per file
+    calculations = []
+    # loop over orthologs
+    for (sico_file, alignment_a, alignment_b), codeml_values in zip(split_alignments, all_codeml_values):
         # create gathering instance of clade_calcs
         instance = clade_calcs(alignment_a, genomes_a)
 
@@ -632,8 +632,13 @@ def run_calculations(genomes_a_file,
                      genomes_b_file,
                      sico_files,
                      table_a_dest,
-                     table_b_dest):
+                     table_b_dest,
+                     backend='codeml',
+                     native_phi=False,
+                     phipack_stats=None):
     '''Perform all calculations as requested through command line arguments'''
+    phipack_stats = phipack_stats or {}
+
     # parse genomes in genomes_x_files
     genome_ids_a, common_prefix_a = _extract_genome_ids_and_common_prefix(genomes_a_file)
     genome_ids_b, common_prefix_b = _extract_genome_ids_and_common_prefix(genomes_b_file)
@@ -645,15 +650,20 @@ def run_calculations(genomes_a_file,
                           defaultdict(int)
                           for sico_file in sico_files}
     else:
+        # reuse phipack values from an earlier run_phipack stats file where available
         phipack_dir = tempfile.mkdtemp(prefix='phipack_')
-        phipack_values = {sico_file:
-                          run_phipack(phipack_dir, sico_file)
-                          for sico_file in sico_files}
+        phipack_values = {}
+        for sico_file in sico_files:
+            ortholog = os.path.basename(sico_file).split('.')[0]
+            if ortholog in phipack_stats:
+                phipack_values[sico_file] = dict(phipack_stats[ortholog])
+            else:
+                phipack_values[sico_file] = run_phipack(phipack_dir, sico_file, native_phi)
         shutil.rmtree(phipack_dir)
 
     # per table calculations
     if 1 < len(genome_ids_a):
-        calculations_ab = _table_calculations(genome_ids_a, genome_ids_b, sico_files, phipack_values)
+        calculations_ab = _table_calculations(genome_ids_a, genome_ids_b, sico_files, phipack_values, backend)
         _write_to_file(table_a_dest,
                        genome_ids_a, genome_ids_b,
                        common_prefix_a, common_prefix_b,
@@ -663,7 +673,7 @@ def run_calculations(genomes_a_file,
             write_handle.write('#At least two genomes are needed to calculate diversity, not ' + str(len(genome_ids_a)))
 
     if 1 < len(genome_ids_b):
-        calculations_ba = _table_calculations(genome_ids_b, genome_ids_a, sico_files, phipack_values)
+        calculations_ba = _table_calculations(genome_ids_b, genome_ids_a, sico_files, phipack_values, backend)
         _write_to_file(table_b_dest,
                        genome_ids_b, genome_ids_a,
                        common_prefix_b, common_prefix_a,
@@ -724,7 +734,10 @@ def _prepare_calculations(genomes_a_file,
                           sicozip_file,
                           table_a_dest,
                           table_b_dest,
-                          append_odd_even=False):
+                          append_odd_even=False,
+                          backend='codeml',
+                          native_phi=False,
+                          phipack_stats_file=None):
     '''Unzip sico_files, and if needed create temporary files for the odd/even only codons.'''
     if append_odd_even:
         # prepend file makeup when odd/even table are also added
@@ -735,17 +748,25 @@ def _prepare_calculations(genomes_a_file,
     rundir = tempfile.mkdtemp(prefix='calculations_')
     sico_files = extract_archive_of_files(sicozip_file, create_directory('sicos', inside_dir=rundir))
 
+    # phipack values for the full alignments might have been calculated before by run_phipack
+    phipack_stats = read_phipack_stats(phipack_stats_file) if phipack_stats_file else None
+
     # perform normal calculation
-    run_calculations(genomes_a_file, genomes_b_file, sico_files, table_a_dest, table_b_dest)
+    run_calculations(genomes_a_file, genomes_b_file, sico_files, table_a_dest, table_b_dest, backend, native_phi,
+                     phipack_stats)
 
     # separate calculations for odd and even tables
     if append_odd_even:
         odd_sico_files, even_sico_files = _split_by_odd_even_codons(sico_files)
-        run_calculations(genomes_a_file, genomes_b_file, odd_sico_files, table_a_dest, table_b_dest)
-        run_calculations(genomes_a_file, genomes_b_file, even_sico_files, table_a_dest, table_b_dest)
+        run_calculations(genomes_a_file, genomes_b_file, odd_sico_files, table_a_dest, table_b_dest, backend,
+                         native_phi)
+        run_calculations(genomes_a_file, genomes_b_file, even_sico_files, table_a_dest, table_b_dest, backend,
+                         native_phi)
 
     # clean up
     shutil.rmtree(rundir)
+    get_cache('codeml').flush()
+    get_cache('phipack').flush()
 
 def main(argv=None):  # IGNORE:C0111
     '''Command line options.'''
@@ -789,6 +810,14 @@ USAGE
 
         parser.add_argument('-a', '--append-odd-even', action='store_true',
                             help='append separate tables calculated for odd and even codons of ortholog alignments (default: False)')
+        parser.add_argument('--backend', choices=sorted(BACKENDS), default='codeml',
+                            help='program to calculate divergence with, where yn00 is much faster than codeml '
+                                 '(default: codeml)')
+        parser.add_argument('--native-phi', action='store_true',
+                            help='calculate PhiPack values in process instead of running the PhiPack binary '
+                                 '(default: False)')
+        parser.add_argument('--phipack-stats', type=test_file_readable,
+                            help='reuse PhiPack values per ortholog from the stats file produced by run_phipack')
 
         # Process arguments
         args = parser.parse_args(argv)
@@ -803,7 +832,10 @@ USAGE
                               args.sico_zip[0],
                               args.table_a[0],
                               args.table_b[0],
-                              args.append_odd_even)
+                              args.append_odd_even,
+                              args.backend,
+                              args.native_phi,
+                              args.phipack_stats)
 
         return 0
     except KeyboardInterrupt:
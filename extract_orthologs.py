@@ -5,6 +5,7 @@ from __future__ import division
 from Bio import SeqIO
 from divergence import create_directory, extract_archive_of_files, create_archive_of_files, parse_options, \
     get_most_recent_gene_name, find_cogs_in_sequence_records
+from divergence.groups_store import has_current_store, read_groups_store
 from divergence.select_taxa import select_genomes_by_ids
 from itertools import chain
 import logging as log
@@ -106,6 +107,10 @@ def extract_orthologs(run_dir, genomes, dna_files, groups_file, require_limiter=
 
 def _create_ortholog_dictionaries(groups_file):
     """Convert groups file into a list of ortholog dictionaries, which map project_id to their associated proteins."""
+    #Read the binary groups store written next to groups file when it is current, instead of parsing groups file again
+    if has_current_store(groups_file):
+        return read_groups_store(groups_file)
+
     #Sample line: 58017|YP_219088.1 58191|YP_001572431.1 59431|YP_002149136.1
     ortholog_proteins_per_genome = []
     with open(groups_file) as read_handle:
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""Module to store the groups of orthologous proteins in groups.txt in a compact binary file next to it, which can be
+memory-mapped to look up the group of any protein in constant time, without parsing groups.txt again.
+
+The store holds interned genome and protein ids, group membership in compressed sparse row format, and an open
+addressing hash index from genome and protein id to protein, all as little-endian unsigned 32 bit integers. Proteins
+are stored in order of their groups, so the row offsets of each group delimit its proteins directly:
+    header                  magic, number of genomes, proteins, groups & hash slots, and size & CRC-32 of groups.txt
+    genome_offsets          genomes + 1 offsets into the genome ids
+    protein_genomes         genome of each protein
+    protein_offsets         proteins + 1 offsets into the protein ids
+    protein_groups          group of each protein
+    group_offsets           groups + 1 offsets into the proteins
+    slots                   hash slots holding protein + 1, or zero when empty
+    genome ids & protein ids, as concatenated strings"""
+
+from array import array
+from contextlib import closing
+import logging as log
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+
+__author__ = "Tim te Beek"
+__contact__ = "brs@nbic.nl"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Suffix appended to the groups file path to get the path of its store
+STORE_SUFFIX = '.store'
+
+# Identifies the file format, including its version
+MAGIC = 'DGS2'
+
+HEADER = struct.Struct('<4sIIIIQI')
+UINT32 = struct.Struct('<I')
+
+
+def _hash(genome_id, protein_id):
+    """Return unsigned 32 bit hash of genome_id and protein_id, which is the same across platforms and runs."""
+    return zlib.crc32(protein_id, zlib.crc32(genome_id)) & 0xffffffff
+
+
+def _uint32_array(values=()):
+    """Return array of unsigned 32 bit integers holding values."""
+    values = array('I', values)
+    assert values.itemsize == 4, 'Unsigned integers should be 4 bytes long, but are {0}'.format(values.itemsize)
+    return values
+
+
+def _checksum(groups_file):
+    """Return size and unsigned 32 bit CRC-32 of the contents of groups_file."""
+    size = crc = 0
+    with open(groups_file, mode='rb') as read_handle:
+        for chunk in iter(lambda: read_handle.read(1 << 20), ''):
+            size += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+    return size, crc & 0xffffffff
+
+
+def _write_uint32_array(write_handle, values):
+    """Write values to write_handle as little-endian unsigned 32 bit integers."""
+    if sys.byteorder == 'big':
+        values = _uint32_array(values)
+        values.byteswap()
+    values.tofile(write_handle)
+
+
+def _read_uint32_array(buffer_, offset, length):
+    """Return array of length little-endian unsigned 32 bit integers read from buffer_ at offset."""
+    values = _uint32_array()
+    values.fromstring(buffer_[offset:offset + 4 * length])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def write_groups_store(groups_file, store_file=None):
+    """Write the groups in groups_file, with proteins in the form genome_id|protein_id separated by whitespace, to a
+    binary store at store_file, defaulting to groups_file with STORE_SUFFIX appended. Return the store file."""
+    start = time.time()
+    store_file = store_file or groups_file + STORE_SUFFIX
+    genome_indices = {}
+    genome_offsets = _uint32_array([0])
+    genome_ids = []
+    protein_genomes = _uint32_array()
+    protein_offsets = _uint32_array([0])
+    protein_ids = []
+    protein_groups = _uint32_array()
+    group_offsets = _uint32_array([0])
+    size = crc = 0
+    with open(groups_file, mode='rb') as read_handle:
+        for line in read_handle:
+            size += len(line)
+            crc = zlib.crc32(line, crc)
+            for label in line.split():
+                genome_id, protein_id = label.split('|', 1)
+                if genome_id not in genome_indices:
+                    genome_indices[genome_id] = len(genome_ids)
+                    genome_ids.append(genome_id)
+                    genome_offsets.append(genome_offsets[-1] + len(genome_id))
+                protein_genomes.append(genome_indices[genome_id])
+                protein_ids.append(protein_id)
+                protein_offsets.append(protein_offsets[-1] + len(protein_id))
+                protein_groups.append(len(group_offsets) - 1)
+            group_offsets.append(len(protein_ids))
+
+    # Index proteins in an open addressing hash table with linear probing, at most three quarters full
+    slots = _uint32_array([0]) * max(2, 1 << (len(protein_ids) * 4 // 3).bit_length())
+    mask = len(slots) - 1
+    for protein, protein_id in enumerate(protein_ids):
+        slot = _hash(genome_ids[protein_genomes[protein]], protein_id) & mask
+        while slots[slot]:
+            slot = (slot + 1) & mask
+        slots[slot] = protein + 1
+
+    with open(store_file + '.tmp', mode='wb') as write_handle:
+        write_handle.write(HEADER.pack(MAGIC, len(genome_ids), len(protein_ids), len(group_offsets) - 1, len(slots),
+                                       size, crc & 0xffffffff))
+        for values in (genome_offsets, protein_genomes, protein_offsets, protein_groups, group_offsets, slots):
+            _write_uint32_array(write_handle, values)
+        write_handle.write(''.join(genome_ids))
+        write_handle.write(''.join(protein_ids))
+    os.rename(store_file + '.tmp', store_file)
+    log.info('Stored %i groups of %i proteins from %i genomes in %.1f seconds', len(group_offsets) - 1,
+             len(protein_ids), len(genome_ids), time.time() - start)
+    return store_file
+
+
+def has_current_store(groups_file):
+    """Return True when the store next to groups_file exists and was written from the current contents of groups_file,
+    as recorded by their size and CRC-32, regardless of modification times that copies may or may not keep."""
+    store_file = groups_file + STORE_SUFFIX
+    if not os.path.isfile(store_file):
+        return False
+    with open(store_file, mode='rb') as read_handle:
+        header = read_handle.read(HEADER.size)
+    if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+        return False
+    size, crc = HEADER.unpack(header)[5:]
+    return os.path.getsize(groups_file) == size and _checksum(groups_file) == (size, crc)
+
+
+class GroupsStore(object):
+    """Memory-mapped binary store of groups written by write_groups_store, where groups and proteins are referred to by
+    their index in the store."""
+
+    def __init__(self, store_file):
+        with open(store_file, mode='rb') as read_handle:
+            self._map = mmap.mmap(read_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, genomes, proteins, groups, slots = HEADER.unpack_from(self._map)[:5]
+        assert magic == MAGIC, '{0} is not a groups store'.format(store_file)
+        self.genome_count, self.protein_count, self.group_count, self._slot_count = genomes, proteins, groups, slots
+
+        # Determine the offsets of each section, which follow each other in a fixed order
+        offset = HEADER.size
+        sections = {}
+        for name, length in (('genome_offsets', genomes + 1), ('protein_genomes', proteins),
+                             ('protein_offsets', proteins + 1), ('protein_groups', proteins),
+                             ('group_offsets', groups + 1), ('slots', slots)):
+            sections[name] = offset
+            offset += 4 * length
+        self._sections = sections
+        self._genome_ids = offset
+        self._protein_ids = offset + self._uint32('genome_offsets', genomes)
+        self._genomes = [self._string(self._genome_ids, 'genome_offsets', index) for index in xrange(genomes)]
+
+    def _uint32(self, section, index):
+        """Return the unsigned integer at index in section."""
+        return UINT32.unpack_from(self._map, self._sections[section] + 4 * index)[0]
+
+    def _string(self, strings, section, index):
+        """Return the string at index of the strings starting at offset strings, delimited by the offsets in section."""
+        return self._map[strings + self._uint32(section, index):strings + self._uint32(section, index + 1)]
+
+    def __len__(self):
+        return self.group_count
+
+    def close(self):
+        """Close the memory map backing this store."""
+        self._map.close()
+
+    def genome_ids(self):
+        """Return the genome ids in the store, in order of their first occurrence in the groups."""
+        return list(self._genomes)
+
+    def protein(self, protein):
+        """Return genome id and protein id of protein."""
+        return (self._genomes[self._uint32('protein_genomes', protein)],
+                self._string(self._protein_ids, 'protein_offsets', protein))
+
+    def members(self, group):
+        """Return the proteins in group, as tuples of genome id and protein id."""
+        return [self.protein(protein)
+                for protein in xrange(self._uint32('group_offsets', group), self._uint32('group_offsets', group + 1))]
+
+    def proteins_per_genome(self, group):
+        """Return dictionary mapping the genome ids in group to their protein ids, in the same order as groups.txt."""
+        proteins_per_genome = {}
+        for genome_id, protein_id in self.members(group):
+            proteins_per_genome.setdefault(genome_id, []).append(protein_id)
+        return proteins_per_genome
+
+    def all_proteins_per_genome(self):
+        """Return the proteins_per_genome dictionaries of all groups, reading each section only once."""
+        protein_genomes = _read_uint32_array(self._map, self._sections['protein_genomes'], self.protein_count)
+        protein_offsets = _read_uint32_array(self._map, self._sections['protein_offsets'], self.protein_count + 1)
+        group_offsets = _read_uint32_array(self._map, self._sections['group_offsets'], self.group_count + 1)
+        protein_ids = self._map[self._protein_ids:self._protein_ids + protein_offsets[-1]]
+        groups = []
+        for group in xrange(self.group_count):
+            proteins_per_genome = {}
+            for protein in xrange(group_offsets[group], group_offsets[group + 1]):
+                proteins_per_genome.setdefault(self._genomes[protein_genomes[protein]], []).append(
+                    protein_ids[protein_offsets[protein]:protein_offsets[protein + 1]])
+            groups.append(proteins_per_genome)
+        return groups
+
+    def find(self, genome_id, protein_id):
+        """Return the group containing protein_id of genome_id, or None when the protein is in none of the groups."""
+        mask = self._slot_count - 1
+        slot = _hash(genome_id, protein_id) & mask
+        while True:
+            protein = self._uint32('slots', slot)
+            if not protein:
+                return None
+            if self.protein(protein - 1) == (genome_id, protein_id):
+                return self._uint32('protein_groups', protein - 1)
+            slot = (slot + 1) & mask
+
+
+def read_groups_store(groups_file):
+    """Return the groups in the current store next to groups_file as a list of dictionaries mapping genome ids to their
+    protein ids, the same as parsing groups_file itself would."""
+    with closing(GroupsStore(groups_file + STORE_SUFFIX)) as store:
+        return store.all_proteins_per_genome()
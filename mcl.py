@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""Module to cluster the mclInput graph with the Markov Cluster algorithm in process using SciPy sparse matrices, as an
+alternative to the mcl binary: http://www.micans.org/mcl/"""
+
+from __future__ import division
+from multiprocessing.pool import ThreadPool
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+import logging as log
+import multiprocessing
+import numpy as np
+import time
+
+__author__ = "Tim te Beek"
+__contact__ = "brs@nbic.nl"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Same inflation as passed to the mcl binary
+INFLATION = 1.5
+
+# After each expansion drop values below PRUNE_THRESHOLD and keep at most SELECT values per column, as mcl -P & -S do
+PRUNE_THRESHOLD = 1 / 4000
+SELECT = 500
+
+# Stop iterating once no value changes more than CONVERGENCE_TOLERANCE, or after MAX_ITERATIONS
+CONVERGENCE_TOLERANCE = 1e-6
+MAX_ITERATIONS = 100
+
+
+def read_abc(mcl_input_file):
+    """Return labels in order of appearance and a symmetric sparse matrix of the weights between the labels in the tab
+    separated label, label, weight lines of mcl_input_file, keeping the highest weight of edges listed both ways."""
+    indices = {}
+    rows, columns, weights = [], [], []
+    with open(mcl_input_file) as read_handle:
+        for line in read_handle:
+            label_a, label_b, weight = line.split()
+            rows.append(indices.setdefault(label_a, len(indices)))
+            columns.append(indices.setdefault(label_b, len(indices)))
+            weights.append(float(weight))
+    labels = sorted(indices, key=indices.get)
+    matrix = sparse.coo_matrix((weights, (rows, columns)), shape=(len(labels), len(labels))).tocsr()
+    return labels, matrix.maximum(matrix.T).tocsc()
+
+
+def _normalize_columns(matrix):
+    """Return matrix with each column scaled to sum to one."""
+    sums = np.asarray(matrix.sum(axis=0)).ravel()
+    return matrix.dot(sparse.diags(1 / np.where(sums == 0, 1, sums))).tocsc()
+
+
+def _expand(matrix, pool, threads):
+    """Return the square of matrix, computed by threads over blocks of columns."""
+    if threads == 1:
+        return matrix.dot(matrix).tocsc()
+    block_size = -(-matrix.shape[1] // threads)
+    blocks = [matrix[:, start:start + block_size] for start in range(0, matrix.shape[1], block_size)]
+    return sparse.hstack(pool.map(matrix.dot, blocks), format='csc')
+
+
+def _prune(matrix, prune_threshold, select):
+    """Drop values below prune_threshold and all but the select largest values in each column of the CSC matrix, while
+    always keeping the largest value of each column."""
+    matrix.sort_indices()
+    counts = np.diff(matrix.indptr)
+    columns = np.repeat(np.arange(matrix.shape[1]), counts)
+    order = np.lexsort((-matrix.data, columns))
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - np.repeat(matrix.indptr[:-1], counts)
+    matrix.data[(0 < ranks) & ((matrix.data < prune_threshold) | (select <= ranks))] = 0
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def _inflate(matrix, inflation):
+    """Return matrix with each value raised to the power inflation, and columns normalized again."""
+    matrix = matrix.copy()
+    matrix.data **= inflation
+    return _normalize_columns(matrix)
+
+
+def markov_clustering(matrix, inflation=INFLATION, threads=None, prune_threshold=PRUNE_THRESHOLD, select=SELECT,
+                      max_iterations=MAX_ITERATIONS):
+    """Return clusters as arrays of node indices in the symmetric sparse weights matrix, after alternating expansion
+    and inflation until the matrix converges. Clusters are the connected components of the converged matrix."""
+    if not matrix.shape[0]:
+        return []
+    # Add loops with the maximum weight of each column, as mcl does by default, and make the matrix stochastic
+    maxima = np.asarray(matrix.max(axis=0).todense()).ravel()
+    matrix = _normalize_columns(matrix + sparse.diags(maxima - matrix.diagonal()))
+
+    threads = threads or multiprocessing.cpu_count()
+    pool = ThreadPool(threads) if 1 < threads else None
+    try:
+        for iteration in range(1, max_iterations + 1):
+            expanded = _prune(_expand(matrix, pool, threads), prune_threshold, select)
+            inflated = _inflate(_normalize_columns(expanded), inflation)
+            change = abs(inflated - matrix).max()
+            matrix = inflated
+            if change < CONVERGENCE_TOLERANCE:
+                log.info('MCL converged after %i iterations', iteration)
+                break
+        else:
+            log.warn('MCL did not converge within %i iterations', max_iterations)
+    finally:
+        if pool:
+            pool.close()
+
+    nr_clusters, assignment = connected_components(matrix, directed=False)
+    order = np.argsort(assignment, kind='mergesort')
+    return np.split(order, np.cumsum(np.bincount(assignment, minlength=nr_clusters))[:-1])
+
+
+def write_clusters(labels, clusters, groups_file):
+    """Write clusters to groups_file in the same format as mcl --abc: one line of tab separated labels per cluster,
+    with the largest clusters first."""
+    with open(groups_file, mode='w') as write_handle:
+        for cluster in sorted(clusters, key=len, reverse=True):
+            write_handle.write('\t'.join(labels[index] for index in cluster) + '\n')
+    return groups_file
+
+
+def run_mcl(mcl_input_file, groups_file, inflation=INFLATION, threads=None, prune_threshold=PRUNE_THRESHOLD,
+            select=SELECT):
+    """Cluster the graph in ABC format mcl_input_file and write the resulting clusters to groups_file."""
+    start = time.time()
+    labels, matrix = read_abc(mcl_input_file)
+    clusters = markov_clustering(matrix, inflation, threads, prune_threshold, select)
+    log.info('Clustered %i proteins into %i groups in %.1f seconds', len(labels), len(clusters), time.time() - start)
+    return write_clusters(labels, clusters, groups_file)
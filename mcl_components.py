@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Module to split the mclInput graph into its connected components and cluster those independently across processes,
+as Markov clusters never span more than one connected component. Components are clustered with either the mcl binary
+or the in process Markov Cluster algorithm of the mcl module."""
+
+from divergence.versions import MCL
+from multiprocessing import Pool
+from subprocess import check_call, STDOUT
+import logging as log
+import os
+import shutil
+import tempfile
+import time
+
+__author__ = "Tim te Beek"
+__contact__ = "brs@nbic.nl"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Small components are clustered together in batches of about this many edges, to limit the overhead per batch
+BATCH_SIZE = 100000
+
+
+def _find(parents, node):
+    """Return the root of node in the union-find forest parents, while halving the path to the root."""
+    while parents[node] != node:
+        parents[node] = parents[parents[node]]
+        node = parents[node]
+    return node
+
+
+def read_components(mcl_input_file):
+    """Return the connected components of the graph in ABC format mcl_input_file, found by union-find over interned
+    labels, as tuples of the labels and the edge lines of each component."""
+    indices = {}
+    parents = []
+    edges = []
+    with open(mcl_input_file) as read_handle:
+        for line in read_handle:
+            nodes = []
+            for label in line.split()[:2]:
+                node = indices.setdefault(label, len(indices))
+                if node == len(parents):
+                    parents.append(node)
+                nodes.append(node)
+            root_a, root_b = _find(parents, nodes[0]), _find(parents, nodes[1])
+            if root_a != root_b:
+                parents[max(root_a, root_b)] = min(root_a, root_b)
+            edges.append((nodes[0], line))
+
+    components = {}
+    for label, node in indices.iteritems():
+        components.setdefault(_find(parents, node), ([], []))[0].append(label)
+    for node, line in edges:
+        components[_find(parents, node)][1].append(line)
+    return components.values()
+
+
+def _cluster_batch(job):
+    """Cluster the graph in ABC format batch_file into batch_file.groups with the mcl binary, or in process when native
+    is True. Return the groups file."""
+    batch_file, native, threads, prune_threshold, select = job
+    groups_file = batch_file + '.groups'
+    if native:
+        from divergence.mcl import run_mcl, PRUNE_THRESHOLD, SELECT
+        run_mcl(batch_file, groups_file, threads=threads, prune_threshold=prune_threshold or PRUNE_THRESHOLD,
+                select=select or SELECT)
+    else:
+        command = [MCL, batch_file, '--abc', '-I', '1.5', '-o', groups_file, '-te', str(threads)]
+        with open(os.devnull, mode='w') as devnull:
+            check_call(command, stdout=devnull, stderr=STDOUT)
+    return groups_file
+
+
+def cluster_components(mcl_input_file, groups_file, processes, native=False, threads=1, prune_threshold=None,
+                       select=None):
+    """Cluster the connected components of the graph in ABC format mcl_input_file independently across processes, each
+    using threads, and write the merged groups to groups_file with the largest groups first. Components of one or two
+    proteins form a group without clustering, while larger components are clustered in batches of about BATCH_SIZE
+    edges, with the largest components first."""
+    start = time.time()
+    components = read_components(mcl_input_file)
+    groups = [labels for labels, _ in components if len(labels) <= 2]
+    larger = sorted((lines for labels, lines in components if 2 < len(labels)), key=len, reverse=True)
+
+    #Write batches of whole components to separate files, to cluster each batch in a separate process
+    batch_dir = tempfile.mkdtemp(prefix='mcl_components_', dir=os.path.dirname(os.path.abspath(groups_file)))
+    jobs = []
+    batch = []
+    for index, lines in enumerate(larger):
+        batch.extend(lines)
+        if BATCH_SIZE <= len(batch) or index == len(larger) - 1:
+            batch_file = os.path.join(batch_dir, 'batch_{0}.abc'.format(len(jobs)))
+            with open(batch_file, mode='w') as write_handle:
+                write_handle.writelines(batch)
+            jobs.append((batch_file, native, threads, prune_threshold, select))
+            batch = []
+
+    if jobs:
+        pool = Pool(min(processes, len(jobs)))
+        try:
+            batch_groups_files = pool.map(_cluster_batch, jobs, chunksize=1)
+        finally:
+            pool.close()
+        for batch_groups_file in batch_groups_files:
+            with open(batch_groups_file) as read_handle:
+                groups.extend(line.split() for line in read_handle if line.strip())
+    shutil.rmtree(batch_dir)
+
+    with open(groups_file, mode='w') as write_handle:
+        for group in sorted(groups, key=len, reverse=True):
+            write_handle.write('\t'.join(group) + '\n')
+    log.info('Clustered %i connected components, of which %i with more than two proteins in %i batches, into %i '
+             'groups in %.1f seconds', len(components), len(larger), len(jobs), len(groups), time.time() - start)
+    return groups_file
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""Module to cluster the mclInput graph at several inflation values in one pass, loading the graph only once, and to
+summarize the number of single copy orthologs (SICOs) found at each inflation value, to help choose the granularity."""
+
+from divergence import create_archive_of_files, create_directory, parse_options
+from divergence.versions import MCL, MCXLOAD
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from subprocess import check_call, STDOUT
+import logging as log
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+__author__ = "Tim te Beek"
+__contact__ = "brs@nbic.nl"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Graph shared with the processes forked to cluster it, so each process need not read or receive the graph itself
+_GRAPH = {}
+
+
+def count_sicos(groups_file, genome_ids=None):
+    """Return the number of groups in groups_file with exactly one protein for each of genome_ids, or for each of the
+    genomes in groups_file when genome_ids is not given, and the number of groups in total."""
+    groups = []
+    with open(groups_file) as read_handle:
+        for line in read_handle:
+            genomes = [protein.split('|')[0] for protein in line.split()]
+            if genomes:
+                groups.append(genomes)
+    genome_ids = set(genome_ids or (genome for genomes in groups for genome in genomes))
+    sicos = sum(1 for genomes in groups if len(genomes) == len(genome_ids) and set(genomes) == genome_ids)
+    return sicos, len(groups)
+
+
+def _cluster_shared_graph(job):
+    """Cluster the graph shared through _GRAPH at inflation and write the clusters to groups_file."""
+    from divergence.mcl import markov_clustering, write_clusters
+    inflation, groups_file, threads, prune_threshold, select = job
+    clusters = markov_clustering(_GRAPH['matrix'], inflation, threads, prune_threshold, select)
+    return write_clusters(_GRAPH['labels'], clusters, groups_file)
+
+
+def _sweep_native(mcl_input_file, jobs, processes):
+    """Read mcl_input_file once into a sparse matrix shared with forked processes, and cluster it for each of jobs."""
+    from divergence.mcl import read_abc
+    _GRAPH['labels'], _GRAPH['matrix'] = read_abc(mcl_input_file)
+    try:
+        pool = Pool(processes)
+        try:
+            return pool.map(_cluster_shared_graph, jobs, chunksize=1)
+        finally:
+            pool.close()
+    finally:
+        _GRAPH.clear()
+
+
+def _sweep_mcl(mcl_input_file, jobs, processes, work_dir):
+    """Load mcl_input_file once into the native binary matrix format of mcl with mcxload, and run mcl on that matrix
+    for each of jobs, with processes instances of mcl running at once."""
+    matrix_file = os.path.join(work_dir, 'mclInput.mcx')
+    tab_file = os.path.join(work_dir, 'mclInput.tab')
+    command = [MCXLOAD, '-abc', mcl_input_file, '--stream-mirror', '--write-binary', '-write-tab', tab_file,
+               '-o', matrix_file]
+    log.info('Executing: %s', ' '.join(command))
+    check_call(command)
+
+    def cluster_matrix(job):
+        """Cluster the loaded matrix at inflation into groups_file, using labels from the tab file."""
+        inflation, groups_file, threads = job[:3]
+        command = [MCL, matrix_file, '-I', str(inflation), '-use-tab', tab_file, '-o', groups_file, '-te', str(threads)]
+        log.info('Executing: %s', ' '.join(command))
+        with open(os.devnull, mode='w') as devnull:
+            check_call(command, stdout=devnull, stderr=STDOUT)
+        return groups_file
+
+    pool = ThreadPool(processes)
+    try:
+        return pool.map(cluster_matrix, jobs, chunksize=1)
+    finally:
+        pool.close()
+
+
+def sweep_inflations(mcl_input_file, inflations, out_dir, processes=None, native=False, threads=1, prune_threshold=None,
+                     select=None, genome_ids=None):
+    """Cluster the graph in ABC format mcl_input_file at each of inflations, across processes that each use threads,
+    writing the groups for each inflation to out_dir/groups_I{inflation}.tsv. Write a tab separated summary of the
+    number of groups and SICOs across genome_ids per inflation to out_dir/inflation_summary.tsv. The graph is loaded
+    once, either into a sparse matrix when native is True, or else into a binary matrix for the mcl binary. Return the
+    groups files and the summary file."""
+    start = time.time()
+    inflations = sorted(set(float(inflation) for inflation in inflations))
+    processes = min(processes or multiprocessing.cpu_count(), len(inflations))
+    if native:
+        from divergence.mcl import PRUNE_THRESHOLD, SELECT
+        prune_threshold, select = prune_threshold or PRUNE_THRESHOLD, select or SELECT
+    jobs = [(inflation, os.path.join(out_dir, 'groups_I{0}.tsv'.format(inflation)), threads, prune_threshold, select)
+            for inflation in inflations]
+    if native:
+        groups_files = _sweep_native(mcl_input_file, jobs, processes)
+    else:
+        work_dir = tempfile.mkdtemp(prefix='mcl_sweep_', dir=out_dir)
+        groups_files = _sweep_mcl(mcl_input_file, jobs, processes, work_dir)
+        shutil.rmtree(work_dir)
+
+    #Summarize the number of groups and SICOs per inflation value
+    summary_file = os.path.join(out_dir, 'inflation_summary.tsv')
+    with open(summary_file, mode='w') as write_handle:
+        write_handle.write('inflation\tgroups\tsicos\n')
+        for inflation, groups_file in zip(inflations, groups_files):
+            sicos, groups = count_sicos(groups_file, genome_ids)
+            write_handle.write('{0}\t{1}\t{2}\n'.format(inflation, groups, sicos))
+            log.info('Inflation %s yields %i groups, of which %i SICOs', inflation, groups, sicos)
+    log.info('Clustered at %i inflation values in %.1f seconds', len(inflations), time.time() - start)
+    return groups_files, summary_file
+
+
+def main(args):
+    """Main function called when run from command line or as part of pipeline."""
+    usage = """
+Usage: mcl_sweep.py
+--mcl-input=FILE       mclInput file of a run_orthomcl.py run, with tab separated protein, protein & weight lines
+--inflations=LIST      comma separated inflation values to cluster at, such as 1.2,1.5,2,3
+--groups-zip=FILE      destination file path for archive of groups files, one per inflation value
+--summary=FILE         destination file path for tab separated number of groups & SICOs per inflation value
+--genomes=LIST         comma separated genome ids to count SICOs across, defaults to all genomes in mcl-input
+                       [OPTIONAL]
+--native-mcl           cluster in process instead of with the mcl binary [OPTIONAL]
+--processes=INT        number of inflation values to cluster at in parallel, defaults to the number of cores [OPTIONAL]
+--mcl-threads=INT      number of threads to cluster with per inflation value, defaults to one [OPTIONAL]
+"""
+    options = ['mcl-input', 'inflations', 'groups-zip', 'summary', 'genomes=?', 'native-mcl?', 'processes=?',
+               'mcl-threads=?']
+    mcl_input_file, inflations, target_groups_zip, target_summary, genome_ids, native_mcl, processes, mcl_threads = \
+        parse_options(usage, options, args)
+
+    run_dir = tempfile.mkdtemp(prefix='mcl_sweep_')
+    groups_files, summary_file = sweep_inflations(mcl_input_file, inflations.split(','),
+                                                  create_directory('groups', inside_dir=run_dir),
+                                                  processes=processes and int(processes), native=native_mcl,
+                                                  threads=mcl_threads and int(mcl_threads) or 1,
+                                                  genome_ids=genome_ids and genome_ids.split(','))
+
+    #Move output files to their destinations
+    create_archive_of_files(target_groups_zip, groups_files)
+    shutil.move(summary_file, target_summary)
+
+    #Remove unused files to free disk space
+    shutil.rmtree(run_dir)
+
+    #Exit after a comforting log message
+    log.info("Produced: \n%s\n%s", target_groups_zip, target_summary)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
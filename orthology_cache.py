@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""Module to cache the groups and pairwise edges of OrthoMCL runs indexed by genome, so runs on any subset of the
+genomes of a cached run can be answered by projecting its groups onto the selected genomes, instead of running OrthoMCL
+all over again."""
+
+from contextlib import closing
+from divergence import create_directory
+from divergence.result_cache import LOCK_TIMEOUT
+import gzip
+import json
+import logging as log
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+__author__ = "Tim te Beek"
+__contact__ = "brs@nbic.nl"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Maximum number of runs retained, after which the least recently used runs are evicted
+MAX_SUPERSETS = 20
+
+# Statements creating the tables for runs, their genomes including poor proteins, and their group members
+SCHEMA = ['CREATE TABLE IF NOT EXISTS supersets (id INTEGER PRIMARY KEY, parameters TEXT NOT NULL, '
+          'accessed REAL NOT NULL)',
+          'CREATE TABLE IF NOT EXISTS genomes (superset INTEGER NOT NULL, taxon TEXT NOT NULL, proteome TEXT NOT NULL, '
+          'poor_proteins BLOB NOT NULL, PRIMARY KEY (superset, taxon))',
+          'CREATE INDEX IF NOT EXISTS genomes_proteome_ix ON genomes (taxon, proteome)',
+          'CREATE TABLE IF NOT EXISTS members (superset INTEGER NOT NULL, taxon TEXT NOT NULL, protein TEXT NOT NULL, '
+          'group_index INTEGER NOT NULL)',
+          'CREATE INDEX IF NOT EXISTS members_taxon_ix ON members (superset, taxon)']
+
+
+def _split_fasta_by_taxon(fasta_file):
+    """Return dictionary of taxon code to the records in fasta_file with headers in the form >taxon|protein."""
+    records = {}
+    taxon = None
+    with open(fasta_file) as read_handle:
+        for line in read_handle:
+            if line.startswith('>'):
+                taxon = line[1:].split('|')[0]
+            if taxon is not None:
+                records.setdefault(taxon, []).append(line)
+    return dict((taxon, ''.join(lines)) for taxon, lines in records.iteritems())
+
+
+def _write_groups(groups, groups_file):
+    """Write groups to groups_file in the same format as mcl --abc, with the largest groups first."""
+    with open(groups_file, mode='w') as write_handle:
+        for group in sorted(groups, key=len, reverse=True):
+            write_handle.write('\t'.join(group) + '\n')
+
+
+class OrthologyCache(object):
+    """SQLite backed cache of OrthoMCL runs that can be shared between concurrent processes, next to a gzipped copy of
+    the mclInput edges of each run.
+
+    Each run is stored with its parameters and genomes, where genomes map taxon codes to proteome checksums, so a
+    genome only matches a cached genome for exactly the same proteome. Group members are indexed by run and taxon,
+    to project groups onto a selection of genomes without reading the groups of genomes left out."""
+
+    def __init__(self, cache_dir=None, max_supersets=MAX_SUPERSETS):
+        if cache_dir is None:
+            cache_dir = create_directory('cache')
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, 'orthology.sqlite')
+        self.max_supersets = max_supersets
+
+        with closing(self._connect()) as connection:
+            with connection:
+                for statement in SCHEMA:
+                    connection.execute(statement)
+
+    def _connect(self):
+        """Open connection that defers to explicit BEGIN IMMEDIATE statements for write transactions."""
+        connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+        connection.text_factory = str
+        return connection
+
+    def _edges_file(self, superset):
+        """Return path of the gzipped mclInput edges of superset."""
+        return os.path.join(self.cache_dir, 'orthology_{0}.abc.gz'.format(superset))
+
+    def find_superset(self, genomes, parameters):
+        """Return the cached run with the fewest genomes that contains all genomes and was run with parameters, or None
+        when no such run was cached."""
+        parameters = json.dumps(parameters, sort_keys=True)
+        with closing(self._connect()) as connection:
+            candidates = None
+            for taxon, proteome in genomes.iteritems():
+                supersets = set(row[0] for row in connection.execute(
+                    'SELECT g.superset FROM genomes g JOIN supersets s ON s.id = g.superset '
+                    'WHERE g.taxon = ? AND g.proteome = ? AND s.parameters = ?', (taxon, proteome, parameters)))
+                candidates = supersets if candidates is None else candidates & supersets
+                if not candidates:
+                    return None
+            sizes = [(connection.execute('SELECT COUNT(*) FROM genomes WHERE superset = ?', (superset,)).fetchone()[0],
+                      superset) for superset in candidates]
+            superset = min(sizes)[1]
+            with connection:
+                connection.execute('UPDATE supersets SET accessed = ? WHERE id = ?', (time.time(), superset))
+        log.info('Found cached run %i with %i genomes covering all %i selected genomes', superset, min(sizes)[0],
+                 len(genomes))
+        return superset
+
+    def project(self, superset, genomes, groups_file, poor_proteins_file, recluster=False, native_mcl=False):
+        """Write the groups of cached run superset restricted to the proteins of genomes to groups_file, and the poor
+        proteins of genomes to poor_proteins_file. Groups that lost proteins of genomes left out are affected: when
+        recluster is True these are clustered again using only the edges between their remaining proteins, or else they
+        are kept with their remaining proteins, as long as more than one protein remains."""
+        start = time.time()
+        taxa = sorted(genomes)
+        groups = {}
+        with closing(self._connect()) as connection:
+            poor_proteins = {}
+            for taxon in taxa:
+                poor_proteins[taxon] = connection.execute('SELECT poor_proteins FROM genomes WHERE superset = ? AND '
+                                                          'taxon = ?', (superset, taxon)).fetchone()[0]
+                for protein, group_index in connection.execute(
+                        'SELECT protein, group_index FROM members WHERE superset = ? AND taxon = ?', (superset, taxon)):
+                    groups.setdefault(group_index, []).append(protein)
+            affected = set(row[0] for row in connection.execute(
+                'SELECT DISTINCT group_index FROM members WHERE superset = ? AND taxon NOT IN ({0})'.format(
+                    ', '.join('?' * len(taxa))), [superset] + taxa))
+
+        with open(poor_proteins_file, mode='w') as write_handle:
+            for taxon in taxa:
+                write_handle.write(str(poor_proteins[taxon]))
+
+        #Drop affected groups left with a single protein, as proteins only similar to proteins left out have no edges
+        projected = [group for group_index, group in groups.iteritems()
+                     if group_index not in affected or not recluster and 1 < len(group)]
+        reclustered = [group for group_index, group in groups.iteritems() if group_index in affected and recluster]
+        if reclustered:
+            projected.extend(self._recluster(superset, reclustered, native_mcl))
+        _write_groups(projected, groups_file)
+        log.info('Projected %i groups onto %i genomes, of which %i affected groups%s, in %.1f seconds', len(projected),
+                 len(taxa), len(affected & set(groups)), ' were clustered again' if recluster else '',
+                 time.time() - start)
+        return groups_file, poor_proteins_file
+
+    def _recluster(self, superset, groups, native_mcl):
+        """Return the clusters of the proteins in groups, using only the cached edges of superset between proteins of
+        the same group."""
+        from divergence.mcl_components import cluster_components
+        group_of = dict((protein, index) for index, group in enumerate(groups) for protein in group)
+        work_dir = tempfile.mkdtemp(prefix='orthology_cache_')
+        try:
+            mcl_input_file = os.path.join(work_dir, 'mclInput.tsv')
+            with closing(gzip.open(self._edges_file(superset))) as read_handle:
+                with open(mcl_input_file, mode='w') as write_handle:
+                    for line in read_handle:
+                        protein_a, protein_b = line.split()[:2]
+                        if protein_a in group_of and group_of[protein_a] == group_of.get(protein_b):
+                            write_handle.write(line)
+            groups_file = cluster_components(mcl_input_file, os.path.join(work_dir, 'groups.tsv'), 1, native_mcl)
+            with open(groups_file) as read_handle:
+                return [line.split() for line in read_handle if line.strip()]
+        finally:
+            shutil.rmtree(work_dir)
+
+    def store(self, genomes, parameters, groups_file, mcl_input_file, poor_proteins_file):
+        """Store the groups, mclInput edges and poor proteins of a run over genomes with parameters. Cached runs over a
+        subset of genomes with the same parameters are removed, as are the least recently used runs beyond
+        max_supersets."""
+        poor_proteins = _split_fasta_by_taxon(poor_proteins_file)
+        with open(groups_file) as read_handle:
+            members = [(protein.split('|')[0], protein, group_index)
+                       for group_index, line in enumerate(read_handle) for protein in line.split()]
+        parameters = json.dumps(parameters, sort_keys=True)
+
+        with closing(self._connect()) as connection:
+            connection.isolation_level = None
+            connection.execute('BEGIN IMMEDIATE')
+            superset = connection.execute('INSERT INTO supersets (parameters, accessed) VALUES (?, ?)',
+                                          (parameters, time.time())).lastrowid
+            connection.executemany('INSERT INTO genomes (superset, taxon, proteome, poor_proteins) VALUES (?, ?, ?, ?)',
+                                   [(superset, taxon, proteome, sqlite3.Binary(poor_proteins.get(taxon, '')))
+                                    for taxon, proteome in genomes.iteritems()])
+            connection.executemany('INSERT INTO members (superset, taxon, protein, group_index) VALUES (?, ?, ?, ?)',
+                                   [(superset,) + member for member in members])
+
+            #Remove runs over a subset of these genomes, and the least recently used runs beyond max_supersets
+            removed = []
+            for other, in connection.execute('SELECT id FROM supersets WHERE id != ? AND parameters = ?',
+                                             (superset, parameters)).fetchall():
+                other_genomes = connection.execute('SELECT taxon, proteome FROM genomes WHERE superset = ?', (other,))
+                if all(genomes.get(taxon) == proteome for taxon, proteome in other_genomes):
+                    removed.append(other)
+            removed.extend(row[0] for row in connection.execute(
+                'SELECT id FROM supersets WHERE id NOT IN ({0}) ORDER BY accessed DESC LIMIT -1 OFFSET ?'.format(
+                    ', '.join('?' * (len(removed) + 1))), removed + [superset, self.max_supersets - 1]))
+            for other in removed:
+                for table, column in (('supersets', 'id'), ('genomes', 'superset'), ('members', 'superset')):
+                    connection.execute('DELETE FROM {0} WHERE {1} = ?'.format(table, column), (other,))
+
+            #Copy the edges before committing, so committed runs always have their edges available
+            with open(mcl_input_file, mode='rb') as read_handle:
+                with closing(gzip.open(self._edges_file(superset), mode='wb')) as write_handle:
+                    shutil.copyfileobj(read_handle, write_handle)
+            connection.execute('COMMIT')
+
+        for other in removed:
+            if os.path.isfile(self._edges_file(other)):
+                os.remove(self._edges_file(other))
+        log.info('Cached run %i with %i genomes and %i grouped proteins, removing %i cached runs', superset,
+                 len(genomes), len(members), len(removed))
+        return superset
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""Module to convert all-vs-all BLAST hits into similar sequences rows in process, producing the same rows as
+orthomclBlastParser, while reading the compliant fasta files only once and streaming over the BLAST hits."""
+
+from __future__ import division
+from itertools import groupby
+import logging as log
+import os
+import re
+import time
+
+__author__ = "Tim te Beek"
+__contact__ = "brs@nbic.nl"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Number of similar sequences rows written at once
+WRITE_BATCH_SIZE = 10000
+
+
+def read_protein_lengths(fasta_files_dir):
+    """Return dictionary mapping each protein id in the compliant taxon.fasta files in fasta_files_dir to its taxon code
+    and sequence length."""
+    proteins = {}
+    for fasta_file in sorted(name for name in os.listdir(fasta_files_dir) if not name.startswith('.')):
+        match = re.search(r'(\w+).fasta', fasta_file)
+        assert match, '\'{0}\' is not in \'taxon.fasta\' format'.format(fasta_file)
+        taxon = match.group(1)
+        protein_id = None
+        with open(os.path.join(fasta_files_dir, fasta_file)) as read_handle:
+            for line in read_handle:
+                line = line.rstrip('\n')
+                if not line.strip():
+                    continue
+                header = re.search(r'>(\S+)', line)
+                if header:
+                    protein_id = header.group(1)
+                    assert protein_id not in proteins, 'Fasta files contain duplicate ID ' + protein_id
+                    proteins[protein_id] = [taxon, 0]
+                elif protein_id:
+                    proteins[protein_id][1] += len(line)
+    return proteins
+
+
+def _format_evalue(evalue):
+    """Return mantissa and exponent strings for evalue string, formatted exactly like orthomclBlastParser does."""
+    if evalue.startswith('e'):
+        evalue = '1' + evalue
+    mantissa, exponent = ('%.3e' % float(evalue)).split('e')
+    mantissa = re.sub(r'\.0+$', '', '%.2f' % float(mantissa))
+    exponent = exponent.replace('+', '')
+    return mantissa, '0' if exponent == '00' else exponent
+
+
+def _non_overlapping_length(spans):
+    """Return the number of positions covered by the union of the inclusive (start, end) spans."""
+    spans = sorted(tuple(sorted(span)) for span in spans)
+    start, end = spans[0]
+    length = 0
+    for span_start, span_end in spans[1:]:
+        if span_end <= end:
+            continue
+        if span_start <= end:
+            end = span_end
+        else:
+            length += end - start + 1
+            start, end = span_start, span_end
+    return length + end - start + 1
+
+
+def _perl_number(value):
+    """Return value formatted the way Perl prints numbers."""
+    return '%.15g' % value
+
+
+def _similar_sequences_row(proteins, query_id, subject_id, hsps):
+    """Return similar sequences row for all HSPs of query_id against subject_id, computing percent match over the union
+    of the HSPs on the shorter of both sequences."""
+    query_taxon, query_length = proteins[query_id]
+    subject_taxon, subject_length = proteins[subject_id]
+    query_shorter = query_length < subject_length
+
+    # Values from the first HSP, and HSP spans on the shorter sequence
+    mantissa, exponent = _format_evalue(hsps[0][10])
+    spans = [(int(hsp[6]), int(hsp[7])) if query_shorter else (int(hsp[8]), int(hsp[9])) for hsp in hsps]
+    total_identities = sum(float(hsp[2]) * float(hsp[3]) for hsp in hsps)
+    total_length = sum(float(hsp[3]) for hsp in hsps)
+
+    percent_identity = int(total_identities / total_length * 10 + .5) / 10
+    shorter_length = query_length if query_shorter else subject_length
+    percent_match = int(_non_overlapping_length(spans) / shorter_length * 1000 + .5) / 10
+    return '\t'.join((query_id, subject_id, query_taxon, subject_taxon, mantissa, exponent,
+                      _perl_number(percent_identity), _perl_number(percent_match))) + '\n'
+
+
+def _parse_hits(proteins, read_handle, counts):
+    """Yield a similar sequences row for each query and subject pair of consecutive HSPs read from read_handle, while
+    counting the rows in counts[0]."""
+    hsps = (line.split() for line in read_handle if line.strip())
+    for (query_id, subject_id), pair_hsps in groupby(hsps, key=lambda hsp: (hsp[0], hsp[1])):
+        assert query_id in proteins, 'can\'t find length for ' + query_id
+        assert subject_id in proteins, 'can\'t find length for ' + subject_id
+        counts[0] += 1
+        yield _similar_sequences_row(proteins, query_id, subject_id, list(pair_hsps))
+
+
+def _evalue_key(fields):
+    """Return sortable exponent and mantissa of the evalue in similar sequences row fields, with zero evalues lowest."""
+    mantissa = float(fields[4])
+    return (int(fields[5]), mantissa) if mantissa else (float('-inf'), 0)
+
+
+def apply_cutoffs(rows, evalue_exponent, percent_match):
+    """Yield those similar sequences rows that can still affect the pairs orthomclPairs finds with the same cutoffs,
+    dropping all other rows. Rows should be grouped by query, as they are in BLAST output.
+
+    Kept are all rows that pass both cutoffs, where zero evalues always pass the evalue cutoff. Also kept are rows that
+    only fail the percent match cutoff, when they have the lowest evalue of the inter-taxon rows of their query and
+    subject taxon, as orthomclPairs determines best hits before applying the percent match cutoff. Finally the
+    dropped row with the lowest exponent is yielded last, when lower than that of any kept row, as orthomclPairs gives
+    zero evalues an exponent one below the lowest exponent. Any kept rows failing the cutoffs are still ignored by
+    orthomclPairs itself."""
+    seen_queries = set()
+    lowest_kept = lowest_dropped = None
+    for query_id, query_rows in groupby(rows, key=lambda row: row.split('\t', 1)[0]):
+        assert query_id not in seen_queries, 'Similar sequences should be grouped by query, but met again ' + query_id
+        seen_queries.add(query_id)
+
+        # Rows failing the evalue cutoff never affect pairs, as best hits only matter when they pass the evalue cutoff
+        candidates = []
+        best = {}
+        for row in query_rows:
+            fields = row.split('\t')
+            key = _evalue_key(fields)
+            if key[0] <= evalue_exponent:
+                candidates.append((row, fields, key))
+                if fields[2] != fields[3] and key < best.get(fields[3], (float('inf'), 0)):
+                    best[fields[3]] = key
+            elif lowest_dropped is None or key < lowest_dropped[0]:
+                lowest_dropped = key, row
+
+        # Zero evalues are excluded when determining the lowest exponent
+        for row, fields, key in candidates:
+            if percent_match <= float(fields[7]) or fields[2] != fields[3] and key == best[fields[3]]:
+                if fields[4] != '0' and (lowest_kept is None or key < lowest_kept):
+                    lowest_kept = key
+                yield row
+            elif fields[4] != '0' and (lowest_dropped is None or key < lowest_dropped[0]):
+                lowest_dropped = key, row
+
+    if lowest_dropped is not None and (lowest_kept is None or lowest_dropped[0] < lowest_kept):
+        yield lowest_dropped[1]
+
+
+def parse_blast(blast_file, fasta_files_dir, similar_seqs_file, evalue_exponent=None, percent_match=None):
+    """Write a similar sequences row to similar_seqs_file for each query and subject pair of consecutive HSPs in BLAST
+    m8 format blast_file, with lengths and taxa of proteins read from the compliant fasta files in fasta_files_dir.
+    When evalue_exponent and percent_match are given, only rows that can pass these cutoffs in orthomclPairs are
+    written."""
+    start = time.time()
+    proteins = read_protein_lengths(fasta_files_dir)
+    counts = [0]
+    written = 0
+    with open(blast_file) as read_handle:
+        with open(similar_seqs_file, mode='w') as write_handle:
+            rows = _parse_hits(proteins, read_handle, counts)
+            if evalue_exponent is not None:
+                rows = apply_cutoffs(rows, int(evalue_exponent), percent_match)
+            buffered = []
+            for row in rows:
+                buffered.append(row)
+                if WRITE_BATCH_SIZE <= len(buffered):
+                    write_handle.writelines(buffered)
+                    written += len(buffered)
+                    buffered = []
+            write_handle.writelines(buffered)
+            written += len(buffered)
+    log.info('Parsed %i similar sequences from BLAST hits in %.1f seconds, and wrote %i of them', counts[0],
+             time.time() - start, written)
+    return similar_seqs_file
+
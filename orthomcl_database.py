@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 """Module to create, configure and dispose separate database instances for individual OrthoMCL runs."""
 
+from __future__ import division
 from ConfigParser import SafeConfigParser
 from datetime import datetime
 from divergence import resource_filename
@@ -9,12 +10,29 @@ import logging as log
 import os
 import shutil
 import socket
+import time
 
 __author__ = "Tim te Beek"
 __contact__ = "brs@nbic.nl"
 __copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
 __license__ = "MIT"
 
+# Minimum percentage of the shorter sequence covered by a BLAST hit for the hit to be considered in finding pairs
+PERCENT_MATCH_CUTOFF = 50
+
+# Open connections per database name, reused for all statements against the same database within a process
+_CONNECTIONS = {}
+
+# Number of pre-installed databases leased to runs, and seconds to wait before trying again when all are leased
+POOL_SIZE = 8
+LEASE_RETRY_INTERVAL = 10
+
+# Tables of the OrthoMCL schema, which are truncated when emptying a pooled database while any other tables are dropped
+SCHEMA_TABLES = ('SimilarSequences', 'Ortholog', 'InParalog', 'CoOrtholog')
+
+# Open connections holding the named lock on each leased database, as MySQL releases locks when connections close
+_LEASES = {}
+
 
 def _get_root_credentials():
     """Retrieve MySQL credentials from orthomcl.config to an account that is allowed to create new databases."""
@@ -57,6 +75,74 @@ def create_database():
     return dbname
 
 
+def _lock_pooled_database(cursor, pool_size):
+    """Return the name of the first pooled database that cursor could obtain the named lock on, or None if all are
+    locked by other connections."""
+    for index in range(pool_size):
+        dbname = 'orthomcl_pool_{0}'.format(index)
+        cursor.execute('SELECT GET_LOCK(%s, 0)', (dbname,))
+        if cursor.fetchone()[0] == 1:
+            return dbname
+    return None
+
+
+def _empty_database(cursor, dbname):
+    """Drop all tables but those of the OrthoMCL schema from dbname, such as those left behind by orthomclPairs, and
+    truncate the tables of the OrthoMCL schema. Return True when all tables of the OrthoMCL schema exist."""
+    cursor.execute('SELECT table_name FROM information_schema.tables WHERE table_schema = %s AND table_type = %s',
+                   (dbname, 'BASE TABLE'))
+    tables = [row[0] for row in cursor.fetchall()]
+    leftover = [table for table in tables if table not in SCHEMA_TABLES]
+    if leftover:
+        cursor.execute('DROP TABLE ' + ', '.join('{0}.{1}'.format(dbname, table) for table in leftover))
+    for table in SCHEMA_TABLES:
+        if table in tables:
+            cursor.execute('TRUNCATE TABLE {0}.{1}'.format(dbname, table))
+    return all(table in tables for table in SCHEMA_TABLES)
+
+
+def lease_database(pool_size=POOL_SIZE):
+    """Lease one of the databases orthomcl_pool_0 up to orthomcl_pool_{pool_size - 1}, waiting for a database to be
+    returned when all are leased, and grant rights to orthomcl user. A lease is held as a named lock on a separate
+    connection until the database is returned, or until that connection is lost, so concurrent runs never share a
+    database. The leased database is emptied of anything left behind by earlier runs, and created anew when the
+    OrthoMCL schema was not completely installed in it. Return the database name and whether the schema is installed."""
+    dbhost, port, user, passwd = _get_root_credentials()
+    db_connection = MySQLdb.connect(host=dbhost, port=port, user=user, passwd=passwd)
+    cursor = db_connection.cursor()
+    dbname = _lock_pooled_database(cursor, pool_size)
+    while dbname is None:
+        log.info('All %i pooled databases are leased, trying again in %i seconds', pool_size, LEASE_RETRY_INTERVAL)
+        time.sleep(LEASE_RETRY_INTERVAL)
+        dbname = _lock_pooled_database(cursor, pool_size)
+
+    cursor.execute('CREATE DATABASE IF NOT EXISTS ' + dbname)
+    installed = _empty_database(cursor, dbname)
+    if not installed:
+        #Start over from an empty database, as orthomclInstallSchema fails on any existing tables
+        cursor.execute('DROP DATABASE ' + dbname)
+        cursor.execute('CREATE DATABASE ' + dbname)
+    cursor.execute('GRANT ALL on {0}.* TO orthomcl@{1} IDENTIFIED BY \'pass\';'.format(dbname, socket.gethostname()))
+    db_connection.commit()
+    cursor.close()
+    _LEASES[dbname] = db_connection
+    log.info('Leased database %s as %s on %s', dbname, user, dbhost)
+    return dbname, installed
+
+
+def return_database(dbname):
+    """Empty leased database dbname for the next run, and release the lease on it."""
+    _close_connection(dbname)
+    db_connection = _LEASES.pop(dbname)
+    cursor = db_connection.cursor()
+    _empty_database(cursor, dbname)
+    db_connection.commit()
+    cursor.execute('SELECT RELEASE_LOCK(%s)', (dbname,))
+    cursor.close()
+    db_connection.close()
+    log.info('Returned database %s', dbname)
+
+
 def get_configuration_file(run_dir, dbname, evalue_exponent):
     """Return OrthoMCL configuration file for generated database and evalue_exponent.
     dbname - unique unused database name
@@ -72,9 +158,10 @@ orthologTable=Ortholog
 inParalogTable=InParalog
 coOrthologTable=CoOrtholog
 interTaxonMatchView=InterTaxonMatch
-percentMatchCutoff=50
+percentMatchCutoff={percent_match}
 evalueExponentCutoff={evalue_exponent}
-oracleIndexTblSpc=NONE""".format(dbname=dbname, host=host, port=port, evalue_exponent=evalue_exponent)
+oracleIndexTblSpc=NONE""".format(dbname=dbname, host=host, port=port, percent_match=PERCENT_MATCH_CUTOFF,
+                                  evalue_exponent=evalue_exponent)
 
     #Write to file & return file
     config_file = os.path.join(run_dir, '{0}.cfg'.format(dbname))
@@ -83,8 +170,69 @@ oracleIndexTblSpc=NONE""".format(dbname=dbname, host=host, port=port, evalue_exp
     return config_file
 
 
+def get_connection(dbname):
+    """Return connection to database dbname with LOAD DATA LOCAL INFILE enabled on the client side, reusing an open
+    connection to the same database within this process."""
+    connection = _CONNECTIONS.get(dbname)
+    if connection is not None:
+        try:
+            connection.ping()
+            return connection
+        except MySQLdb.OperationalError:
+            log.info('Reconnecting to database %s', dbname)
+    host, port, user, passwd = _get_root_credentials()
+    connection = MySQLdb.connect(host=host, port=port, user=user, passwd=passwd, db=dbname, local_infile=1)
+    _CONNECTIONS[dbname] = connection
+    return connection
+
+
+def _close_connection(dbname):
+    """Close the pooled connection to database dbname, if any."""
+    connection = _CONNECTIONS.pop(dbname, None)
+    if connection is not None:
+        connection.close()
+
+
+def bulk_load_similar_sequences(dbname, similar_seqs_file):
+    """Load similar sequences into SimilarSequences in database dbname with LOAD DATA LOCAL INFILE. Non unique indexes
+    are dropped ahead of the load and added again afterwards in a single statement, so MySQL builds them once instead
+    of maintaining them row by row. Unique indexes are kept, as the REPLACE in loading depends on them."""
+    connection = get_connection(dbname)
+    cursor = connection.cursor()
+
+    #Collect columns per non unique index, in order, as reported by SHOW INDEX
+    cursor.execute('SHOW INDEX FROM SimilarSequences')
+    indexes = {}
+    for row in cursor.fetchall():
+        non_unique, key_name, seq_in_index, column_name = row[1:5]
+        if non_unique and key_name != 'PRIMARY':
+            indexes.setdefault(key_name, []).append((seq_in_index, column_name))
+    if indexes:
+        cursor.execute('ALTER TABLE SimilarSequences ' + ', '.join('DROP INDEX ' + name for name in sorted(indexes)))
+
+    #Load the similar sequences file from the client side
+    start = time.time()
+    cursor.execute('LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE SimilarSequences FIELDS TERMINATED BY \'\\t\'',
+                   (similar_seqs_file,))
+    rows = cursor.rowcount
+    connection.commit()
+    loaded = time.time()
+    log.info('Loaded %i similar sequences into %s in %.1f seconds (%.0f rows per second)', rows, dbname,
+             loaded - start, rows / max(loaded - start, 0.001))
+
+    #Add the dropped indexes again
+    if indexes:
+        cursor.execute('ALTER TABLE SimilarSequences ' + ', '.join(
+            'ADD INDEX {0} ({1})'.format(name, ', '.join(column for _, column in sorted(columns)))
+            for name, columns in sorted(indexes.items())))
+        log.info('Rebuilt %i indexes on SimilarSequences in %.1f seconds', len(indexes), time.time() - loaded)
+    cursor.close()
+    return rows
+
+
 def delete_database(dbname):
     """Delete database after running OrthoMCL analysis."""
+    _close_connection(dbname)
     host, port, user, passwd = _get_root_credentials()
     db_connection = MySQLdb.connect(host=host, port=port, user=user, passwd=passwd)
     cursor = db_connection.cursor()
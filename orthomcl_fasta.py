@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""Module to adjust and filter proteome fasta files in process, producing the same files as orthomclAdjustFasta and
+orthomclFilterFasta, but at paths of our choosing instead of in the current working directory."""
+
+from __future__ import division
+from functools import partial
+from multiprocessing import Pool
+import logging as log
+import os
+import re
+
+__author__ = "Tim te Beek"
+__contact__ = "brs@nbic.nl"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Fraction of poor proteins above which a proteome is reported as suspicious
+MAX_POOR_FRACTION = 0.1
+
+
+def _map(function, arguments, processes):
+    """Return function applied to each of arguments, in a pool of processes when more than one process is requested."""
+    if processes and 1 < processes and 1 < len(arguments):
+        pool = Pool(processes)
+        try:
+            return pool.map(function, arguments)
+        finally:
+            pool.close()
+    return map(function, arguments)
+
+
+def adjust_fasta(proteome, id_field=3):
+    """Write proteome fasta file to adjusted fasta file with definition lines >taxon_code|unique_protein_id, where the
+    protein id is taken from field id_field of the original definition line, with fields separated by spaces or '|'.
+    proteome - tuple of taxon code, proteome fasta file and adjusted fasta file"""
+    taxon_code, proteome_file, adjusted_fasta_file = proteome
+    ids = set()
+    with open(proteome_file) as read_handle:
+        with open(adjusted_fasta_file, mode='w') as write_handle:
+            for line in read_handle:
+                if '>' in line:
+                    definition = re.sub(r'\s*\|\s*', '|', re.sub(r'\s+', ' ', re.sub(r'^>\s*', '', line)))
+                    protein_id = re.split(r'[\s\|]', definition)[id_field - 1]
+                    assert protein_id not in ids, \
+                        'Fasta file \'{0}\' contains a duplicate id: {1}'.format(proteome_file, protein_id)
+                    ids.add(protein_id)
+                    write_handle.write('>{0}|{1}\n'.format(taxon_code, protein_id))
+                else:
+                    write_handle.write(line)
+    return adjusted_fasta_file
+
+
+def adjust_fasta_files(proteomes, id_field=3, processes=None):
+    """Adjust each of proteomes as tuples of taxon code, proteome file and adjusted fasta file, optionally in parallel
+    across processes. Return the adjusted fasta files."""
+    return _map(partial(adjust_fasta, id_field=id_field), proteomes, processes)
+
+
+def _write_sequence(sequence_lines, min_length, max_percent_stop, good_handle, poor_handle):
+    """Write the definition and sequence lines of a single protein to either good_handle or poor_handle, depending on
+    its length and percentage of stop codons. Return True when the protein was written to poor_handle."""
+    sequence = ''.join(line.rstrip('\n') for line in sequence_lines[1:])
+    stops = len(re.findall(r'[^A-Za-z]', sequence))
+    is_poor = len(sequence) < min_length or (sequence and max_percent_stop < stops / len(sequence) * 100)
+    (poor_handle if is_poor else good_handle).writelines(sequence_lines)
+    return bool(is_poor)
+
+
+def filter_fasta(filter_job, min_length=10, max_percent_stop=20):
+    """Split the proteins in a compliant fasta file over separate good and poor proteins files, where poor proteins are
+    shorter than min_length or contain more than max_percent_stop percent stop codons.
+    filter_job - tuple of compliant fasta file, good proteins file and poor proteins file
+    Return the number of proteins and the number of poor proteins."""
+    fasta_file, good_file, poor_file = filter_job
+    proteins = poor = 0
+    with open(fasta_file) as read_handle, open(good_file, mode='w') as good_handle, \
+            open(poor_file, mode='w') as poor_handle:
+        sequence_lines = []
+        for line in read_handle:
+            line = line.rstrip('\n') + '\n'
+            if line.startswith('>') and sequence_lines:
+                proteins += 1
+                poor += _write_sequence(sequence_lines, min_length, max_percent_stop, good_handle, poor_handle)
+                sequence_lines = []
+            sequence_lines.append(line)
+        if sequence_lines:
+            proteins += 1
+            poor += _write_sequence(sequence_lines, min_length, max_percent_stop, good_handle, poor_handle)
+    return proteins, poor
+
+
+def filter_fasta_files(fasta_files, out_dir, good_file, poor_file, report_file, min_length=10, max_percent_stop=20,
+                       processes=None):
+    """Filter each of the compliant taxon.fasta files into good_file and poor_file, optionally in parallel across
+    processes, and write a report of suspicious proteomes with more than 10% poor proteins to report_file."""
+    #Options may be passed on from the command line as strings, which Python 2 would compare to lengths without error
+    min_length, max_percent_stop = int(min_length), float(max_percent_stop)
+    jobs = []
+    for fasta_file in sorted(fasta_files):
+        taxon = re.search(r'(\w+).fasta', os.path.basename(fasta_file)).group(1)
+        jobs.append((fasta_file, os.path.join(out_dir, taxon + '.good.fasta'),
+                     os.path.join(out_dir, taxon + '.poor.fasta')))
+    counts = _map(partial(filter_fasta, min_length=min_length, max_percent_stop=max_percent_stop), jobs, processes)
+
+    # Concatenate good and poor proteins per proteome in a fixed order
+    with open(good_file, mode='w') as good_handle, open(poor_file, mode='w') as poor_handle:
+        for _, taxon_good, taxon_poor in jobs:
+            for taxon_file, handle in ((taxon_good, good_handle), (taxon_poor, poor_handle)):
+                with open(taxon_file) as read_handle:
+                    for line in read_handle:
+                        handle.write(line)
+                os.remove(taxon_file)
+
+    # Report proteomes with a high fraction of poor proteins the same way as orthomclFilterFasta
+    suspicious = [(os.path.basename(fasta_file), poor / proteins)
+                  for (fasta_file, _, _), (proteins, poor) in zip(jobs, counts)
+                  if proteins and MAX_POOR_FRACTION < poor / proteins]
+    with open(report_file, mode='w') as report_handle:
+        if suspicious:
+            report_handle.write('\nProteomes with > 10% poor proteins:\n')
+            for name, fraction in suspicious:
+                report_handle.write('  {0}\t{1}%\n'.format(name, int(fraction * 100)))
+    log.info('Filtered %i proteins from %i proteomes, of which %i poor', sum(proteins for proteins, _ in counts),
+             len(jobs), sum(poor for _, poor in counts))
+    return good_file, poor_file
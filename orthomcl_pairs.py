@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Module to find orthologs, inparalogs and coorthologs among similar sequences in memory using NumPy, following the
+same algorithm as orthomclPairs, but without loading the similar sequences into a database first."""
+
+from __future__ import division
+from divergence.orthomcl_database import PERCENT_MATCH_CUTOFF
+from divergence.orthomcl_sqlite import write_pairs_files
+import logging as log
+import numpy as np
+import time
+
+__author__ = "Tim te Beek"
+__contact__ = "brs@nbic.nl"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+
+def read_similar_sequences(similar_seqs_file):
+    """Read tab separated similar sequences as output by orthomclBlastParser into arrays. Return sorted unique sequence
+    ids, sorted unique taxon ids and a dictionary of arrays per column, with sequences and taxa as indices in these."""
+    with open(similar_seqs_file) as read_handle:
+        rows = [line.rstrip('\n').split('\t') for line in read_handle]
+    columns = zip(*rows) if rows else [()] * 8
+    sequence_ids, sequences = np.unique(np.array(columns[0] + columns[1], dtype=str), return_inverse=True)
+    taxon_ids, taxa = np.unique(np.array(columns[2] + columns[3], dtype=str), return_inverse=True)
+    hits = {'query': sequences[:len(rows)],
+            'subject': sequences[len(rows):],
+            'query_taxon': taxa[:len(rows)],
+            'subject_taxon': taxa[len(rows):],
+            'evalue_mant': np.array(columns[4], dtype=float),
+            'evalue_exp': np.array(columns[5], dtype=float).astype(np.int64),
+            'percent_match': np.array(columns[7], dtype=float)}
+    return sequence_ids, taxon_ids, hits
+
+
+def _join(left, right):
+    """Return indices into left and right for all pairs of equal values, as in an inner join on those values."""
+    order = np.argsort(right, kind='mergesort')
+    lows = np.searchsorted(right[order], left, side='left')
+    counts = np.searchsorted(right[order], left, side='right') - lows
+    left_indices = np.repeat(np.arange(len(left)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return left_indices, order[np.repeat(lows, counts) + offsets]
+
+
+def _lowest_evalues(keys, exponents, mantissas):
+    """Return the sorted unique keys, and the exponent and mantissa of the lowest evalue for each of those keys."""
+    order = np.lexsort((mantissas, exponents, keys))
+    firsts = order[np.concatenate(([True], keys[order][1:] != keys[order][:-1]))] if len(keys) else order
+    return keys[firsts], exponents[firsts], mantissas[firsts]
+
+
+def _lookup(sorted_keys, keys):
+    """Return indices of keys in sorted_keys, and a mask of the keys that occur in sorted_keys at all."""
+    indices = np.minimum(np.searchsorted(sorted_keys, keys), max(len(sorted_keys) - 1, 0))
+    found = sorted_keys[indices] == keys if len(sorted_keys) else np.zeros(len(keys), dtype=bool)
+    return indices, found
+
+
+def _mutual_hits(hits, rows, nr_sequences, small_mantissa):
+    """Return sequences a & b and the unnormalized score for each pair of rows that are hits in both directions, with a
+    before b. The score is the mean of -log10(evalue) in both directions, using just the exponents when either mantissa
+    is below small_mantissa."""
+    query = hits['query'][rows]
+    subject = hits['subject'][rows]
+    first, second = _join(query * nr_sequences + subject, subject * nr_sequences + query)
+    keep = query[first] < subject[first]
+    first, second = rows[first[keep]], rows[second[keep]]
+    return hits['query'][first], hits['subject'][first], _score(hits, first, second, small_mantissa)
+
+
+def _score(hits, first, second, small_mantissa):
+    """Return the mean of -log10(evalue) of the hits in rows first and second."""
+    exponents = hits['evalue_exp'][first] + hits['evalue_exp'][second]
+    mantissas = hits['evalue_mant'][first] * hits['evalue_mant'][second]
+    small = (hits['evalue_mant'][first] < small_mantissa) | (hits['evalue_mant'][second] < small_mantissa)
+    return (np.log10(np.where(small, 1, mantissas)) + exponents) / -2
+
+
+def _unordered_pairs(first, second, count):
+    """Return a single key for each pair of values below count, regardless of the order of the values in the pair."""
+    return np.minimum(first, second) * count + np.maximum(first, second)
+
+
+def _normalize(scores, groups):
+    """Return scores divided by the average score within the same group."""
+    inverse = np.unique(groups, return_inverse=True)[1]
+    averages = np.bincount(inverse, weights=scores) / np.bincount(inverse)
+    return scores / averages[inverse]
+
+
+def find_pairs(hits, nr_sequences, nr_taxa, evalue_exponent, percent_match=PERCENT_MATCH_CUTOFF):
+    """Return orthologs, inparalogs and coorthologs among similar sequences hits as orthomclPairs would, each as a tuple
+    of arrays with sequences a & b and their normalized scores."""
+    query, subject = hits['query'], hits['subject']
+    query_taxon, subject_taxon = hits['query_taxon'], hits['subject_taxon']
+    mantissas, exponents = hits['evalue_mant'], hits['evalue_exp']
+    sequence_taxa = np.zeros(nr_sequences, dtype=np.int64)
+    sequence_taxa[query] = query_taxon
+    sequence_taxa[subject] = subject_taxon
+
+    # Replace the exponent of zero evalues with an exponent lower than any other
+    if (mantissas == 0).any():
+        exponents[mantissas == 0] = exponents[mantissas != 0].min() - 1 if (mantissas != 0).any() else 0
+    passes_cutoffs = (exponents <= int(evalue_exponent)) & (percent_match <= hits['percent_match'])
+
+    # Orthologs: mutual best hits between taxa, where best hits are determined before applying any cutoffs
+    inter = np.flatnonzero(query_taxon != subject_taxon)
+    query_taxon_keys = query * nr_taxa + subject_taxon
+    best_keys, best_exponents, best_mantissas = _lowest_evalues(query_taxon_keys[inter], exponents[inter],
+                                                                mantissas[inter])
+    best = _lookup(best_keys, query_taxon_keys[inter])[0]
+    is_best = (mantissas[inter] < 0.01) | ((exponents[inter] == best_exponents[best])
+                                           & (mantissas[inter] == best_mantissas[best]))
+    best_hits = inter[is_best & passes_cutoffs[inter]]
+    ortholog_a, ortholog_b, ortholog_scores = _mutual_hits(hits, best_hits, nr_sequences, 0.01)
+    taxon_a, taxon_b = sequence_taxa[ortholog_a], sequence_taxa[ortholog_b]
+    ortholog_scores = _normalize(ortholog_scores, _unordered_pairs(taxon_a, taxon_b, nr_taxa))
+
+    # InParalogs: mutual hits within a taxon that are at least as good as the best hit of the query in any other taxon
+    inter_queries, inter_exponents, inter_mantissas = _lowest_evalues(best_keys // nr_taxa, best_exponents,
+                                                                      best_mantissas)
+    intra = np.flatnonzero((query != subject) & (query_taxon == subject_taxon) & passes_cutoffs)
+    indices, found = _lookup(inter_queries, query[intra])
+    is_better = ~found | (mantissas[intra] < 0.001) | (exponents[intra] < inter_exponents[indices]) \
+        | ((exponents[intra] == inter_exponents[indices]) & (mantissas[intra] <= inter_mantissas[indices]))
+    inparalog_a, inparalog_b, inparalog_scores = _mutual_hits(hits, intra[is_better], nr_sequences, 0.01)
+
+    # Normalize by the average score of inparalogs with an ortholog in the same taxon, or else of all inparalogs
+    inparalog_taxa = sequence_taxa[inparalog_a]
+    with_ortholog = np.in1d(inparalog_a, (ortholog_a, ortholog_b)) | np.in1d(inparalog_b, (ortholog_a, ortholog_b))
+    sums = np.bincount(inparalog_taxa, weights=inparalog_scores * with_ortholog, minlength=nr_taxa)
+    counts = np.bincount(inparalog_taxa, weights=with_ortholog, minlength=nr_taxa)
+    all_sums = np.bincount(inparalog_taxa, weights=inparalog_scores, minlength=nr_taxa)
+    all_counts = np.bincount(inparalog_taxa, minlength=nr_taxa)
+    averages = np.where(0 < counts, sums / np.maximum(counts, 1), all_sums / np.maximum(all_counts, 1))
+    inparalog_scores = inparalog_scores / averages[inparalog_taxa]
+
+    # CoOrthologs: pairs linked through inparalogs and orthologs that are mutual hits, but not orthologs themselves
+    inparalog_from = np.concatenate((inparalog_a, inparalog_b))
+    inparalog_to = np.concatenate((inparalog_b, inparalog_a))
+    ortholog_from = np.concatenate((ortholog_a, ortholog_b))
+    ortholog_to = np.concatenate((ortholog_b, ortholog_a))
+    first, second = _join(inparalog_to, ortholog_from)
+    linked_from, linked_to = inparalog_from[first], ortholog_to[second]
+    first, second = _join(linked_to, inparalog_from)
+    candidate_a = np.concatenate((linked_from, linked_from[first]))
+    candidate_b = np.concatenate((linked_to, inparalog_to[second]))
+    candidates = np.unique(_unordered_pairs(candidate_a, candidate_b, nr_sequences))
+    candidates = candidates[~np.in1d(candidates, ortholog_a * nr_sequences + ortholog_b)]
+
+    # Both directions should be hits that pass the cutoffs
+    passing = np.flatnonzero(passes_cutoffs)
+    first, ab_hits = _join(candidates, query[passing] * nr_sequences + subject[passing])
+    reverse = (candidates[first] % nr_sequences) * nr_sequences + candidates[first] // nr_sequences
+    second, ba_hits = _join(reverse, query[passing] * nr_sequences + subject[passing])
+    ab_hits, ba_hits = passing[ab_hits[second]], passing[ba_hits]
+    coortholog_scores = _score(hits, ab_hits, ba_hits, 0.00001)
+    taxon_a, taxon_b = query_taxon[ab_hits], subject_taxon[ab_hits]
+    coortholog_scores = _normalize(coortholog_scores, _unordered_pairs(taxon_a, taxon_b, nr_taxa))
+    return ((ortholog_a, ortholog_b, ortholog_scores),
+            (inparalog_a, inparalog_b, inparalog_scores),
+            (query[ab_hits], subject[ab_hits], coortholog_scores))
+
+
+def run_native_pairs(run_dir, similar_seqs_file, evalue_exponent):
+    """Find pairs among the similar sequences in similar_seqs_file and write the mclInput and pairs files to run_dir,
+    as alternative to steps 4 and 9 through 11 against a database. Return the same files as step 11."""
+    start = time.time()
+    sequence_ids, taxon_ids, hits = read_similar_sequences(similar_seqs_file)
+    pairs = find_pairs(hits, len(sequence_ids), len(taxon_ids), evalue_exponent)
+    log.info('Found %i orthologs, %i inparalogs and %i coorthologs among %i similar sequences in %.1f seconds',
+             *([len(scores) for _, _, scores in pairs] + [len(hits['query']), time.time() - start]))
+    return write_pairs_files(run_dir, *[zip(sequence_ids[first], sequence_ids[second], scores)
+                                        for first, second, scores in pairs])
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""Module to run the OrthoMCL database steps against an embedded SQLite database in the run directory, as alternative to
+loading similar sequences into and finding pairs in a MySQL server shared between concurrent runs."""
+
+from divergence import create_directory
+from divergence.orthomcl_database import PERCENT_MATCH_CUTOFF
+from itertools import islice
+import logging as log
+import math
+import os
+import sqlite3
+import time
+
+__author__ = "Tim te Beek"
+__contact__ = "brs@nbic.nl"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Number of similar sequences rows inserted per executemany call
+INSERT_CHUNK_SIZE = 100000
+
+# Tables as created by orthomclInstallSchema, but without indexes so they are not maintained row by row during the load
+SCHEMA = ['''CREATE TABLE SimilarSequences (
+    query_id TEXT, subject_id TEXT, query_taxon_id TEXT, subject_taxon_id TEXT,
+    evalue_mant REAL, evalue_exp INTEGER, percent_identity REAL, percent_match REAL)''',
+          '''CREATE TABLE Ortholog (
+    sequence_id_a TEXT, sequence_id_b TEXT, taxon_id_a TEXT, taxon_id_b TEXT,
+    unnormalized_score REAL, normalized_score REAL)''',
+          '''CREATE TABLE InParalog (
+    sequence_id_a TEXT, sequence_id_b TEXT, taxon_id TEXT,
+    unnormalized_score REAL, normalized_score REAL)''',
+          '''CREATE TABLE CoOrtholog (
+    sequence_id_a TEXT, sequence_id_b TEXT, taxon_id_a TEXT, taxon_id_b TEXT,
+    unnormalized_score REAL, normalized_score REAL)''',
+          '''CREATE VIEW InterTaxonMatch AS
+    SELECT query_id, subject_id, subject_taxon_id, evalue_mant, evalue_exp FROM SimilarSequences
+    WHERE subject_taxon_id != query_taxon_id''']
+
+# Indexes created only once all similar sequences are loaded
+INDEXES = ['CREATE INDEX ss_qtaxexp_ix ON SimilarSequences '
+           '(query_id, subject_taxon_id, evalue_exp, evalue_mant, query_taxon_id, subject_id)',
+           'CREATE INDEX ss_seqs_ix ON SimilarSequences (query_id, subject_id, evalue_exp, evalue_mant, percent_match)']
+
+# Score of a pair of mutual hits: the mean of -log10(evalue) in both directions, with rigged exponents for zero evalues
+_SCORE = '''CASE WHEN {0}.evalue_mant < {2} OR {1}.evalue_mant < {2}
+    THEN ({0}.evalue_exp + {1}.evalue_exp) / -2.0
+    ELSE (log10({0}.evalue_mant * {1}.evalue_mant) + {0}.evalue_exp + {1}.evalue_exp) / -2.0 END'''
+
+# Pair finding statements of orthomclPairs, in order, with the cutoffs substituted
+PAIRS_SQL = [
+    # Replace the exponent of zero evalues with an exponent lower than any other
+    '''UPDATE SimilarSequences SET evalue_exp =
+    (SELECT min(evalue_exp) FROM SimilarSequences WHERE evalue_mant != 0) - 1 WHERE evalue_mant = 0''',
+
+    # Orthologs: mutual best hits between taxa
+    '''CREATE TEMP TABLE BestQueryTaxonScore AS
+    SELECT im.query_id, im.subject_taxon_id, low_exp.evalue_exp, min(im.evalue_mant) AS evalue_mant
+    FROM InterTaxonMatch im,
+         (SELECT query_id, subject_taxon_id, min(evalue_exp) AS evalue_exp
+          FROM InterTaxonMatch GROUP BY query_id, subject_taxon_id) low_exp
+    WHERE im.query_id = low_exp.query_id AND im.subject_taxon_id = low_exp.subject_taxon_id
+      AND im.evalue_exp = low_exp.evalue_exp
+    GROUP BY im.query_id, im.subject_taxon_id, low_exp.evalue_exp''',
+    'CREATE INDEX temp.qtscore_ix ON BestQueryTaxonScore (query_id, subject_taxon_id, evalue_exp, evalue_mant)',
+    '''CREATE TEMP TABLE BestHit AS
+    SELECT s.query_id, s.subject_id, s.query_taxon_id, s.subject_taxon_id, s.evalue_exp, s.evalue_mant
+    FROM SimilarSequences s, BestQueryTaxonScore cutoff
+    WHERE s.query_id = cutoff.query_id AND s.subject_taxon_id = cutoff.subject_taxon_id
+      AND s.query_taxon_id != s.subject_taxon_id
+      AND s.evalue_exp <= {evalue_exponent} AND s.percent_match >= {percent_match}
+      AND (s.evalue_mant < 0.01 OR s.evalue_exp = cutoff.evalue_exp AND s.evalue_mant = cutoff.evalue_mant)''',
+    'CREATE INDEX temp.best_hit_ix ON BestHit (query_id, subject_id)',
+    '''CREATE TEMP TABLE OrthologTemp AS
+    SELECT bh1.query_id AS sequence_id_a, bh1.subject_id AS sequence_id_b,
+           bh1.query_taxon_id AS taxon_id_a, bh1.subject_taxon_id AS taxon_id_b,
+           ''' + _SCORE.format('bh1', 'bh2', 0.01) + ''' AS unnormalized_score
+    FROM BestHit bh1, BestHit bh2
+    WHERE bh1.query_id < bh1.subject_id AND bh1.query_id = bh2.subject_id AND bh1.subject_id = bh2.query_id''',
+    '''CREATE TEMP TABLE OrthologAvgScore AS
+    SELECT min(taxon_id_a, taxon_id_b) AS smaller_tax_id, max(taxon_id_a, taxon_id_b) AS bigger_tax_id,
+           avg(unnormalized_score) AS avg_score
+    FROM OrthologTemp GROUP BY smaller_tax_id, bigger_tax_id''',
+    '''INSERT INTO Ortholog
+    SELECT ot.sequence_id_a, ot.sequence_id_b, ot.taxon_id_a, ot.taxon_id_b, ot.unnormalized_score,
+           ot.unnormalized_score / a.avg_score
+    FROM OrthologTemp ot, OrthologAvgScore a
+    WHERE min(ot.taxon_id_a, ot.taxon_id_b) = a.smaller_tax_id
+      AND max(ot.taxon_id_a, ot.taxon_id_b) = a.bigger_tax_id''',
+
+    # InParalogs: mutual hits within a taxon that are better than the best hit in any other taxon
+    '''CREATE TEMP TABLE BestInterTaxonScore AS
+    SELECT bqts.query_id, low_exp.evalue_exp, min(bqts.evalue_mant) AS evalue_mant
+    FROM BestQueryTaxonScore bqts,
+         (SELECT query_id, min(evalue_exp) AS evalue_exp FROM BestQueryTaxonScore GROUP BY query_id) low_exp
+    WHERE bqts.query_id = low_exp.query_id AND bqts.evalue_exp = low_exp.evalue_exp
+    GROUP BY bqts.query_id, low_exp.evalue_exp''',
+    'CREATE UNIQUE INDEX temp.bis_uids_ix ON BestInterTaxonScore (query_id)',
+    '''CREATE TEMP TABLE BetterHit AS
+    SELECT s.query_id, s.subject_id, s.query_taxon_id AS taxon_id, s.evalue_exp, s.evalue_mant
+    FROM SimilarSequences s, BestInterTaxonScore bis
+    WHERE s.query_id != s.subject_id AND s.query_taxon_id = s.subject_taxon_id AND s.query_id = bis.query_id
+      AND s.evalue_exp <= {evalue_exponent} AND s.percent_match >= {percent_match}
+      AND (s.evalue_mant < 0.001 OR s.evalue_exp < bis.evalue_exp
+           OR (s.evalue_exp = bis.evalue_exp AND s.evalue_mant <= bis.evalue_mant))
+    UNION
+    SELECT s.query_id, s.subject_id, s.query_taxon_id AS taxon_id, s.evalue_exp, s.evalue_mant
+    FROM SimilarSequences s
+    WHERE s.query_id != s.subject_id AND s.query_taxon_id = s.subject_taxon_id
+      AND s.evalue_exp <= {evalue_exponent} AND s.percent_match >= {percent_match}
+      AND s.query_id NOT IN (SELECT query_id FROM BestInterTaxonScore)''',
+    'CREATE INDEX temp.better_hit_ix ON BetterHit (query_id, subject_id)',
+    '''CREATE TEMP TABLE InParalogTemp AS
+    SELECT bh1.query_id AS sequence_id_a, bh1.subject_id AS sequence_id_b, bh1.taxon_id,
+           ''' + _SCORE.format('bh1', 'bh2', 0.01) + ''' AS unnormalized_score
+    FROM BetterHit bh1, BetterHit bh2
+    WHERE bh1.query_id < bh1.subject_id AND bh1.query_id = bh2.subject_id AND bh1.subject_id = bh2.query_id''',
+    '''CREATE TEMP TABLE OrthologUniqueId AS
+    SELECT sequence_id_a AS sequence_id FROM Ortholog UNION SELECT sequence_id_b FROM Ortholog''',
+    'CREATE UNIQUE INDEX temp.ortholog_unique_id_ix ON OrthologUniqueId (sequence_id)',
+    # Normalize by the average score of inparalogs with an ortholog in the same taxon, or else of all inparalogs
+    '''CREATE TEMP TABLE InParalogAvgScore AS
+    SELECT taxon_id, avg(unnormalized_score) AS avg_score FROM InParalogTemp
+    WHERE sequence_id_a IN (SELECT sequence_id FROM OrthologUniqueId)
+       OR sequence_id_b IN (SELECT sequence_id FROM OrthologUniqueId)
+    GROUP BY taxon_id''',
+    '''INSERT INTO InParalogAvgScore
+    SELECT taxon_id, avg(unnormalized_score) FROM InParalogTemp
+    WHERE taxon_id NOT IN (SELECT taxon_id FROM InParalogAvgScore)
+    GROUP BY taxon_id''',
+    '''INSERT INTO InParalog
+    SELECT it.sequence_id_a, it.sequence_id_b, it.taxon_id, it.unnormalized_score, it.unnormalized_score / a.avg_score
+    FROM InParalogTemp it, InParalogAvgScore a
+    WHERE it.taxon_id = a.taxon_id''',
+
+    # CoOrthologs: pairs linked through inparalogs and orthologs that are mutual hits, but not orthologs themselves
+    '''CREATE TEMP TABLE InParalog2Way AS
+    SELECT sequence_id_a, sequence_id_b FROM InParalog
+    UNION SELECT sequence_id_b, sequence_id_a FROM InParalog''',
+    'CREATE INDEX temp.inparalog2way_ix ON InParalog2Way (sequence_id_b, sequence_id_a)',
+    '''CREATE TEMP TABLE Ortholog2Way AS
+    SELECT sequence_id_a, sequence_id_b FROM Ortholog
+    UNION SELECT sequence_id_b, sequence_id_a FROM Ortholog''',
+    'CREATE INDEX temp.ortholog2way_ix ON Ortholog2Way (sequence_id_a, sequence_id_b)',
+    '''CREATE TEMP TABLE CoOrthologCandidate AS
+    SELECT DISTINCT min(sequence_id_a, sequence_id_b) AS sequence_id_a,
+           max(sequence_id_a, sequence_id_b) AS sequence_id_b
+    FROM (SELECT ip1.sequence_id_a, ip2.sequence_id_b
+          FROM InParalog2Way ip1, Ortholog2Way o, InParalog2Way ip2
+          WHERE ip1.sequence_id_b = o.sequence_id_a AND o.sequence_id_b = ip2.sequence_id_a
+          UNION
+          SELECT ip.sequence_id_a, o.sequence_id_b
+          FROM InParalog2Way ip, Ortholog2Way o
+          WHERE ip.sequence_id_b = o.sequence_id_a)''',
+    '''CREATE TEMP TABLE CoOrthNotOrtholog AS
+    SELECT cc.sequence_id_a, cc.sequence_id_b
+    FROM CoOrthologCandidate cc LEFT OUTER JOIN Ortholog o
+      ON cc.sequence_id_a = o.sequence_id_a AND cc.sequence_id_b = o.sequence_id_b
+    WHERE o.sequence_id_a IS NULL''',
+    '''CREATE TEMP TABLE CoOrthologTemp AS
+    SELECT candidate.sequence_id_a, candidate.sequence_id_b,
+           ab.query_taxon_id AS taxon_id_a, ab.subject_taxon_id AS taxon_id_b,
+           ''' + _SCORE.format('ab', 'ba', 0.00001) + ''' AS unnormalized_score
+    FROM SimilarSequences ab, CoOrthNotOrtholog candidate, SimilarSequences ba
+    WHERE ab.evalue_exp <= {evalue_exponent} AND ab.percent_match >= {percent_match}
+      AND ba.evalue_exp <= {evalue_exponent} AND ba.percent_match >= {percent_match}
+      AND candidate.sequence_id_a = ab.query_id AND candidate.sequence_id_b = ab.subject_id
+      AND candidate.sequence_id_b = ba.query_id AND candidate.sequence_id_a = ba.subject_id''',
+    '''CREATE TEMP TABLE CoOrthologAvgScore AS
+    SELECT min(taxon_id_a, taxon_id_b) AS smaller_tax_id, max(taxon_id_a, taxon_id_b) AS bigger_tax_id,
+           avg(unnormalized_score) AS avg_score
+    FROM CoOrthologTemp GROUP BY smaller_tax_id, bigger_tax_id''',
+    '''INSERT INTO CoOrtholog
+    SELECT ct.sequence_id_a, ct.sequence_id_b, ct.taxon_id_a, ct.taxon_id_b, ct.unnormalized_score,
+           ct.unnormalized_score / a.avg_score
+    FROM CoOrthologTemp ct, CoOrthologAvgScore a
+    WHERE min(ct.taxon_id_a, ct.taxon_id_b) = a.smaller_tax_id
+      AND max(ct.taxon_id_a, ct.taxon_id_b) = a.bigger_tax_id''']
+
+
+def open_sqlite_database(database_file):
+    """Return connection to SQLite database in database_file, with the log10 function used in finding pairs."""
+    connection = sqlite3.connect(database_file)
+    connection.text_factory = str
+    connection.create_function('log10', 1, math.log10)
+    # The database only lives as long as the run directory, so trade durability for speed
+    connection.execute('PRAGMA journal_mode = OFF')
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.execute('PRAGMA temp_store = FILE')
+    return connection
+
+
+def create_sqlite_database(database_file=':memory:'):
+    """Create SQLite database in database_file, or in memory by default, and install the OrthoMCL schema in it.
+    Return the open connection, which holds the only copy of the data for in memory databases."""
+    if database_file != ':memory:' and os.path.exists(database_file):
+        os.remove(database_file)
+    connection = open_sqlite_database(database_file)
+    for statement in SCHEMA:
+        connection.execute(statement)
+    connection.commit()
+    log.info('Created SQLite OrthoMCL database in %s', database_file)
+    return connection
+
+
+def load_similar_sequences(connection, similar_seqs_file):
+    """Bulk insert the tab separated similar sequences rows into SimilarSequences, and only then create the indexes."""
+    start = time.time()
+    rows = 0
+    with open(similar_seqs_file) as read_handle:
+        lines = (line.rstrip('\n').split('\t') for line in read_handle)
+        while True:
+            chunk = list(islice(lines, INSERT_CHUNK_SIZE))
+            if not chunk:
+                break
+            connection.executemany('INSERT INTO SimilarSequences VALUES (?, ?, ?, ?, ?, ?, ?, ?)', chunk)
+            rows += len(chunk)
+    for statement in INDEXES:
+        connection.execute(statement)
+    connection.commit()
+    log.info('Loaded %i similar sequences into SQLite in %.1f seconds', rows, time.time() - start)
+
+
+def find_pairs(connection, evalue_exponent, percent_match=PERCENT_MATCH_CUTOFF):
+    """Populate the Ortholog, InParalog and CoOrtholog tables from SimilarSequences, as orthomclPairs would."""
+    start = time.time()
+    # Remove any pairs found before, so pairs can be found again in a database that was loaded in an earlier run
+    for table in ('Ortholog', 'InParalog', 'CoOrtholog'):
+        connection.execute('DELETE FROM ' + table)
+    for statement in PAIRS_SQL:
+        connection.execute(statement.format(evalue_exponent=int(evalue_exponent), percent_match=percent_match))
+    connection.commit()
+    counts = [connection.execute('SELECT count(*) FROM ' + table).fetchone()[0]
+              for table in ('Ortholog', 'InParalog', 'CoOrtholog')]
+    log.info('Found %i orthologs, %i inparalogs and %i coorthologs in %.1f seconds', *(counts + [time.time() - start]))
+
+
+def dump_pairs_files(run_dir, connection):
+    """Write the mclInput and pairs files as orthomclDumpPairsFiles would from the populated pairs tables."""
+    tables = [connection.execute('SELECT sequence_id_a, sequence_id_b, normalized_score FROM ' + table)
+              for table in ('Ortholog', 'InParalog', 'CoOrtholog')]
+    return write_pairs_files(run_dir, *tables)
+
+
+def _format_score(score):
+    """Round score to three decimals and format it the way Perl prints numbers."""
+    return '%.15g' % (int(score * 1000 + .5) / 1000.)
+
+
+def write_pairs_files(run_dir, orthologs, inparalogs, coorthologs):
+    """Write mclInput and the potential orthologs, inparalogs & coorthologs files to the same paths in run_dir as used
+    for the output of orthomclDumpPairsFiles. Each of the pairs is a (sequence_id_a, sequence_id_b, normalized score)
+    tuple. Return paths to mclInput and the three pairs files."""
+    out_dir = create_directory('orthologs', inside_dir=run_dir)
+    mcl_dir = create_directory('mcl', inside_dir=run_dir)
+    mclinput = os.path.join(mcl_dir, 'mclInput.tsv')
+    pairs_files = [os.path.join(out_dir, 'potentialOrthologs.tsv'),
+                   os.path.join(out_dir, 'potentialInparalogs.tsv'),
+                   os.path.join(out_dir, 'potentialCoorthologs.tsv')]
+
+    with open(mclinput, mode='w') as mcl_handle:
+        for pairs, pairs_file in zip((orthologs, inparalogs, coorthologs), pairs_files):
+            with open(pairs_file, mode='w') as pairs_handle:
+                for sequence_id_a, sequence_id_b, score in pairs:
+                    line = '{0}\t{1}\t{2}\n'.format(sequence_id_a, sequence_id_b, _format_score(score))
+                    pairs_handle.write(line)
+                    mcl_handle.write(line)
+
+    #Assert mcl input file exists and has some content
+    assert os.path.isfile(mclinput) and 0 < os.path.getsize(mclinput), mclinput + ' should exist and have some content'
+    return [mclinput] + pairs_files
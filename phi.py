@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""Module to test for recombination through the pairwise homoplasy index (Phi), Max Chi^2 and the neighbour similarity
+score (NSS) as also reported by PhiPack, but calculated in process using NumPy."""
+
+from __future__ import division
+from Bio import SeqIO
+import numpy as np
+
+__author__ = "Tim te Beek"
+__contact__ = "brs@nbic.nl"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Same defaults as PhiPack: 1000 permutations, and Phi over pairs of informative sites at most 100 sites apart
+PERMUTATIONS = 1000
+WINDOW = 100
+
+# Minimum number of informative sites needed to test for recombination at all
+MIN_INFORMATIVE_SITES = 3
+
+# Width and step in alignment positions of the windows for which Phi is reported when scanning along an alignment
+SCAN_WINDOW = 300
+SCAN_STEP = 30
+
+# Maximum number of values held in the intermediate arrays of a single chunk or batch of permutations
+BATCH_VALUES = 2 ** 22
+
+# Map nucleotides to states 0 through 3, and gaps and ambiguous characters to missing data
+_STATES = np.full(256, -1, dtype=np.int8)
+for _index, _nucleotides in enumerate(('Aa', 'Cc', 'Gg', 'Tt')):
+    for _nucleotide in _nucleotides:
+        _STATES[ord(_nucleotide)] = _index
+
+
+def read_alignment(dna_file):
+    """Return aligned sequences in FASTA dna_file as matrix of states per sequence and site, -1 for missing data."""
+    sequences = [str(seqr.seq) for seqr in SeqIO.parse(dna_file, 'fasta')]
+    characters = np.frombuffer(''.join(sequences), dtype=np.uint8).reshape(len(sequences), -1)
+    return _STATES[characters]
+
+
+def informative_sites(states):
+    """Return the columns of states that are parsimony informative: with at least two states occurring twice or more."""
+    return states[:, _informative_mask(states)]
+
+
+def _informative_mask(states):
+    """Return boolean mask over the columns of states that are parsimony informative."""
+    counts = (states[:, :, None] == np.arange(4)).sum(axis=0)
+    return (2 <= counts).sum(axis=1) >= 2
+
+
+def incompatibility_matrix(sites):
+    """Return matrix of refined incompatibility scores between all pairs of columns in sites.
+
+    The refined incompatibility of two sites is the minimum number of homoplasies needed to explain their combined
+    states on any tree: the number of edges minus nodes plus connected components of the graph connecting the states
+    of either site that occur together in any sequence. Sequences with missing data at either site are ignored."""
+    nr_seqs, nr_sites = sites.shape
+    if not nr_sites:
+        return np.zeros((0, 0), dtype=np.int32)
+    onehot = (sites[:, :, None] == np.arange(4)).reshape(nr_seqs, nr_sites * 4).astype(np.float32)
+    cooccurrence = np.dot(onehot.T, onehot).reshape(nr_sites, 4, nr_sites, 4)
+
+    # Nodes 0-3 are the states of the first site, nodes 4-7 those of the second site
+    lower = np.tril(np.ones((8, 8), dtype=bool), -1)
+    matrix = np.empty((nr_sites, nr_sites), dtype=np.int32)
+    chunk = max(1, BATCH_VALUES // (64 * nr_sites))
+    for start in range(0, nr_sites, chunk):
+        edges = 0 < cooccurrence[start:start + chunk].transpose(0, 2, 1, 3)
+        nodes = np.concatenate((edges.any(axis=3), edges.any(axis=2)), axis=2)
+
+        # Find nodes reachable from each node by repeatedly squaring the adjacency matrix, as paths span at most 8 nodes
+        reach = np.zeros(edges.shape[:2] + (8, 8), dtype=np.uint8)
+        reach[..., :4, 4:] = edges
+        reach[..., 4:, :4] = edges.swapaxes(2, 3)
+        reach[..., range(8), range(8)] = 1
+        for _ in range(3):
+            reach = (0 < np.matmul(reach, reach)).astype(np.uint8)
+
+        # Count each component once, by the node with the lowest index among the nodes present in that component
+        firsts = nodes & ~(reach.astype(bool) & lower & nodes[:, :, None, :]).any(axis=3)
+        matrix[start:start + chunk] = edges.sum(axis=(2, 3)) - nodes.sum(axis=2) + firsts.sum(axis=2)
+    return matrix
+
+
+def phi_statistic(incompatibility, orders, window=WINDOW):
+    """Return Phi for each of the site orders: mean incompatibility over pairs of sites at most window sites apart."""
+    nr_sites = incompatibility.shape[0]
+    total = np.zeros(len(orders))
+    pairs = 0
+    for distance in range(1, min(window, nr_sites - 1) + 1):
+        total += incompatibility[orders[:, :-distance], orders[:, distance:]].sum(axis=1)
+        pairs += nr_sites - distance
+    return total / pairs
+
+
+def nss_statistic(incompatibility, orders):
+    """Return the neighbour similarity score for each of the site orders: the fraction of adjacent compatible sites."""
+    return (incompatibility[orders[:, :-1], orders[:, 1:]] == 0).mean(axis=1)
+
+
+def pairwise_differences(sites):
+    """Return for each pair of distinct sequences whether they differ at each of the sites, ignoring missing data."""
+    unique = np.unique(sites, axis=0) if len(sites) else sites
+    first, second = np.triu_indices(len(unique), 1)
+    return (unique[first] != unique[second]) & (0 <= unique[first]) & (0 <= unique[second])
+
+
+def max_chi2_statistic(differences, orders):
+    """Return the maximum chi-squared value over all pairs of sequences and breakpoints for each of the site orders,
+    comparing the number of differences before and after each breakpoint between sites."""
+    nr_sites = differences.shape[1]
+    if not len(differences):
+        return np.zeros(len(orders))
+    # For each pair of sequences and breakpoint: differences before the breakpoint, and the total number of differences
+    before = np.cumsum(differences[:, orders], axis=2)[:, :, :-1]
+    total = differences.sum(axis=1)[:, None, None]
+    left = np.arange(1, nr_sites)
+    right = nr_sites - left
+
+    # Chi-squared for the 2x2 table of sites before and after the breakpoint against sites that differ or match
+    denominator = left * right * total * (nr_sites - total)
+    numerator = nr_sites * (before * nr_sites - left * total) ** 2.
+    chi2 = np.where(0 < denominator, numerator / np.maximum(denominator, 1), 0)
+    return chi2.max(axis=(0, 2))
+
+
+def phi_test(dna_file, permutations=PERMUTATIONS, window=WINDOW, seed=None):
+    """Test for recombination in the aligned sequences of dna_file, returning the number of informative sites and the
+    permutation p-values of Phi, Max Chi^2 and NSS, under the same keys as run_phipack."""
+    return phi_test_states(read_alignment(dna_file), permutations, window, seed)
+
+
+def phi_test_states(states, permutations=PERMUTATIONS, window=WINDOW, seed=None):
+    """Test for recombination in the alignment already read into states, as phi_test does for an alignment file."""
+    sites = informative_sites(states)
+    nr_sites = sites.shape[1]
+    if nr_sites < MIN_INFORMATIVE_SITES:
+        return {'PhiPack sites': nr_sites, 'Phi': None, 'Max Chi^2': None, 'NSS': None}
+
+    incompatibility = incompatibility_matrix(sites)
+    differences = pairwise_differences(sites)
+
+    # Observed values for the sites in alignment order
+    identity = np.arange(nr_sites)[None]
+    observed_phi = phi_statistic(incompatibility, identity, window)[0]
+    observed_chi2 = max_chi2_statistic(differences, identity)[0]
+    observed_nss = nss_statistic(incompatibility, identity)[0]
+
+    # Recombination makes nearby sites more compatible than distant sites: Phi goes down, while Max Chi^2 and NSS go up
+    random_state = np.random.RandomState(seed)
+    lower_phi = higher_chi2 = higher_nss = 0
+    batch_size = max(1, BATCH_VALUES // max(differences.size, nr_sites))
+    for start in range(0, permutations, batch_size):
+        shape = (min(batch_size, permutations - start), nr_sites)
+        orders = np.argsort(random_state.random_sample(shape), axis=1)
+        lower_phi += (phi_statistic(incompatibility, orders, window) <= observed_phi).sum()
+        higher_chi2 += (observed_chi2 <= max_chi2_statistic(differences, orders)).sum()
+        higher_nss += (observed_nss <= nss_statistic(incompatibility, orders)).sum()
+
+    return {'PhiPack sites': nr_sites,
+            'Phi': lower_phi / permutations,
+            'Max Chi^2': higher_chi2 / permutations,
+            'NSS': higher_nss / permutations}
+
+
+def phi_profile(states, scan_window=SCAN_WINDOW, step=SCAN_STEP, window=WINDOW):
+    """Return start, end, number of informative sites and Phi for windows of scan_window alignment positions every step
+    positions along the alignment in states. Phi per window is taken from a single incompatibility matrix, as the mean
+    incompatibility over pairs of informative sites within the window that are at most window sites apart."""
+    length = states.shape[1]
+    starts = np.arange(0, max(length - scan_window, 0) + 1, step)
+    ends = np.minimum(starts + scan_window, length)
+    mask = _informative_mask(states)
+    positions = np.flatnonzero(mask)
+    if not len(positions):
+        # Conserved alignments have no informative sites in any window, and thus no Phi
+        return [(start, end, 0, None) for start, end in zip(starts, ends)]
+    incompatibility = incompatibility_matrix(states[:, mask])
+
+    # Sum incompatibility and count pairs within any block of consecutive informative sites through 2D prefix sums
+    distances = np.subtract.outer(np.arange(len(positions)), np.arange(len(positions)))
+    band = (distances < 0) & (-window <= distances)
+    sums = _prefix_sums(np.where(band, incompatibility, 0))
+    pairs = _prefix_sums(band)
+
+    lows = np.searchsorted(positions, starts)
+    highs = np.searchsorted(positions, ends)
+    window_sums = sums[highs, highs] - sums[lows, highs] - sums[highs, lows] + sums[lows, lows]
+    window_pairs = pairs[highs, highs] - pairs[lows, highs] - pairs[highs, lows] + pairs[lows, lows]
+    return [(start, end, high - low, window_sum / window_pair if window_pair else None)
+            for start, end, low, high, window_sum, window_pair
+            in zip(starts, ends, lows, highs, window_sums, window_pairs)]
+
+
+def _prefix_sums(matrix):
+    """Return sums over all preceding rows and columns of matrix, with an additional leading zero row and column."""
+    sums = np.zeros((matrix.shape[0] + 1, matrix.shape[1] + 1), dtype=np.int64)
+    sums[1:, 1:] = matrix.cumsum(axis=0).cumsum(axis=1)
+    return sums
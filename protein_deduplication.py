@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Module to deduplicate identical proteins across proteomes ahead of the all-vs-all BLAST, so only one representative
+of each set of identical proteins is searched, and to expand the hits of representatives back to all their members."""
+
+from __future__ import division
+from itertools import groupby
+import hashlib
+import logging as log
+import os
+
+__author__ = "Tim te Beek"
+__contact__ = "brs@nbic.nl"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+
+def _record(record_lines):
+    """Return protein id, definition and sequence lines, and sequence of the record in record_lines."""
+    return record_lines[0][1:].split()[0], record_lines, ''.join(line.strip() for line in record_lines[1:])
+
+
+def _read_records(fasta_file):
+    """Yield protein id, definition and sequence lines, and sequence of each record in compliant fasta_file."""
+    record_lines = []
+    with open(fasta_file) as read_handle:
+        for line in read_handle:
+            line = line.rstrip('\n') + '\n'
+            if line.startswith('>') and record_lines:
+                yield _record(record_lines)
+                record_lines = []
+            record_lines.append(line)
+    if record_lines:
+        yield _record(record_lines)
+
+
+def deduplicate_proteins(good_proteins_file, fasta_files, out_dir):
+    """Write the first protein of each set of identical proteins across the compliant fasta_files to a fasta file per
+    proteome in out_dir, and the representatives among good proteins to out_dir/goodProteins.fasta. Identical proteins
+    are either all good or all poor, as filtering only depends on sequence. Write a report of the search space saved to
+    out_dir/deduplication.tsv.
+
+    Return the representative good proteins file, the non-empty representative fasta files, a dictionary mapping
+    representatives of identical proteins to all members including the representative itself, and the number of
+    residues in all good proteins, to keep Expect values the same as when searching all good proteins."""
+    representatives = {}
+    members = {}
+    proteins = query_residues = unique_query_residues = 0
+    unique_fasta_files = []
+    for fasta_file in fasta_files:
+        unique_fasta_file = os.path.join(out_dir, os.path.basename(fasta_file))
+        with open(unique_fasta_file, mode='w') as write_handle:
+            for protein_id, record_lines, sequence in _read_records(fasta_file):
+                proteins += 1
+                query_residues += len(sequence)
+                digest = hashlib.sha1(sequence).digest()
+                representative = representatives.setdefault(digest, protein_id)
+                if representative == protein_id:
+                    unique_query_residues += len(sequence)
+                    write_handle.writelines(record_lines)
+                else:
+                    members.setdefault(representative, [representative]).append(protein_id)
+        if os.path.getsize(unique_fasta_file):
+            unique_fasta_files.append(unique_fasta_file)
+    representatives = set(representatives.itervalues())
+
+    unique_good_file = os.path.join(out_dir, 'goodProteins.fasta')
+    good_proteins = database_residues = unique_database_residues = 0
+    with open(unique_good_file, mode='w') as write_handle:
+        for protein_id, record_lines, sequence in _read_records(good_proteins_file):
+            good_proteins += 1
+            database_residues += len(sequence)
+            if protein_id in representatives:
+                unique_database_residues += len(sequence)
+                write_handle.writelines(record_lines)
+
+    # Report the number of proteins and residues searched, and the fraction of the search space saved
+    search_space = query_residues * database_residues
+    unique_search_space = unique_query_residues * unique_database_residues
+    saved = 1 - unique_search_space / search_space if search_space else 0
+    report = [('proteins', proteins),
+              ('unique_proteins', len(representatives)),
+              ('identical_sets', len(members)),
+              ('good_proteins', good_proteins),
+              ('query_residues', query_residues),
+              ('unique_query_residues', unique_query_residues),
+              ('database_residues', database_residues),
+              ('unique_database_residues', unique_database_residues),
+              ('search_space', search_space),
+              ('unique_search_space', unique_search_space),
+              ('percent_saved', '{0:.1f}'.format(saved * 100))]
+    with open(os.path.join(out_dir, 'deduplication.tsv'), mode='w') as write_handle:
+        for key, value in report:
+            write_handle.write('{0}\t{1}\n'.format(key, value))
+    log.info('Deduplicated %i proteins into %i unique proteins, saving %.1f%% of the all-vs-all search space',
+             proteins, len(representatives), saved * 100)
+    return unique_good_file, unique_fasta_files, members, database_residues
+
+
+def expand_hits(hits_file, members, expanded_file):
+    """Write each hit in BLAST m8 format hits_file to expanded_file once for each combination of the members of its
+    query and subject representatives. Hits stay grouped by query, and HSPs stay grouped by query and subject."""
+    hits = 0
+    with open(hits_file) as read_handle:
+        with open(expanded_file, mode='w') as write_handle:
+            for query_id, query_lines in groupby(read_handle, key=lambda line: line.split('\t', 1)[0]):
+                query_lines = [line.split('\t', 2) for line in query_lines if line.strip()]
+                for query_member in members.get(query_id, (query_id,)):
+                    for subject_id, subject_lines in groupby(query_lines, key=lambda fields: fields[1]):
+                        subject_lines = list(subject_lines)
+                        for subject_member in members.get(subject_id, (subject_id,)):
+                            hits += len(subject_lines)
+                            write_handle.writelines('\t'.join((query_member, subject_member, fields[2]))
+                                                    for fields in subject_lines)
+    log.info('Expanded hits of representatives into %i hits between all identical proteins', hits)
+    return expanded_file
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Module to find orthologs between two genomes as reciprocal best BLAST hits, directly from the all-vs-all BLAST hits
+in memory, as a fast alternative to finding pairs in a database and clustering those with MCL."""
+
+from divergence.orthomcl_blast_parser import read_protein_lengths, _evalue_key, _parse_hits
+from divergence.orthomcl_database import PERCENT_MATCH_CUTOFF
+import logging as log
+import time
+
+__author__ = "Tim te Beek"
+__contact__ = "brs@nbic.nl"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+
+def best_hits(rows, evalue_exponent, percent_match=PERCENT_MATCH_CUTOFF):
+    """Return dictionary mapping each query in similar sequences rows to the set of its inter-taxon subjects with the
+    lowest evalue, considering only rows that pass both the evalue_exponent and percent_match cutoffs. Subjects tied
+    for the lowest evalue are all best hits, as in orthomclPairs."""
+    best = {}
+    for row in rows:
+        fields = row.split('\t')
+        key = _evalue_key(fields)
+        if fields[2] == fields[3] or evalue_exponent < key[0] or float(fields[7]) < percent_match:
+            continue
+        query_key, subjects = best.get(fields[0], (None, None))
+        if query_key is None or key < query_key:
+            best[fields[0]] = key, set([fields[1]])
+        elif key == query_key:
+            subjects.add(fields[1])
+    return dict((query, subjects) for query, (_, subjects) in best.iteritems())
+
+
+def reciprocal_best_hit_groups(best):
+    """Return groups of proteins connected through reciprocal best hits in best, as sorted lists of protein ids.
+    Without ties each group holds a single pair of orthologs, while ties join all reciprocal best hits involved into one
+    group."""
+    neighbours = {}
+    for query, subjects in best.iteritems():
+        for subject in subjects:
+            if query in best.get(subject, ()):
+                neighbours.setdefault(query, set()).add(subject)
+
+    groups = []
+    seen = set()
+    for protein in sorted(neighbours):
+        if protein in seen:
+            continue
+        group = []
+        stack = [protein]
+        seen.add(protein)
+        while stack:
+            member = stack.pop()
+            group.append(member)
+            for neighbour in neighbours[member] - seen:
+                seen.add(neighbour)
+                stack.append(neighbour)
+        groups.append(sorted(group))
+    return groups
+
+
+def find_reciprocal_best_hits(blast_file, fasta_files_dir, groups_file, evalue_exponent,
+                              percent_match=PERCENT_MATCH_CUTOFF):
+    """Write groups of reciprocal best hits between the genomes in BLAST m8 format blast_file to groups_file, in the
+    same format as the groups.txt file produced by MCL, with lengths and taxa of proteins read from the compliant fasta
+    files in fasta_files_dir. Hits only count when their evalue exponent is at most evalue_exponent, and their HSPs
+    cover at least percent_match percent of the shorter protein."""
+    start = time.time()
+    proteins = read_protein_lengths(fasta_files_dir)
+    taxa = set(taxon for taxon, _ in proteins.itervalues())
+    assert len(taxa) == 2, 'Reciprocal best hits require exactly two genomes, but found {0}'.format(len(taxa))
+
+    counts = [0]
+    with open(blast_file) as read_handle:
+        best = best_hits(_parse_hits(proteins, read_handle, counts), int(evalue_exponent), percent_match)
+    groups = reciprocal_best_hit_groups(best)
+
+    with open(groups_file, mode='w') as write_handle:
+        for group in sorted(groups, key=len, reverse=True):
+            write_handle.write('\t'.join(group) + '\n')
+    log.info('Found %i groups of reciprocal best hits among %i similar sequences, of which %i joined by ties, in %.1f '
+             'seconds', len(groups), counts[0], sum(1 for group in groups if 2 < len(group)), time.time() - start)
+    return groups_file
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 """Module for the reciprocal blast step."""
 
+from __future__ import division
 from divergence import create_directory, concatenate
 from divergence.versions import MAKEBLASTDB, BLASTN, BLASTP
+from multiprocessing.pool import ThreadPool
 from subprocess import check_call, STDOUT
 import logging as log
+import multiprocessing
 import os
 import tempfile
 import shutil
@@ -15,15 +18,18 @@ __copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
 __license__ = "MIT"
 
 
-def reciprocal_blast(good_proteins_fasta, fasta_files):
-    """Create blast database for good_proteins_fasta, blast all fasta_files against this database & return hits."""
+def reciprocal_blast(good_proteins_fasta, fasta_files, dbsize=None, cores=None):
+    """Create blast database for good_proteins_fasta, blast all fasta_files against this database & return hits.
+    dbsize - effective length of the database to compute Expect values with, instead of the actual database length
+    cores - number of cores to divide over concurrent searches, defaults to all available cores"""
     run_dir = tempfile.mkdtemp(prefix='reciprocal_blast_')
 
     # Create blast database, retrieve path & name
     db_dir, db_name = _create_blast_database(run_dir, good_proteins_fasta)
 
     # Blast individual fasta files against the made blast databank, instead of the much larger good_proteins_fasta
-    x_vs_all_hits = [_blast_file_against_database(db_dir, db_name, fasta) for fasta in fasta_files]
+    x_vs_all_hits = _blast_files_against_databases([(db_dir, db_name, fasta, False) for fasta in fasta_files], cores,
+                                                   dbsize)
 
     # Concatenate the individual blast result files into one
     allvsall = tempfile.mkstemp(suffix='.tsv', prefix='all-vs-all_')[1]
@@ -35,6 +41,35 @@ def reciprocal_blast(good_proteins_fasta, fasta_files):
     return allvsall
 
 
+def incremental_blast(good_proteins_fasta, added_proteins_fasta, added_fasta_files, previous_fasta_files, dbsize,
+                      cores=None):
+    """Blast only added_fasta_files against all good_proteins_fasta, and previous_fasta_files against just the
+    added_proteins_fasta, returning the hits missing from the all-vs-all hits of an earlier run over the previous
+    proteomes. Expect values are computed against a fixed dbsize, so they match those of the earlier run with the same
+    dbsize regardless of the size of either database. All searches run concurrently, dividing cores among them."""
+    assert dbsize, 'Incremental blast requires a fixed database size, to keep Expect values comparable between runs'
+    run_dir = tempfile.mkdtemp(prefix='incremental_blast_')
+
+    # Create blast databases for all good proteins & for the good proteins of added proteomes only
+    all_db_dir, all_db_name = _create_blast_database(create_directory('all', inside_dir=run_dir), good_proteins_fasta)
+    added_db_dir, added_db_name = _create_blast_database(create_directory('added', inside_dir=run_dir),
+                                                         added_proteins_fasta)
+
+    # Blast new against all, and previous against new, as previous against previous was done in the earlier run
+    jobs = [(all_db_dir, all_db_name, fasta, False) for fasta in added_fasta_files]
+    jobs.extend((added_db_dir, added_db_name, fasta, True) for fasta in previous_fasta_files)
+    hits = _blast_files_against_databases(jobs, cores, dbsize)
+
+    # Concatenate the individual blast result files into one
+    added_hits = tempfile.mkstemp(suffix='.tsv', prefix='added-vs-all_')[1]
+    concatenate(added_hits, hits)
+
+    # Clean up
+    shutil.rmtree(run_dir)
+
+    return added_hits
+
+
 def _create_blast_database(run_dir, fasta_file, nucleotide=False):
     """Create blast database"""
     assert os.path.exists(MAKEBLASTDB) and os.access(MAKEBLASTDB, os.X_OK), 'Could not find or run ' + MAKEBLASTDB
@@ -53,8 +88,54 @@ def _create_blast_database(run_dir, fasta_file, nucleotide=False):
     return db_dir, db_name
 
 
-def _blast_file_against_database(db_dir, blast_db, fasta_file, nucleotide=False):
-    """Blast all genes from genomes one and two against all genomes"""
+def _allocate_threads(fasta_files, cores):
+    """Return the number of threads to blast each of fasta_files with, when searching them concurrently using cores.
+    With at least as many files as cores each search uses a single thread, while the number of searches running at once
+    is limited to cores. With fewer files all searches run at once, and the cores beyond one per search are divided in
+    proportion to the size of each file, so the largest proteomes do not hold up the run."""
+    if cores <= len(fasta_files):
+        return [1] * len(fasta_files)
+    sizes = [max(1, os.path.getsize(fasta_file)) for fasta_file in fasta_files]
+    shares = [(cores - len(fasta_files)) * size / sum(sizes) for size in sizes]
+    threads = [1 + int(share) for share in shares]
+
+    # Hand out the cores left after rounding down to the searches with the largest remainders
+    by_remainder = sorted(range(len(shares)), key=lambda index: shares[index] - int(shares[index]), reverse=True)
+    for index in by_remainder[:cores - sum(threads)]:
+        threads[index] += 1
+    return threads
+
+
+def _blast_files_against_databases(jobs, cores=None, dbsize=None):
+    """Blast each of jobs, as tuples of database directory, database name, fasta file and whether its hits may be empty,
+    concurrently using cores, with the largest fasta files first. Return the hits files in order of jobs."""
+    if not jobs:
+        return []
+    cores = cores or multiprocessing.cpu_count()
+    threads = _allocate_threads([fasta_file for _, _, fasta_file, _ in jobs], cores)
+
+    def blast_job(index):
+        """Blast the fasta file of job index against its database, using its allocated number of threads."""
+        db_dir, blast_db, fasta_file, allow_empty = jobs[index]
+        return _blast_file_against_database(db_dir, blast_db, fasta_file, dbsize=dbsize, allow_empty=allow_empty,
+                                            threads=threads[index])
+
+    # Searches run as separate processes, so threads suffice to run them concurrently
+    order = sorted(range(len(jobs)), key=lambda index: os.path.getsize(jobs[index][2]), reverse=True)
+    pool = ThreadPool(min(cores, len(jobs)))
+    try:
+        hits_files = dict(zip(order, pool.map(blast_job, order, chunksize=1)))
+    finally:
+        pool.close()
+    log.info('Blasted %i fasta files against their databases using %i cores', len(jobs), cores)
+    return [hits_files[index] for index in range(len(jobs))]
+
+
+def _blast_file_against_database(db_dir, blast_db, fasta_file, nucleotide=False, dbsize=None, allow_empty=False,
+                                 threads=None):
+    """Blast all genes from genomes one and two against all genomes, optionally with a fixed effective dbsize, using
+    threads. Hits are only allowed to be empty when blasting against part of the
+    genomes, as proteins always hit themselves."""
     blast_program = BLASTN if nucleotide else BLASTP
     assert os.path.exists(blast_program) and os.access(blast_program, os.X_OK), 'Could not find or run ' + blast_program
 
@@ -68,9 +149,14 @@ def _blast_file_against_database(db_dir, blast_db, fasta_file, nucleotide=False)
                '-query', fasta_file,
                '-outfmt', str(6),
                '-out', hits_file]
+    if dbsize:
+        command.extend(['-dbsize', str(dbsize)])
+    if threads:
+        command.extend(['-num_threads', str(threads)])
     log.info('Executing: %s', ' '.join(command))
     check_call(command, cwd=db_dir, stdout=open('/dev/null', mode='w'), stderr=STDOUT)
 
     #Sanity check
-    assert os.path.isfile(hits_file) and 0 < os.path.getsize(hits_file), hits_file + ' should exist with some content'
+    assert os.path.isfile(hits_file), hits_file + ' should exist'
+    assert allow_empty or 0 < os.path.getsize(hits_file), hits_file + ' should exist with some content'
     return hits_file
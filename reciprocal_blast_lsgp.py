@@ -15,13 +15,15 @@ __copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
 __license__ = "MIT"
 
 
-def reciprocal_blast(good_proteins_fasta, fasta_files):
-    """Create blast database for good_proteins_fasta, blast all fasta_files against this database & return hits."""
+def reciprocal_blast(good_proteins_fasta, fasta_files, dbsize=None):
+    """Create blast database for good_proteins_fasta, blast all fasta_files against this database & return hits.
+    dbsize - effective length of the database to compute Expect values with, instead of the actual database length"""
     # Create blast database, retrieve path & name
     database_url = _create_blast_database(good_proteins_fasta)
 
     # Submit job for each fasta files, and store jobid & hits file name tuples
-    jobids_and_hits_filenames = [_submit_blast_run(database_url, fasta_file) for fasta_file in fasta_files]
+    jobids_and_hits_filenames = [_submit_blast_run(database_url, fasta_file, dbsize=dbsize)
+                                 for fasta_file in fasta_files]
 
     # Retrieve all results, which should only take neglishably longer than waiting for the slowest results
     x_vs_all_hits = [_retrieve_blast_hits(jobid, hits_file) for jobid, hits_file in jobids_and_hits_filenames]
@@ -75,18 +77,21 @@ def blast_file_against_database(database_url, fasta_file, nucleotide=False):
     return outside_path
 
 
-def _submit_blast_run(database_url, fasta_file, nucleotide=False):
+def _submit_blast_run(database_url, fasta_file, nucleotide=False, dbsize=None):
     """
     Submit a BLAST run, returning the created jobid and filename for BLAST hits.
     @param database_url:
     @param fasta_file:
     @param nucleotide:
+    @param dbsize: optional fixed effective database length
     """
     blast_app = LSGP_BLASTN if nucleotide else LSGP_BLASTP
     # Determine output file name
     hits_file = os.path.splitext(os.path.split(fasta_file)[1])[0] + '-vs-all.tsv'
     # Run BLAST[P/N] remotely
     params = {'db[]': database_url, 'out': hits_file, 'outfmt': 6}
+    if dbsize:
+        params['dbsize'] = dbsize
     files = {'query': fasta_file}
     jobid = submit_application_run(blast_app,
                                    params=params,
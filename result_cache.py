@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Module to cache computed values on disk, keyed by a hash over the content the values were computed from."""
+
+from contextlib import closing
+from divergence import create_directory
+import hashlib
+import json
+import logging as log
+import os
+import sqlite3
+import time
+import zlib
+
+__author__ = "Tim te Beek"
+__contact__ = "brs@nbic.nl"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Maximum number of entries retained per cache, after which the least recently used entries are evicted
+MAX_ENTRIES = 250000
+
+# Seconds to wait for locks held by concurrent Galaxy jobs writing to the same cache
+LOCK_TIMEOUT = 300
+
+
+def content_hash(*parts):
+    """Return SHA1 hex digest over all string parts, each prefixed with its length so part boundaries are hashed too."""
+    sha1 = hashlib.sha1()
+    for part in parts:
+        sha1.update('{0}:'.format(len(part)))
+        sha1.update(part)
+    return sha1.hexdigest()
+
+
+class ResultCache(object):
+    """SQLite backed cache of JSON serializable values that can be shared between concurrent processes.
+
+    Every access opens a short lived connection and transaction, so no locks are held in between calls. Hit and miss
+    counters are kept in memory and only added to the persistent counters in flush(), which also evicts the least
+    recently used entries when the cache holds more than max_entries values."""
+
+    def __init__(self, name, max_entries=MAX_ENTRIES, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = create_directory('cache')
+        self.name = name
+        self.path = os.path.join(cache_dir, name + '.sqlite')
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        with closing(self._connect()) as connection:
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                                   '(key TEXT PRIMARY KEY, value BLOB NOT NULL, accessed REAL NOT NULL)')
+                connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed_ix ON entries (accessed)')
+                connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+
+    def _connect(self):
+        """Open connection that defers to explicit BEGIN IMMEDIATE statements for write transactions."""
+        connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+        connection.text_factory = str
+        return connection
+
+    def get(self, key):
+        """Return cached value for key, or None when no value was stored for key."""
+        with closing(self._connect()) as connection:
+            row = connection.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            with connection:
+                connection.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+        self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key, value):
+        """Store value for key, replacing any value previously stored by this or another process."""
+        blob = sqlite3.Binary(zlib.compress(json.dumps(value)))
+        with closing(self._connect()) as connection:
+            connection.isolation_level = None
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('INSERT OR REPLACE INTO entries (key, value, accessed) VALUES (?, ?, ?)',
+                               (key, blob, time.time()))
+            connection.execute('COMMIT')
+
+    def flush(self):
+        """Add hit and miss counters to the persistent counters, evict least recently used entries and log usage."""
+        with closing(self._connect()) as connection:
+            connection.isolation_level = None
+            connection.execute('BEGIN IMMEDIATE')
+            for counter, value in (('hits', self.hits), ('misses', self.misses)):
+                connection.execute('INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)', (counter,))
+                connection.execute('UPDATE counters SET value = value + ? WHERE name = ?', (value, counter))
+            # Remove all entries beyond the max_entries most recently accessed entries
+            evicted = connection.execute('DELETE FROM entries WHERE key IN '
+                                         '(SELECT key FROM entries ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                                         (self.max_entries,)).rowcount
+            connection.execute('COMMIT')
+            totals = dict(connection.execute('SELECT name, value FROM counters'))
+
+        log.info('%s cache: %i hits, %i misses (%i hits, %i misses in total), evicted %i entries', self.name,
+                 self.hits, self.misses, totals['hits'], totals['misses'], evicted)
+        self.hits = 0
+        self.misses = 0
+
+
+def get_cache(name, _caches={}):  # pylint: disable=W0102
+    """Return the ResultCache for name, creating it on first use within this process."""
+    if name not in _caches:
+        _caches[name] = ResultCache(name)
+    return _caches[name]
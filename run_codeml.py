@@ -1,16 +1,22 @@
 #!/usr/bin/env python
-"""Module to run Phylogenetic Analysis by Maximum Likelihood (codeml)."""
+"""Module to run Phylogenetic Analysis by Maximum Likelihood (codeml), or the faster yn00 from the same package."""
 
 from Bio import AlignIO
 from Bio.Align import MultipleSeqAlignment
 from Bio.Data import CodonTable
-from collections import deque
+from collections import Counter
 from divergence import create_directory, extract_archive_of_files, create_archive_of_files, parse_options, \
     CODON_TABLE_ID
-from divergence.versions import CODEML
-from subprocess import check_call, STDOUT
+from divergence.result_cache import get_cache, content_hash
+from divergence.versions import CODEML, YN00
+from functools import partial
+from itertools import chain, product
+from multiprocessing import Pool
+from subprocess import check_call, CalledProcessError, STDOUT
 import logging as log
 import os.path
+import random
+import re
 import shutil
 import sys
 import tempfile
@@ -20,17 +26,23 @@ __contact__ = "brs@nbic.nl"
 __copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
 __license__ = "MIT"
 
+# Programs from PAML to calculate pairwise divergence with: the maximum likelihood method of codeml, or the much faster
+# counting method of Yang & Nielsen (2000) in yn00, which trades a little accuracy for speed in large screens
+BACKENDS = {'codeml': CODEML, 'yn00': YN00}
 
-def run_codeml_for_sicos(codeml_dir, genome_ids_a, genome_ids_b, sico_files):
-    """Run codeml for representatives of clades A and B in each of the SICO files, to calculate dN/dS."""
+
+def run_codeml_for_sicos(codeml_dir, genome_ids_a, genome_ids_b, sico_files, batch_size=None, backend='codeml'):
+    """Run codeml for representatives of clades A and B in each of the SICO files, to calculate dN/dS.
+
+    When batch_size is given, codeml is run once per batch of batch_size SICOs instead of once per SICO. When backend
+    is 'yn00', yn00 is run instead of codeml."""
     log.info('Running codeml for {0} aligned and trimmed SICOs'.format(len(sico_files)))
 
     codeml_files = []
+    alignment_pairs = []
     for sico_file in sico_files:
         # Separate alignments for clade A & clade B genomes
-        ali = AlignIO.read(sico_file, 'fasta')
-        alignment_a = MultipleSeqAlignment(seqr for seqr in ali if seqr.id.split('|')[0] in genome_ids_a)
-        alignment_b = MultipleSeqAlignment(seqr for seqr in ali if seqr.id.split('|')[0] in genome_ids_b)
+        alignment_a, alignment_b = _split_alignment(sico_file, genome_ids_a, genome_ids_b)
 
         # Create sub directory for this run based on sico_file name
         filename = os.path.split(sico_file)[1]
@@ -38,52 +50,286 @@ def run_codeml_for_sicos(codeml_dir, genome_ids_a, genome_ids_b, sico_files):
         base_name = filename[:filename.find('.')]
         sub_dir = create_directory(base_name, inside_dir=codeml_dir)
 
-        # Submit for asynchronous calculation
-        codeml_file = run_codeml(sub_dir, alignment_a, alignment_b)
-        codeml_files.append(codeml_file)
+        # Collect alignments to run in batches, or run codeml for this SICO right away
+        if batch_size:
+            alignment_pairs.append((alignment_a, alignment_b))
+            codeml_files.append(os.path.join(sub_dir, base_name + '.codeml'))
+        else:
+            codeml_file = run_codeml(sub_dir, alignment_a, alignment_b, backend)
+            codeml_files.append(codeml_file)
+
+    # Write out the codeml output section for each SICO from the batched runs
+    if batch_size:
+        sequence_pairs = [_representative_sequences(pair_a, pair_b) for pair_a, pair_b in alignment_pairs]
+        results = _codeml_results_for_pairs(sequence_pairs, batch_size, backend)
+        for codeml_file, result in zip(codeml_files, results):
+            with open(codeml_file, mode='w') as write_handle:
+                write_handle.write(result['output'])
 
     return codeml_files
 
+
+def _split_alignment(sico_file, genome_ids_a, genome_ids_b):
+    """Read alignment from sico_file and return separate alignments for clade A & clade B genomes."""
+    ali = AlignIO.read(sico_file, 'fasta')
+    alignment_a = MultipleSeqAlignment(seqr for seqr in ali if seqr.id.split('|')[0] in genome_ids_a)
+    alignment_b = MultipleSeqAlignment(seqr for seqr in ali if seqr.id.split('|')[0] in genome_ids_b)
+    return alignment_a, alignment_b
+
 # Using the standard NCBI Bacterial, Archaeal and Plant Plastid Code translation table (11).
 BACTERIAL_CODON_TABLE = CodonTable.unambiguous_dna_by_id.get(CODON_TABLE_ID)
 
 
-def run_codeml(sub_dir, alignment_a, alignment_b):
-    """Run codeml from PAML for selected sequence records from sico_file, returning main nexus output file."""
-    # Note on whether or not I should be randomizing the below representative selection:
-    # "both alternatives have their advantages - just selecting one strain for the divergence calculation means that you
-    # know exactly which strains the divergence comes from - but if this strain is anomalous then you might get some
-    # strange results. i think i would stick with a single strain" - AEW
+def run_codeml(sub_dir, alignment_a, alignment_b, backend='codeml'):
+    """Run codeml (or yn00) from PAML for selected sequence records from sico_file, returning main output file."""
+    sequence_a, sequence_b = _representative_sequences(alignment_a, alignment_b)
+    base_name = os.path.split(sub_dir)[1]
+    output_file = os.path.join(sub_dir, base_name + '.codeml')
 
-    # Select first sequences from each clade as representatives
-    ab_alignment = MultipleSeqAlignment([alignment_a[0], alignment_b[0]])
+    # Restore output from the cache when these exact sequences were run through codeml before
+    cache_key = _codeml_cache_key(sequence_a, sequence_b, backend)
+    cached = get_cache('codeml').get(cache_key)
+    if cached is not None:
+        with open(output_file, mode='w') as write_handle:
+            write_handle.write(cached['output'])
+        return output_file
+
+    _run_codeml_for_sequences(sub_dir, sequence_a, sequence_b, output_file, cache_key, backend)
+    return output_file
 
-    # Codeml chokes when presented with an sequence containing stopcodons: strip those out
-    sequence_a = ''
-    sequence_b = ''
-    for index in range(0, len(ab_alignment[0]), 3):
-        codon_a = str(ab_alignment[0][index:index + 3].seq)
-        codon_b = str(ab_alignment[1][index:index + 3].seq)
-        if codon_a not in BACTERIAL_CODON_TABLE.stop_codons and codon_b not in BACTERIAL_CODON_TABLE.stop_codons:
-            sequence_a += codon_a
-            sequence_b += codon_b
 
+def get_codeml_values(alignment_a, alignment_b, backend='codeml'):
+    """Return parsed codeml (or yn00) values for the representatives of both alignments, from cache when available."""
+    sequence_a, sequence_b = _representative_sequences(alignment_a, alignment_b)
+    cache_key = _codeml_cache_key(sequence_a, sequence_b, backend)
+    cached = get_cache('codeml').get(cache_key)
+    if cached is not None:
+        return cached['values']
+
+    # Run codeml in a scratch directory that is removed once the values are parsed
+    sub_dir = tempfile.mkdtemp(prefix='codeml_')
+    output_file = os.path.join(sub_dir, 'codeml.out')
+    codeml_values = _run_codeml_for_sequences(sub_dir, sequence_a, sequence_b, output_file, cache_key, backend)
+    shutil.rmtree(sub_dir)
+    return codeml_values
+
+
+def _run_codeml_for_sequences(sub_dir, sequence_a, sequence_b, output_file, cache_key, backend='codeml'):
+    """Run codeml or yn00 for two representative sequences in sub_dir, store the results in cache and return values."""
     # Write the representative sequence records out to file in codeml compatible format
     base_name = os.path.split(sub_dir)[1]
     nexus_file = os.path.join(sub_dir, base_name + '.nexus')
     _write_nexus_file(sequence_a, sequence_b, nexus_file)
 
-    # Generate codeml configuration file
-    output_file = os.path.join(sub_dir, base_name + '.codeml')
-    config_file = os.path.join(sub_dir, 'codeml.ctl')
-    _write_config_file(nexus_file, output_file, config_file)
+    # Generate codeml or yn00 configuration file
+    config_file = os.path.join(sub_dir, backend + '.ctl')
+    _write_config_file(nexus_file, output_file, config_file, backend)
 
-    # Run codeml
-    command = [CODEML, os.path.split(config_file)[1]]
+    # Run codeml or yn00
+    command = [BACKENDS[backend], os.path.split(config_file)[1]]
     check_call(command, cwd=sub_dir, stdout=open('/dev/null', mode='w'), stderr=STDOUT)
 
     assert os.path.isfile(output_file) and os.path.getsize(output_file), 'Expected some content in ' + output_file
-    return output_file
+
+    # Store both the parsed values and the full output, so later runs can skip codeml entirely
+    codeml_values = parse_codeml_output(output_file, backend)
+    with open(output_file) as read_handle:
+        get_cache('codeml').put(cache_key, {'values': codeml_values, 'output': read_handle.read()})
+    return codeml_values
+
+
+# Number of sequence pairs written as separate datasets into the sequence file of a single codeml run
+BATCH_SIZE = 20
+
+
+def get_codeml_values_for_alignments(alignment_pairs, batch_size=BATCH_SIZE, backend='codeml'):
+    """Return parsed codeml values for the representatives of each of the (alignment_a, alignment_b) pairs, in order.
+
+    Uncached pairs are run through codeml (or yn00) in batches of batch_size pairs, with batches spread over all
+    cores."""
+    sequence_pairs = [_representative_sequences(alignment_a, alignment_b)
+                      for alignment_a, alignment_b in alignment_pairs]
+    return [dict(result['values']) for result in _codeml_results_for_pairs(sequence_pairs, batch_size, backend)]
+
+
+def _codeml_results_for_pairs(sequence_pairs, batch_size, backend='codeml'):
+    """Return cached or computed codeml results with both 'values' and 'output' for each pair of sequences, in order.
+    Identical pairs are only looked up and computed once."""
+    cache = get_cache('codeml')
+    keys = [_codeml_cache_key(sequence_a, sequence_b, backend) for sequence_a, sequence_b in sequence_pairs]
+
+    results = {}
+    uncached = {}
+    for key, sequence_pair in zip(keys, sequence_pairs):
+        if key in results or key in uncached:
+            continue
+        cached = cache.get(key)
+        if cached is None:
+            uncached[key] = sequence_pair
+        else:
+            results[key] = cached
+
+    # Split uncached pairs into batches that each result in a single codeml run
+    keyed_pairs = sorted(uncached.items())
+    batches = [keyed_pairs[index:index + batch_size] for index in range(0, len(keyed_pairs), batch_size)]
+    if batches:
+        log.info('Running %s for %i distinct sequence pairs in %i batches', backend, len(keyed_pairs), len(batches))
+        pool = Pool() if 1 < len(batches) else None
+        try:
+            run_batch = partial(_run_codeml_batch_or_pairs, backend=backend)
+            batch_results = pool.imap_unordered(run_batch, batches) if pool else map(run_batch, batches)
+            for batch_result in batch_results:
+                for key, result in batch_result:
+                    if result is not None:
+                        cache.put(key, result)
+                    results[key] = result
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    # Fail only after all other pairs completed and were cached, so they need not be computed again
+    failed = sum(1 for key in uncached if results[key] is None)
+    assert not failed, '{0} failed for {1} of {2} distinct sequence pairs'.format(backend, failed, len(uncached))
+    return [results[key] for key in keys]
+
+
+def _run_codeml_batch_or_pairs(keyed_pairs, backend='codeml'):
+    """Run codeml (or yn00) for the keyed_pairs of a batch as _run_codeml_batch does, but when the batch fails run its
+    pairs one by one instead, so a single failing pair does not fail the other pairs in the batch. Return (cache key,
+    result) tuples, with None as result for pairs that failed on their own."""
+    try:
+        return _run_codeml_batch(keyed_pairs, backend)
+    except (CalledProcessError, AssertionError) as err:
+        # Errors are logged rather than raised, as not all errors can be passed back from the processes in a pool
+        if len(keyed_pairs) == 1:
+            log.warn('Error running %s for sequence pair %s: %s', backend, keyed_pairs[0][0], err)
+            return [(keyed_pairs[0][0], None)]
+        log.warn('Error running %s for a batch of %i sequence pairs, running them one by one: %s', backend,
+                 len(keyed_pairs), err)
+        return list(chain.from_iterable(_run_codeml_batch_or_pairs([keyed_pair], backend)
+                                        for keyed_pair in keyed_pairs))
+
+
+def _run_codeml_batch(keyed_pairs, backend='codeml'):
+    """Run codeml (or yn00) once for all sequence pairs in the (cache key, (sequence_a, sequence_b)) tuples of
+    keyed_pairs, with each pair written as a separate dataset into a single sequence file.
+    Return (cache key, result) tuples."""
+    sub_dir = tempfile.mkdtemp(prefix='codeml_batch_')
+
+    # Write pairs as consecutive datasets in the sequential format read by PAML
+    sequence_file = os.path.join(sub_dir, 'batch.phy')
+    with open(sequence_file, mode='w') as write_handle:
+        for sequence_a, sequence_b in (sequence_pair for _, sequence_pair in keyed_pairs):
+            write_handle.write('  2  {0}\n\nclade_a  {1}\nclade_b  {2}\n\n'.format(len(sequence_a), sequence_a,
+                                                                                    sequence_b))
+
+    # Generate codeml or yn00 configuration file for all datasets
+    output_file = os.path.join(sub_dir, 'batch.codeml')
+    config_file = os.path.join(sub_dir, backend + '.ctl')
+    with open(config_file, mode='w') as write_handle:
+        write_handle.write(_get_config_contents('batch.phy', 'batch.codeml', len(keyed_pairs), backend))
+
+    # Run codeml or yn00, removing sub_dir also when it fails
+    try:
+        command = [BACKENDS[backend], os.path.split(config_file)[1]]
+        check_call(command, cwd=sub_dir, stdout=open('/dev/null', mode='w'), stderr=STDOUT)
+        assert os.path.isfile(output_file) and os.path.getsize(output_file), 'Expected some content in ' + output_file
+
+        # Split the combined output back into separate outputs per pair
+        outputs = _split_codeml_batch_output(output_file, len(keyed_pairs))
+    finally:
+        shutil.rmtree(sub_dir)
+    return [(key, {'values': _parse_output_values(output, backend), 'output': output})
+            for (key, _), output in zip(keyed_pairs, outputs)]
+
+
+def _split_codeml_batch_output(codeml_file, ndata):
+    """Split the output of a codeml or yn00 run over ndata datasets into separate output sections per dataset."""
+    with open(codeml_file) as read_handle:
+        contents = read_handle.read()
+
+    # Output for each dataset is preceded by a line such as: Data set 2
+    sections = re.split(r'\n\s*Data set \d+\s*\n', contents)
+    assert ndata <= len(sections), 'Expected output for {0} datasets in {1}'.format(ndata, codeml_file)
+    return [section.rstrip() + '\n' for section in sections[-ndata:]]
+
+
+def _representative_sequences(alignment_a, alignment_b):
+    """Return the first sequences from alignment_a and alignment_b as strings, with any codons stripped out where
+    either of the two sequences contains a stop codon."""
+    # Note on whether or not I should be randomizing the below representative selection:
+    # "both alternatives have their advantages - just selecting one strain for the divergence calculation means that you
+    # know exactly which strains the divergence comes from - but if this strain is anomalous then you might get some
+    # strange results. i think i would stick with a single strain" - AEW
+
+    # Select first sequences from each clade as representatives
+    return _strip_stop_codons(str(alignment_a[0].seq), str(alignment_b[0].seq))
+
+
+def _strip_stop_codons(sequence_a, sequence_b):
+    """Return both aligned sequences with codons stripped out where either of the two sequences has a stop codon."""
+    # Codeml chokes when presented with an sequence containing stopcodons: strip those out
+    codons_a = []
+    codons_b = []
+    for index in range(0, len(sequence_a), 3):
+        codon_a = sequence_a[index:index + 3]
+        codon_b = sequence_b[index:index + 3]
+        if codon_a not in BACTERIAL_CODON_TABLE.stop_codons and codon_b not in BACTERIAL_CODON_TABLE.stop_codons:
+            codons_a.append(codon_a)
+            codons_b.append(codon_b)
+    return ''.join(codons_a), ''.join(codons_b)
+
+
+def get_divergence_distributions(alignment_pairs, sample_size=None, seed=None, batch_size=BATCH_SIZE,
+                                 backend='codeml'):
+    """Return the distribution of dN, dS and dN/dS over all cross-clade sequence pairs for each of the (alignment_a,
+    alignment_b) pairs, or over a random sample of sample_size cross-clade pairs per alignment pair.
+
+    Identical sequence pairs within and across orthologs are only run through codeml once, in batches spread over all
+    cores. Each distribution is summarized as a dict with the number of pairs and the mean, median and standard
+    deviation of each value."""
+    rand = random.Random(seed)
+
+    # Count the distinct sequence pairs per ortholog, so identical pairs between clonal strains are weighted correctly
+    pair_counts_per_ortholog = []
+    for alignment_a, alignment_b in alignment_pairs:
+        sequences_a = [str(seqr.seq) for seqr in alignment_a]
+        sequences_b = [str(seqr.seq) for seqr in alignment_b]
+        index_pairs = list(product(range(len(sequences_a)), range(len(sequences_b))))
+        if sample_size and sample_size < len(index_pairs):
+            index_pairs = rand.sample(index_pairs, sample_size)
+        pair_counts = Counter((sequences_a[index_a], sequences_b[index_b]) for index_a, index_b in index_pairs)
+        pair_counts_per_ortholog.append(sorted(pair_counts.items()))
+
+    # Run codeml once for all distinct pairs across orthologs
+    sequence_pairs = [_strip_stop_codons(*pair) for pair, _ in chain.from_iterable(pair_counts_per_ortholog)]
+    results = iter(_codeml_results_for_pairs(sequence_pairs, batch_size, backend))
+
+    distributions = []
+    for pair_counts in pair_counts_per_ortholog:
+        weighted_values = [(next(results)['values'], count) for _, count in pair_counts]
+        distribution = {'pairs': sum(count for _, count in pair_counts), 'distinct pairs': len(pair_counts)}
+        for key in ('dN/dS', 'dN', 'dS'):
+            values = sorted(chain.from_iterable([values[key]] * count for values, count in weighted_values))
+            distribution.update(_summarize(key, values))
+        distributions.append(distribution)
+    return distributions
+
+
+def _summarize(key, values):
+    """Return mean, median and sample standard deviation of the sorted values, under keys prefixed to key."""
+    number = len(values)
+    mean = sum(values) / number
+    middle = number // 2
+    median = values[middle] if number % 2 else (values[middle - 1] + values[middle]) / 2
+    stdev = (sum((value - mean) ** 2 for value in values) / (number - 1)) ** .5 if 1 < number else 0.
+    return {'mean ' + key: mean, 'median ' + key: median, 'sd ' + key: stdev}
+
+
+def _codeml_cache_key(sequence_a, sequence_b, backend='codeml'):
+    """Return cache key over both sequences and the control file parameters they would be run through codeml with."""
+    return content_hash(sequence_a, sequence_b, _get_config_contents('seqfile', 'outfile', backend=backend))
 
 
 def _write_nexus_file(sequence_a, sequence_b, nexus_file):
@@ -103,10 +349,21 @@ end;
         write_handle.write(nexus_contents)
 
 
-def _write_config_file(nexus_file, output_file, config_file):
-    """Write a codeml configuration file using relative paths to the nexus file and output file."""
-    config_contents = '''
+def _write_config_file(nexus_file, output_file, config_file, backend='codeml'):
+    """Write a codeml or yn00 configuration file using relative paths to the nexus file and output file."""
+    with open(config_file, mode='w') as write_handle:
+        write_handle.write(_get_config_contents(os.path.split(nexus_file)[1], os.path.split(output_file)[1],
+                                                backend=backend))
+
+
+def _get_config_contents(seqfile, outfile, ndata=1, backend='codeml'):
+    """Return codeml or yn00 configuration for the given sequence file and output file names and number of datasets.
+    The yn00 configuration is returned when backend is 'yn00'."""
+    if backend == 'yn00':
+        return _get_yn00_config_contents(seqfile, outfile, ndata)
+    return '''
       seqfile = {0} * sequence data filename
+        ndata = {2}  * number of datasets in sequence data file
       outfile = {1}           * main result file name
      treefile = test.tree      * tree structure file name
 
@@ -161,35 +418,78 @@ def _write_config_file(nexus_file, output_file, config_file):
 *   cleandata = 0  * remove sites with ambiguity data (1:yes, 0:no)?
 * fix_blength = 0
        method = 0   * 0: simultaneous; 1: one branch at a time
-'''.format(os.path.split(nexus_file)[1], os.path.split(output_file)[1])
-    with open(config_file, mode='w') as write_handle:
-        write_handle.write(config_contents)
+'''.format(seqfile, outfile, ndata)
+
 
+def _get_yn00_config_contents(seqfile, outfile, ndata=1):
+    """Return yn00 configuration for the given sequence file and output file names and number of datasets."""
+    return '''
+      seqfile = {0} * sequence data file name
+      outfile = {1}           * main result file
+        ndata = {2}  * number of datasets in sequence data file
 
-def parse_codeml_output(codeml_file):
-    """Parse last line of codeml output file to read initial values, and calculate Dn & Ds as derived values."""
+      verbose = 0  * 1: detailed output (list sequences), 0: concise output
+        icode = 0  * 0:universal code; 1:mammalian mt; 2-10:see below
+
+    weighting = 0  * weighting pathways between codons (0/1)?
+   commonf3x4 = 0  * use one set of codon freqs for all pairs (0/1)?
+'''.format(seqfile, outfile, ndata)
+
+
+def parse_codeml_output(codeml_file, backend='codeml'):
+    """Parse values from codeml (or yn00) output file, and calculate Dn & Ds as derived values."""
     with open(codeml_file) as read_handle:
-        # Extract & parse last line
-        last_line = deque(read_handle).pop()
-        # Example lines:
-        # t=50.0000  S=    97.9  N=   328.1  dN/dS= 0.0113  dN= 0.7872  dS=69.8724
-        # t= 1.0569  S=   387.3  N=   950.7  dN/dS= 0.0236  dN= 0.0272  dS= 1.1503
+        return _parse_output_values(read_handle.read(), backend)
+
+
+def _parse_output_values(contents, backend='codeml'):
+    """Parse values from the output contents of either codeml or yn00 for a single pair of sequences."""
+    if backend == 'yn00':
+        return _parse_yn00_values(contents)
+    # Extract & parse last line
+    return _parse_codeml_values(contents.rstrip().split('\n')[-1])
+
+
+def _parse_codeml_values(last_line):
+    """Parse values from the last line of codeml output, and calculate Dn & Ds as derived values."""
+    # Example lines:
+    # t=50.0000  S=    97.9  N=   328.1  dN/dS= 0.0113  dN= 0.7872  dS=69.8724
+    # t= 1.0569  S=   387.3  N=   950.7  dN/dS= 0.0236  dN= 0.0272  dS= 1.1503
 
-        iterator = iter(item.strip() for item in last_line.replace('=', ' ').split())
-        # Use the same above iterator twice in zip to create pairs from sequential items, which we can feed into dict
-        value_dict = dict(zip(iterator, iterator))
+    iterator = iter(item.strip() for item in last_line.replace('=', ' ').split())
+    # Use the same above iterator twice in zip to create pairs from sequential items, which we can feed into dict
+    value_dict = dict(zip(iterator, iterator))
 
-        for key, value in value_dict.iteritems():
-            value_dict[key] = float(value)
+    for key, value in value_dict.iteritems():
+        value_dict[key] = float(value)
 
-        # Below calculations according to AEW to get large D values
-        value_dict['Dn'] = float(value_dict['dN']) * float(value_dict['N'])
-        value_dict['Ds'] = float(value_dict['dS']) * float(value_dict['S'])
-        return value_dict
+    # Below calculations according to AEW to get large D values
+    value_dict['Dn'] = float(value_dict['dN']) * float(value_dict['N'])
+    value_dict['Ds'] = float(value_dict['dS']) * float(value_dict['S'])
+    return value_dict
 
 
-def _write_dnds_per_ortholog(dnds_file, codeml_files):
-    """For each codeml output file write dN, dS & dN/dS to single tab separated file, each on a new line."""
+def _parse_yn00_values(contents):
+    """Parse values from the Yang & Nielsen (2000) section of yn00 output, and calculate Dn & Ds as derived values."""
+    # Example lines:
+    # seq. seq.     S       N        t   kappa   omega     dN +- SE    dS +- SE
+    #
+    #    2    1   285.3   893.7   0.0516  2.9924  0.0644 0.0054 +- 0.0025  0.0845 +- 0.0171
+    section = contents[contents.index('(B) Yang & Nielsen (2000)'):]
+    match = re.search(r'^\s*2\s+1\s+(.+)$', section, re.MULTILINE)
+    assert match, 'Expected values for a pair of sequences in yn00 output:\n' + contents
+
+    values = [float(value) for value in match.group(1).replace('+-', ' ').split()]
+    value_dict = dict(zip(['S', 'N', 't', 'kappa', 'dN/dS', 'dN', 'dN SE', 'dS', 'dS SE'], values))
+
+    # Same derived values as calculated for codeml
+    value_dict['Dn'] = value_dict['dN'] * value_dict['N']
+    value_dict['Ds'] = value_dict['dS'] * value_dict['S']
+    return value_dict
+
+
+def _write_dnds_per_ortholog(dnds_file, codeml_files, backend='codeml'):
+    """For each codeml (or yn00) output file write dN, dS & dN/dS to single tab separated file, each on a new line."""
     # Open file to write dN dS values to
     with open(dnds_file, mode='w') as write_handle:
         write_handle.write('#Ortholog\tN\tdN\tDn\tS\tdS\tDs\tdN/dS\n')
@@ -199,12 +499,25 @@ def _write_dnds_per_ortholog(dnds_file, codeml_files):
         # Write on each line: SICO file, N, dN, Dn, S, dS, Ds & dN/dS
         for codeml_file in codeml_files:
             sico = os.path.split(codeml_file)[1].split('.')[0]
-            value_dict = parse_codeml_output(codeml_file)
+            value_dict = parse_codeml_output(codeml_file, backend)
             write_handle.write('{0}\t{1[N]}\t{1[dN]}\t{1[Dn]}\t{1[S]}\t{1[dS]}\t{1[Ds]}\t{1[dN/dS]}\n'
                                .format(sico, value_dict))
     return dnds_file
 
 
+def _write_divergence_distributions(distributions_file, sico_files, distributions):
+    """Write number of pairs and mean, median & standard deviation of dN/dS, dN & dS per SICO to a single file."""
+    columns = ['pairs', 'distinct pairs']
+    for key in ('dN/dS', 'dN', 'dS'):
+        columns.extend(['mean ' + key, 'median ' + key, 'sd ' + key])
+    with open(distributions_file, mode='w') as write_handle:
+        write_handle.write('#Ortholog\t' + '\t'.join(columns) + '\n')
+        for sico_file, distribution in zip(sico_files, distributions):
+            sico = os.path.split(sico_file)[1].split('.')[0]
+            write_handle.write(sico + '\t' + '\t'.join(str(distribution[column]) for column in columns) + '\n')
+    return distributions_file
+
+
 def main(args):
     """Main function called when run from command line or as part of pipeline."""
     usage = """
@@ -214,9 +527,20 @@ Usage: run_codeml.py
 --sico-zip=FILE      archive of aligned & trimmed single copy orthologous (SICO) genes
 --codeml-zip=FILE     destination file path for archive of codeml output per SICO gene
 --dnds-stats=FILE     destination file path for file with dN, dS & dN/dS values per SICO gene
+--batch-size=INT      run codeml once for every INT SICO genes, with batches spread over all cores [OPTIONAL]
+--pairs-distribution=FILE   destination file path for distribution of dN, dS & dN/dS over all pairs of strains from
+                            taxon A and B per SICO gene [OPTIONAL]
+--sample-pairs=INT          only include a random sample of INT pairs of strains per SICO gene in the above [OPTIONAL]
+--seed=INT                  seed for the random sample of pairs of strains [OPTIONAL]
+--backend=NAME              program to calculate divergence with: codeml (default) or the faster yn00 [OPTIONAL]
 """
-    options = ['genomes-a', 'genomes-b', 'sico-zip', 'codeml-zip', 'dnds-stats']
-    genome_a_ids_file, genome_b_ids_file, sico_zip, codeml_zip, dnds_file = parse_options(usage, options, args)
+    options = ['genomes-a', 'genomes-b', 'sico-zip', 'codeml-zip', 'dnds-stats', 'batch-size=?',
+               'pairs-distribution=?', 'sample-pairs=?', 'seed=?', 'backend=?']
+    genome_a_ids_file, genome_b_ids_file, sico_zip, codeml_zip, dnds_file, batch_size, \
+    distributions_file, sample_pairs, seed, backend = parse_options(usage, options, args)
+
+    backend = backend or 'codeml'
+    assert backend in BACKENDS, 'Backend should be one of {0}, not {1}'.format(', '.join(sorted(BACKENDS)), backend)
 
     # Parse file to extract GenBank Project IDs
     with open(genome_a_ids_file) as read_handle:
@@ -231,10 +555,22 @@ Usage: run_codeml.py
     sico_files = extract_archive_of_files(sico_zip, create_directory('sicos', inside_dir=run_dir))
 
     # Actually run codeml
-    codeml_files = run_codeml_for_sicos(run_dir, genome_ids_a, genome_ids_b, sico_files)
+    codeml_files = run_codeml_for_sicos(run_dir, genome_ids_a, genome_ids_b, sico_files,
+                                        int(batch_size) if batch_size else None, backend)
 
     # Write dnds values to single output file
-    _write_dnds_per_ortholog(dnds_file, codeml_files)
+    _write_dnds_per_ortholog(dnds_file, codeml_files, backend)
+
+    # Optionally run codeml for all or a sample of pairs of strains, to write out the distribution of values per SICO
+    if distributions_file:
+        alignment_pairs = [_split_alignment(sico_file, genome_ids_a, genome_ids_b) for sico_file in sico_files]
+        distributions = get_divergence_distributions(alignment_pairs,
+                                                     sample_size=int(sample_pairs) if sample_pairs else None,
+                                                     seed=int(seed) if seed else None,
+                                                     batch_size=int(batch_size) if batch_size else BATCH_SIZE,
+                                                     backend=backend)
+        _write_divergence_distributions(distributions_file, sico_files, distributions)
+    get_cache('codeml').flush()
 
     # Write the produced files to command line argument filenames
     create_archive_of_files(codeml_zip, codeml_files)
@@ -244,6 +580,8 @@ Usage: run_codeml.py
 
     # Exit after a comforting log message
     log.info("Produced: \n%s\n%s", codeml_zip, dnds_file)
+    if distributions_file:
+        log.info("%s", distributions_file)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
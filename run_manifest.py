@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Module to record the steps completed in a persistent run directory, so interrupted runs can resume after the last
+completed step instead of starting over."""
+
+import hashlib
+import json
+import logging as log
+import os
+
+__author__ = "Tim te Beek"
+__contact__ = "brs@nbic.nl"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Bytes read at once when computing checksums over large files such as BLAST hits
+CHUNK_SIZE = 2 ** 20
+
+
+def checksum(path):
+    """Return SHA1 hex digest over the contents of file path, or over the names and contents of all files below
+    directory path."""
+    sha1 = hashlib.sha1()
+    if os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                file_path = os.path.join(dirpath, filename)
+                sha1.update('{0}:{1}\n'.format(os.path.relpath(file_path, path), checksum(file_path)))
+    else:
+        with open(path, mode='rb') as read_handle:
+            for chunk in iter(lambda: read_handle.read(CHUNK_SIZE), ''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _paths_in(value):
+    """Return all strings in the nested lists, tuples and dictionary values of value that are paths to existing files or
+    directories."""
+    if isinstance(value, basestring):
+        return [value] if os.path.exists(value) else []
+    if isinstance(value, dict):
+        value = [value[key] for key in sorted(value)]
+    if isinstance(value, (list, tuple)):
+        return [path for item in value for path in _paths_in(item)]
+    return []
+
+
+class RunManifest(object):
+    """Manifest of completed steps in run_dir, stored as JSON in run_dir/manifest.json.
+
+    Each step is recorded with the checksums of its input files, its parameters, its result and the checksums of the
+    files and directories in that result. Inputs are compared by content only, so inputs extracted to another temporary
+    directory for each run still match. When resuming, a step is skipped and its recorded result returned when it
+    completed before with the same inputs and parameters, and its outputs are still unchanged. Any step that runs again
+    changes the inputs of the steps that depend on it, so those run again as well."""
+
+    def __init__(self, run_dir, resume=False):
+        self.path = os.path.join(run_dir, 'manifest.json')
+        self.steps = {}
+        self._checksums = {}
+        if resume and os.path.isfile(self.path):
+            with open(self.path) as read_handle:
+                self.steps = json.load(read_handle)
+            log.info('Resuming from %i completed steps recorded in %s', len(self.steps), self.path)
+
+    def _save(self):
+        """Write manifest to a temporary file first, so an interrupted write does not corrupt the existing manifest."""
+        with open(self.path + '.tmp', mode='w') as write_handle:
+            json.dump(self.steps, write_handle, indent=2, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
+
+    def _checksum(self, path):
+        """Return checksum of path, reusing checksums of files that were not modified since they were last computed."""
+        if os.path.isdir(path):
+            return checksum(path)
+        key = (path, os.path.getsize(path), os.path.getmtime(path))
+        if key not in self._checksums:
+            self._checksums[key] = checksum(path)
+        return self._checksums[key]
+
+    def is_complete(self, name, inputs=(), parameters=None):
+        """Return True when step name completed with the same inputs and parameters, and its outputs are unchanged."""
+        step = self.steps.get(name)
+        if step is None:
+            return False
+        if step['inputs'] != [self._checksum(path) for path in inputs]:
+            return False
+        if step['parameters'] != json.loads(json.dumps(parameters)):
+            return False
+        return all(os.path.exists(path) and self._checksum(path) == value
+                   for path, value in step['outputs'].iteritems())
+
+    def run_step(self, name, function, inputs=(), parameters=None):
+        """Return the recorded result of step name when it is complete, or else call function and record its result."""
+        if self.is_complete(name, inputs, parameters):
+            log.info('Skipping completed step %s', name)
+            return self.steps[name]['result']
+
+        # Forget about any previous completion, in case function fails halfway
+        self.invalidate(name)
+        return self.record_step(name, function(), inputs, parameters)
+
+    def record_step(self, name, result, inputs=(), parameters=None):
+        """Record step name as completed with result, for steps whose result was produced outside of run_step."""
+        self.steps[name] = {'inputs': [self._checksum(path) for path in inputs],
+                            'parameters': json.loads(json.dumps(parameters)),
+                            'result': result,
+                            'outputs': dict((path, self._checksum(path)) for path in _paths_in(result))}
+        self._save()
+        return result
+
+    def invalidate(self, name):
+        """Remove step name from the manifest, for instance when resources created in that step were removed."""
+        if self.steps.pop(name, None) is not None:
+            self._save()
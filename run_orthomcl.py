@@ -2,12 +2,23 @@
 """Module to run orthoMCL. Steps in this module reflect the steps in the UserGuide.txt bundled with OrthoMCL."""
 
 from Bio import SeqIO
-from divergence import create_directory, extract_archive_of_files, parse_options
-from divergence.orthomcl_database import create_database, get_configuration_file, delete_database, _get_root_credentials
+from divergence import concatenate, create_directory, extract_archive_of_files, parse_options
+from divergence.groups_store import write_groups_store
+from divergence.orthomcl_blast_parser import apply_cutoffs, parse_blast
+from divergence.orthomcl_fasta import adjust_fasta_files, filter_fasta_files
+from divergence.orthomcl_database import create_database, get_configuration_file, delete_database, \
+    bulk_load_similar_sequences, lease_database, return_database, PERCENT_MATCH_CUTOFF
+from divergence.orthomcl_sqlite import create_sqlite_database, open_sqlite_database, load_similar_sequences, \
+    find_pairs, dump_pairs_files
+from divergence.orthology_cache import OrthologyCache
+from divergence.protein_deduplication import deduplicate_proteins, expand_hits
+from divergence.reciprocal_best_hits import find_reciprocal_best_hits
+from divergence.run_manifest import RunManifest, checksum
 from divergence.translate import translate_fasta_coding_regions
 from divergence.upload_genomes import format_fasta_genome_headers
 from divergence.versions import MCL, ORTHOMCL_INSTALL_SCHEMA, ORTHOMCL_ADJUST_FASTA, ORTHOMCL_FILTER_FASTA, \
     ORTHOMCL_BLAST_PARSER, ORTHOMCL_LOAD_BLAST, ORTHOMCL_PAIRS, ORTHOMCL_DUMP_PAIRS_FILES
+from functools import partial
 from subprocess import Popen, PIPE, CalledProcessError, check_call, STDOUT
 import logging as log
 import multiprocessing
@@ -23,42 +34,156 @@ __copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
 __license__ = "MIT"
 
 
-def run_orthomcl(proteome_files, poor_protein_length, evalue_exponent, target_poor_proteins_file, target_groups_file):
-    """Run all the steps in the orthomcl pipeline, starting with a set of proteomes and ending up with groups.txt."""
-    #Delete orthomcl directory to prevent lingering files from previous runs to influence new runs
-    run_dir = tempfile.mkdtemp(prefix='orthomcl_run_')
-
-    #Steps leading up to and performing the reciprocal blast, as well as minor post processing
-    adjusted_fasta_dir, fasta_files = _step5_orthomcl_adjust_fasta(run_dir, proteome_files)
-    good, poor = _step6_orthomcl_filter_fasta(run_dir, adjusted_fasta_dir, min_length=poor_protein_length)
-    allvsall = _step7_blast_all_vs_all(good, fasta_files)
-    similar_sequences = _step8_orthomcl_blast_parser(run_dir, allvsall, adjusted_fasta_dir)
-    #Clean up all vs all blast results file
-    os.remove(allvsall)
-
-    #Create new database and install database schema in it, so individual runs do not interfere with each other
-    dbname = create_database()
-    config_file = get_configuration_file(run_dir, dbname, evalue_exponent)
-    _step4_orthomcl_install_schema(run_dir, config_file)
-
-    #Steps that occur in database, and thus do little to produce output files
-    _step9_mysql_load_blast(similar_sequences, dbname)  # Workaround for Perl not being able to use load data local infile
-    #_step9_orthomcl_load_blast(similar_sequences, config_file)
-    _step10_orthomcl_pairs(run_dir, config_file)
-    mcl_input = _step11_orthomcl_dump_pairs(run_dir, config_file)[0]
-
-    #Trash database now that we're done with it
-    delete_database(dbname)
-
-    #MCL related steps: run MCL on mcl_input resulting in the groups.txt file
-    groups = _step12_mcl(run_dir, mcl_input)
+# Ways to find pairs among similar sequences: in a new or pooled MySQL database, in SQLite, or natively in memory
+BACKENDS = ('mysql', 'mysql-pool', 'sqlite', 'native')
+
+
+def run_orthomcl(proteome_files, poor_protein_length, evalue_exponent, target_poor_proteins_file, target_groups_file,
+                 backend='mysql', native_parser=False, native_mcl=False, mcl_threads=None, mcl_prune=None,
+                 mcl_select=None, native_fasta=False, processes=None, run_dir=None, resume=False, dbsize=None,
+                 incremental=False, early_cutoffs=False, mcl_processes=None, orthology_cache=False, recluster=False,
+                 rbh=False, deduplicate=False, blast_cores=None, groups_store=False):
+    """Run all the steps in the orthomcl pipeline, starting with a set of proteomes and ending up with groups.txt.
+    backend - either a MySQL server database per run, a MySQL server database leased from a pool of pre-installed
+              databases, an embedded SQLite database inside the run directory, or native to find pairs in memory
+              without any database
+    native_parser - parse BLAST hits into similar sequences in process instead of with orthomclBlastParser
+    native_mcl - cluster in process using SciPy instead of with the mcl binary
+    mcl_threads - number of threads used for clustering, or all available cores by default
+    mcl_prune & mcl_select - after each expansion drop values below mcl_prune and keep at most mcl_select values per
+                             column, with the same defaults as mcl, when clustering in process
+    native_fasta - adjust and filter proteomes in process instead of with orthomclAdjustFasta & orthomclFilterFasta,
+                   which write their output to the current working directory and thus can not run concurrently
+    processes - number of proteomes to adjust and filter in parallel when native_fasta is True
+    run_dir - persistent directory to keep intermediate files and a manifest of completed steps in, instead of a
+              temporary directory that is removed afterwards
+    resume - skip the steps recorded as completed in the manifest in run_dir, reusing their output
+    dbsize - fixed effective database length for BLAST, so Expect values do not depend on the proteomes selected
+    incremental - add proteomes to the completed run in run_dir, which was run with the same dbsize, by blasting only
+                  the added proteomes against all proteomes and all proteomes against the added proteomes; implies
+                  resume
+    early_cutoffs - apply the evalue_exponent and percent match cutoffs of orthomclPairs while parsing BLAST hits
+                    already, so hits that can not affect the pairs found are never stored or loaded
+    mcl_processes - number of processes to cluster connected components in independently, each with an equal share of
+                    mcl_threads, instead of clustering the whole graph at once
+    orthology_cache - project the groups of a cached run over a superset of the proteomes onto the proteomes selected,
+                      instead of running OrthoMCL again, and cache the groups and edges of runs that do run OrthoMCL
+    recluster - cluster the projected groups that lost proteins of proteomes left out again, using the cached edges
+                between their remaining proteins
+    rbh - find orthologs between two proteomes as reciprocal best hits directly from the BLAST hits, instead of finding
+          pairs and clustering those with MCL
+    deduplicate - search only one representative of each set of identical proteins in the all-vs-all BLAST, and
+                  expand its hits to all identical proteins afterwards
+    blast_cores - number of cores to run the all-vs-all BLAST with locally, divided over concurrent searches per
+                  proteome, instead of sending runs of more than two proteomes to the remote grid
+    groups_store - also write the groups to a binary store next to target_groups_file, so later steps can look up
+                   proteins without parsing the groups file"""
+    assert not rbh or len(proteome_files) == 2, 'Reciprocal best hits require exactly two proteomes'
+    assert not rbh or not (incremental or orthology_cache), 'Reciprocal best hits find no pairs to add to or cache'
+    if orthology_cache:
+        #Answer the selection from a cached run over a superset of these proteomes, when there is one
+        cache = OrthologyCache()
+        genomes = dict((_taxon_code(proteome_file), checksum(proteome_file)) for proteome_file in proteome_files)
+        #Include every option that affects the groups, so runs only match cached runs that would yield the same groups
+        cache_parameters = {'evalue_exponent': int(evalue_exponent), 'min_length': int(poor_protein_length),
+                            'dbsize': dbsize, 'early_cutoffs': bool(early_cutoffs), 'deduplicate': bool(deduplicate),
+                            'native_mcl': bool(native_mcl), 'mcl_prune': mcl_prune, 'mcl_select': mcl_select}
+        superset = cache.find_superset(genomes, cache_parameters)
+        if superset is not None:
+            cache.project(superset, genomes, target_groups_file, target_poor_proteins_file, recluster, native_mcl)
+            if groups_store:
+                write_groups_store(target_groups_file)
+            return target_groups_file, target_poor_proteins_file
+
+    #Keep intermediate files in a persistent run_dir when given, or else in a new run_dir for this run only
+    keep_run_dir = run_dir is not None
+    assert keep_run_dir or not resume, 'Can only resume runs in a persistent run directory'
+    assert keep_run_dir or not incremental, 'Can only add genomes to runs in a persistent run directory'
+    if keep_run_dir:
+        run_dir = os.path.abspath(run_dir)
+        if not os.path.isdir(run_dir):
+            os.makedirs(run_dir)
+    else:
+        run_dir = tempfile.mkdtemp(prefix='orthomcl_run_')
+    manifest = RunManifest(run_dir, resume or incremental)
 
-    #Move poor proteins file & groups file outside run_dir ahead of removing run_dir
-    shutil.move(poor, target_poor_proteins_file)
-    shutil.move(groups, target_groups_file)
-    #Remove run_dir to free disk space
-    shutil.rmtree(run_dir)
+    #Only record parameters when given, so runs recorded before these parameters were introduced can still be resumed
+    blast_parameters = dict((key, value) for key, value in (('dbsize', dbsize), ('deduplicate', deduplicate)) if value)
+    blast_parameters = blast_parameters or None
+    cutoffs = early_cutoffs and {'evalue_exponent': int(evalue_exponent), 'percent_match': PERCENT_MATCH_CUTOFF} or None
+    if incremental:
+        #Remember the proteomes and hits of the previous run, before the steps below record those of this run
+        previous = _previous_blast_steps(manifest, poor_protein_length, blast_parameters, cutoffs)
 
+    #Steps leading up to and performing the reciprocal blast, as well as minor post processing
+    adjusted_fasta_dir, fasta_files = manifest.run_step(
+        'adjust_fasta', partial(_step5_orthomcl_adjust_fasta, run_dir, proteome_files, native=native_fasta,
+                                processes=processes),
+        inputs=proteome_files)
+    good, poor = manifest.run_step(
+        'filter_fasta', partial(_step6_orthomcl_filter_fasta, run_dir, adjusted_fasta_dir,
+                                min_length=poor_protein_length, native=native_fasta, processes=processes),
+        inputs=[adjusted_fasta_dir], parameters={'min_length': poor_protein_length})
+    blast_inputs = [good] + fasta_files
+    if incremental and not manifest.is_complete('blast_all_vs_all', blast_inputs, blast_parameters):
+        previous_fasta_files, previous_allvsall, previous_similar_sequences = previous
+        missing = sorted(set(previous_fasta_files) - set(fasta_files))
+        assert not missing, 'Can only add genomes to a previous run, but these were left out: {0}'.format(missing)
+        added_fasta_files = [fasta_file for fasta_file in fasta_files if fasta_file not in previous_fasta_files]
+        assert added_fasta_files, 'Proteins changed since the previous run, while no genomes were added'
+        allvsall, similar_sequences = _step7_add_genomes(run_dir, previous_allvsall, previous_similar_sequences, good,
+                                                         added_fasta_files, previous_fasta_files, adjusted_fasta_dir,
+                                                         native_parser, dbsize, cutoffs, blast_cores)
+        manifest.record_step('blast_all_vs_all', allvsall, blast_inputs, blast_parameters)
+        manifest.record_step('blast_parser', similar_sequences, [allvsall, adjusted_fasta_dir], cutoffs)
+    else:
+        allvsall = manifest.run_step('blast_all_vs_all',
+                                     partial(_step7_blast_all_vs_all, run_dir, good, fasta_files, dbsize, deduplicate,
+                                             blast_cores),
+                                     inputs=blast_inputs, parameters=blast_parameters)
+        if not rbh:
+            similar_sequences = manifest.run_step(
+                'blast_parser', partial(_step8_orthomcl_blast_parser, run_dir, allvsall, adjusted_fasta_dir,
+                                        native_parser, cutoffs=cutoffs),
+                inputs=[allvsall, adjusted_fasta_dir], parameters=cutoffs)
+    if rbh:
+        #Find reciprocal best hits in memory, skipping the database and MCL steps below altogether
+        groups = manifest.run_step(
+            'reciprocal_best_hits', partial(find_reciprocal_best_hits, allvsall, adjusted_fasta_dir,
+                                            os.path.join(run_dir, 'rbh_groups.txt'), evalue_exponent),
+            inputs=[allvsall, adjusted_fasta_dir], parameters={'evalue_exponent': evalue_exponent})
+    #Clean up all vs all blast results file, unless we might resume from it later
+    if not keep_run_dir:
+        os.remove(allvsall)
+
+    if not rbh:
+        #Steps that find pairs among the similar sequences, resulting in the mclInput file
+        mcl_input = manifest.run_step(
+            'find_pairs', partial(_find_pairs, manifest, run_dir, similar_sequences, evalue_exponent, backend),
+            inputs=[similar_sequences], parameters={'evalue_exponent': evalue_exponent, 'backend': backend})[0]
+
+        #MCL related steps: run MCL on mcl_input resulting in the groups.txt file
+        groups = manifest.run_step(
+            'mcl', partial(_step12_mcl, run_dir, mcl_input, native_mcl, mcl_threads, mcl_prune, mcl_select,
+                           mcl_processes),
+            inputs=[mcl_input], parameters={'native': native_mcl, 'prune': mcl_prune, 'select': mcl_select})
+    if orthology_cache:
+        cache.store(genomes, cache_parameters, groups, mcl_input, poor)
+
+    if keep_run_dir:
+        #Copy poor proteins file & groups file, so the run_dir remains complete for later resumes
+        shutil.copy(poor, target_poor_proteins_file)
+        shutil.copy(groups, target_groups_file)
+    else:
+        #Move poor proteins file & groups file outside run_dir ahead of removing run_dir
+        shutil.move(poor, target_poor_proteins_file)
+        shutil.move(groups, target_groups_file)
+        #Remove run_dir to free disk space
+        shutil.rmtree(run_dir)
+
+    #Store groups in binary form next to the groups file, so downstream steps can look up proteins without parsing it
+    if groups_store:
+        write_groups_store(target_groups_file)
     return target_groups_file, target_poor_proteins_file
 
 
@@ -82,7 +207,19 @@ def _step4_orthomcl_install_schema(run_dir, config_file):
     return sql_log_file
 
 
-def _step5_orthomcl_adjust_fasta(run_dir, proteome_files, id_field=3):
+def _taxon_code(proteome_file):
+    """Return the first part of the header of the first entry in proteome_file, which serves as taxon code."""
+    taxon_code = None
+    for record in SeqIO.parse(proteome_file, 'fasta'):
+        taxon_code = record.id.split('|')[0]
+        break
+
+    # If we failed to extract a taxon_code, proteome file must have been empty
+    assert taxon_code, 'Proteome file appears empty: ' + proteome_file
+    return taxon_code
+
+
+def _step5_orthomcl_adjust_fasta(run_dir, proteome_files, id_field=3, native=False, processes=None):
     """Create an OrthoMCL compliant .fasta file, by adjusting definition lines.
 
     Usage:
@@ -114,34 +251,38 @@ def _step5_orthomcl_adjust_fasta(run_dir, proteome_files, id_field=3):
     convenience, but OrthoMCL users are expected to have the scripting skills to provide compliant .fasta files.
 
     EXAMPLE: orthomclSoftware/bin/orthomclAdjustFasta hsa Homo_sapiens.NCBI36.53.pep.all.fa 1
+
+    When native is True the same files are written in process directly into the compliant fasta directory, optionally
+    for multiple proteomes in parallel across processes.
     """
-    #Create directory to hold compliant fasta
+    #Create empty directory to hold compliant fasta, as later steps read all files in it, including those left behind
+    #by earlier runs in the same run_dir over another selection of proteomes
+    adjusted_fasta_dir = os.path.join(run_dir, 'compliant_fasta')
+    if os.path.isdir(adjusted_fasta_dir):
+        shutil.rmtree(adjusted_fasta_dir)
     adjusted_fasta_dir = create_directory('compliant_fasta', inside_dir=run_dir)
-    adjusted_fasta_files = []
+    proteomes = []
     for proteome_file in proteome_files:
-        taxon_code = None
-        #Use first part of header of first entry as taxon code
-        for record in SeqIO.parse(proteome_file, 'fasta'):
-            taxon_code = record.id.split('|')[0]
-            break
+        taxon_code = _taxon_code(proteome_file)
+        proteomes.append((taxon_code, proteome_file, os.path.join(adjusted_fasta_dir, taxon_code + '.fasta')))
 
-        # If we failed to extract a taxon_code, proteome file must have been empty
-        assert taxon_code, 'Proteome file appears empty: ' + proteome_file
+    if native:
+        return adjusted_fasta_dir, adjust_fasta_files(proteomes, id_field, processes)
 
+    adjusted_fasta_files = []
+    for taxon_code, proteome_file, fasta_file_destination in proteomes:
         #Call orhtomclAdjustFasta
         command = [ORTHOMCL_ADJUST_FASTA, taxon_code, proteome_file, str(id_field)]
         log.info('Executing: %s', ' '.join(command))
         check_call(command)
         #Move resulting fasta file to compliantFasta directory
-        adjusted_fasta_file = taxon_code + '.fasta'
-        fasta_file_destination = os.path.join(adjusted_fasta_dir, adjusted_fasta_file)
-        shutil.move(adjusted_fasta_file, fasta_file_destination)
+        shutil.move(taxon_code + '.fasta', fasta_file_destination)
         adjusted_fasta_files.append(fasta_file_destination)
     #Return path to directory containing compliantFasta
     return adjusted_fasta_dir, adjusted_fasta_files
 
 
-def _step6_orthomcl_filter_fasta(run_dir, input_dir, min_length=10, max_percent_stop=20):
+def _step6_orthomcl_filter_fasta(run_dir, input_dir, min_length=10, max_percent_stop=20, native=False, processes=None):
     """Create goodProteins.fasta containing all good proteins and rejectProteins.fasta containing all rejects. Input is
     a directory containing a set of compliant input .fasta files (as produced by orthomclAdjustFasta).
 
@@ -167,20 +308,27 @@ def _step6_orthomcl_filter_fasta(run_dir, input_dir, min_length=10, max_percent_
         report of suspicious proteomes (> 10% poor proteins)
 
     EXAMPLE: orthomclSoftware/bin/orthomclFilterFasta my_orthomcl_dir/compliantFasta 10 20
+
+    When native is True the same files are written in process directly into the filtered fasta directory, optionally
+    filtering multiple proteomes in parallel across processes.
     """
-    #Run orthomclFilterFasta
     out_dir = create_directory('filtered_fasta', inside_dir=run_dir)
     report = os.path.join(out_dir, 'filter_report.log')
-    with open(report, mode='w') as report_file:
-        command = [ORTHOMCL_FILTER_FASTA, input_dir, str(min_length), str(max_percent_stop)]
-        log.info('Executing: %s', ' '.join(command))
-        check_call(command, stdout=report_file, stderr=STDOUT)
-
-    #Move output files to out directory
     good = os.path.join(out_dir, 'good_proteins.fasta')
     poor = os.path.join(out_dir, 'poor_proteins.fasta')
-    shutil.move('goodProteins.fasta', good)
-    shutil.move('poorProteins.fasta', poor)
+    if native:
+        fasta_files = [os.path.join(input_dir, name) for name in os.listdir(input_dir) if not name.startswith('.')]
+        filter_fasta_files(fasta_files, out_dir, good, poor, report, min_length, max_percent_stop, processes)
+    else:
+        #Run orthomclFilterFasta
+        with open(report, mode='w') as report_file:
+            command = [ORTHOMCL_FILTER_FASTA, input_dir, str(min_length), str(max_percent_stop)]
+            log.info('Executing: %s', ' '.join(command))
+            check_call(command, stdout=report_file, stderr=STDOUT)
+
+        #Move output files to out directory
+        shutil.move('goodProteins.fasta', good)
+        shutil.move('poorProteins.fasta', poor)
 
     #Ensure neither of the proteomes is suspicious according to min_length & max_percent_stop
     with open(report) as report_file:
@@ -203,7 +351,7 @@ def _step6_orthomcl_filter_fasta(run_dir, input_dir, min_length=10, max_percent_
     return good, poor
 
 
-def _step7_blast_all_vs_all(good_proteins_file, fasta_files):
+def _step7_blast_all_vs_all(run_dir, good_proteins_file, fasta_files, dbsize=None, deduplicate=False, cores=None):
     """Input:
         goodProteins.fasta
     Output:
@@ -222,19 +370,95 @@ def _step7_blast_all_vs_all(good_proteins_file, fasta_files):
     If you are a super - power user you can deviate from that, and also skip Step 8.   But you must be able to provide the exact format file created by that step as expected by Step 9.  The tricky part is computing percent match.
 
     Time estimate: highly dependent on your data and hardware
+
+    When dbsize is given, Expect values are computed against that fixed effective database length, so genomes can
+    later be added incrementally without changing the Expect values of the hits found here.
+
+    When deduplicate is True, only one representative of each set of identical proteins is searched, against a database
+    of representatives with the dbsize of all good proteins, after which hits are expanded to all identical proteins.
+
+    When cores is given, any number of genomes is blasted locally, with cores divided over concurrent searches.
     """
-    if 2 < len(fasta_files):
+    if 2 < len(fasta_files) and not cores:
         # Send anything concerning more than two genomes to SARA.
         from divergence.reciprocal_blast_lsgp import reciprocal_blast
-        return reciprocal_blast(good_proteins_file, fasta_files)
     else:
-        #Run two genomes ourselves locally.
+        #Run two genomes, or any number of genomes within a budget of cores, ourselves locally.
         from divergence.reciprocal_blast_local import reciprocal_blast
-        return reciprocal_blast(good_proteins_file, fasta_files)
-    
-
-
-def _step8_orthomcl_blast_parser(run_dir, blast_file, fasta_files_dir):
+        reciprocal_blast = partial(reciprocal_blast, cores=cores)
+    if deduplicate:
+        dedup_dir = create_directory('deduplicated', inside_dir=run_dir)
+        good_proteins_file, fasta_files, members, residues = deduplicate_proteins(good_proteins_file, fasta_files,
+                                                                                  dedup_dir)
+        dbsize = dbsize or residues
+    allvsall = reciprocal_blast(good_proteins_file, fasta_files, dbsize)
+
+    #Keep the hits in run_dir, so they can be reused when resuming a run
+    target = os.path.join(run_dir, 'all_vs_all.tsv')
+    if deduplicate:
+        expand_hits(allvsall, members, target)
+        os.remove(allvsall)
+    else:
+        shutil.move(allvsall, target)
+    return target
+
+
+def _previous_blast_steps(manifest, min_length, blast_parameters, cutoffs):
+    """Return the compliant fasta files, all-vs-all hits and similar sequences of the completed run in manifest, after
+    ensuring they were produced with the same min_length, BLAST parameters including a fixed dbsize, and cutoffs."""
+    steps = manifest.steps
+    assert 'blast_parser' in steps, 'No completed run to add genomes to in ' + os.path.dirname(manifest.path)
+    msg = 'Can only add genomes to a run with the same poor protein length {0}, not {1}'
+    assert steps['filter_fasta']['parameters'] == {'min_length': min_length}, \
+        msg.format(steps['filter_fasta']['parameters']['min_length'], min_length)
+    msg = 'Can only add genomes to a run with the same BLAST parameters including a fixed dbsize {0}, not {1}'
+    assert blast_parameters and 'dbsize' in blast_parameters \
+        and steps['blast_all_vs_all']['parameters'] == blast_parameters, \
+        msg.format(steps['blast_all_vs_all']['parameters'], blast_parameters)
+    msg = 'Can only add genomes to a run with the same early cutoffs {0}, not {1}'
+    assert steps['blast_parser']['parameters'] == cutoffs, msg.format(steps['blast_parser']['parameters'], cutoffs)
+    previous = steps['blast_all_vs_all']['result'], steps['blast_parser']['result']
+    for path in previous:
+        assert os.path.isfile(path), 'Output of previous run should still exist: ' + path
+    return (steps['adjust_fasta']['result'][1],) + previous
+
+
+def _step7_add_genomes(run_dir, allvsall, similar_seqs_file, good_proteins_file, added_fasta_files,
+                       previous_fasta_files, fasta_files_dir, native_parser, dbsize, cutoffs=None, cores=None):
+    """Blast added proteomes against all good proteins, and previous proteomes against the good proteins of the added
+    proteomes only. Append the resulting hits and their similar sequences to those of the previous run in allvsall and
+    similar_seqs_file, as incremental alternative to steps 7 and 8, with the same parser cutoffs.
+    Searches run concurrently within a budget of cores. Return both files."""
+    from divergence.reciprocal_blast_local import incremental_blast
+
+    #Extract the good proteins of the added proteomes, to blast the previous proteomes against
+    added_taxa = set(os.path.splitext(os.path.basename(fasta_file))[0] for fasta_file in added_fasta_files)
+    added_proteins = os.path.join(os.path.dirname(good_proteins_file), 'added_proteins.fasta')
+    SeqIO.write((record for record in SeqIO.parse(good_proteins_file, 'fasta')
+                 if record.id.split('|')[0] in added_taxa), added_proteins, 'fasta')
+    log.info('Adding %i to %i proteomes, blasting %i instead of %i proteomes against all',
+             len(added_fasta_files), len(previous_fasta_files), len(added_fasta_files),
+             len(added_fasta_files) + len(previous_fasta_files))
+    added_hits = incremental_blast(good_proteins_file, added_proteins, added_fasta_files, previous_fasta_files, dbsize,
+                                   cores=cores)
+    os.remove(added_proteins)
+
+    #Parse only the added hits, as similar sequences rows depend on just the hits between each query and subject
+    added_similar_sequences = _step8_orthomcl_blast_parser(run_dir, added_hits, fasta_files_dir, native_parser,
+                                                           os.path.join(run_dir, 'added_similar_sequences.tsv'),
+                                                           cutoffs)
+
+    #Only replace the previous files once both are complete, so an interrupted run leaves them intact
+    for target, addition in ((allvsall, added_hits), (similar_seqs_file, added_similar_sequences)):
+        concatenate(target + '.tmp', [target, addition])
+        os.remove(addition)
+    for target in (allvsall, similar_seqs_file):
+        os.rename(target + '.tmp', target)
+    return allvsall, similar_seqs_file
+
+
+def _step8_orthomcl_blast_parser(run_dir, blast_file, fasta_files_dir, native=False, similar_sequences=None,
+                                 cutoffs=None):
     """orthomclBlastParser blast_file fasta_files_dir
 
     where:
@@ -254,19 +478,31 @@ def _step8_orthomcl_blast_parser(run_dir, blast_file, fasta_files_dir):
     (percent_match is computed by counting the number of bases or amino acids in the shorter sequence that are matched in any hsp, and dividing by the length of that shorter sequence)
 
     EXAMPLE: orthomclSoftware/bin/orthomclBlastParser my_blast_results my_orthomcl_dir/compliantFasta >> my_orthomcl_dir/similar_sequences.txt
+
+    When native is True the same rows are produced in process, streaming over the BLAST hits. Rows are written to
+    similar_sequences when given, or else to similar_sequences.tsv in run_dir. When cutoffs holds an evalue_exponent
+    and percent_match, only rows that can still affect the pairs found by orthomclPairs with these cutoffs are written.
     """
-    #Run orthomclBlastParser
-    command = [ORTHOMCL_BLAST_PARSER, blast_file, fasta_files_dir]
-    log.info('Executing: %s', ' '.join(command))
-    similar_sequences = os.path.join(run_dir, 'similar_sequences.tsv')
-    with open(similar_sequences, mode='w') as stdout_file:
-        #check_call(command, stdout = stdout_file, stderr = open('/dev/null', mode = 'w'))
-        process = Popen(command, stdout=stdout_file, stderr=PIPE)
-        retcode = process.wait()
-        if retcode:
-            stderr = process.communicate()[1]
-            log.error(stderr)
-            raise CalledProcessError(retcode, command)
+    similar_sequences = similar_sequences or os.path.join(run_dir, 'similar_sequences.tsv')
+    if native:
+        parse_blast(blast_file, fasta_files_dir, similar_sequences, **(cutoffs or {}))
+    else:
+        #Run orthomclBlastParser
+        command = [ORTHOMCL_BLAST_PARSER, blast_file, fasta_files_dir]
+        log.info('Executing: %s', ' '.join(command))
+        with open(similar_sequences, mode='w') as stdout_file:
+            #check_call(command, stdout = stdout_file, stderr = open('/dev/null', mode = 'w'))
+            if cutoffs:
+                #Filter rows as they are produced, so dropped rows are never written
+                process = Popen(command, stdout=PIPE, stderr=PIPE)
+                stdout_file.writelines(apply_cutoffs(iter(process.stdout.readline, ''), **cutoffs))
+            else:
+                process = Popen(command, stdout=stdout_file, stderr=PIPE)
+            retcode = process.wait()
+            if retcode:
+                stderr = process.communicate()[1]
+                log.error(stderr)
+                raise CalledProcessError(retcode, command)
 
     msg = 'Similar seqeunces files should now have some content'
     assert os.path.isfile(similar_sequences) and 0 < os.path.getsize(similar_sequences), msg
@@ -293,21 +529,9 @@ def _step9_orthomcl_load_blast(similar_seqs_file, config_file):
 
 
 def _step9_mysql_load_blast(similar_seqs_file, database):
-    """Directly load results using MySQL, as Perl MySQL connection does not allow for load data local infile."""
-    host, port, user, passwd = _get_root_credentials()
-    
-    #Run orthomclLoadBlast
-    command = ['mysql',
-               '-h',host,
-               '-u','orthomcl',
-               '--port='+str(port),
-               '--password=pass',
-               '--local-infile=1',
-               '-e', 'LOAD DATA LOCAL INFILE "{0}" REPLACE INTO TABLE SimilarSequences FIELDS TERMINATED BY \'\\t\';'.format(similar_seqs_file),
-               database]
-    log.info('Executing: %s', ' '.join(command))
-    check_call(command)
-    return
+    """Directly load results using MySQLdb, as Perl MySQL connection does not allow for load data local infile.
+    Secondary indexes are rebuilt once after loading, rather than maintained row by row while loading."""
+    bulk_load_similar_sequences(database, similar_seqs_file)
 
 
 def _step10_orthomcl_pairs(run_dir, config_file):
@@ -402,7 +626,89 @@ def _step11_orthomcl_dump_pairs(run_dir, config_file):
     return mclinput, orthologs, inparalogs, coorthologs
 
 
-def _step12_mcl(run_dir, mcl_input_file):
+def _find_pairs(manifest, run_dir, similar_seqs_file, evalue_exponent, backend):
+    """Find pairs among similar sequences with backend, and return the mclInput and pairs files as output by step 11.
+    Similar sequences loaded into a database are recorded in manifest as a separate step, so they can be reused when
+    finding pairs fails or is repeated with other parameters."""
+    if backend == 'native':
+        #Find pairs in memory and write the pairs files directly, without any database
+        from divergence.orthomcl_pairs import run_native_pairs
+        return run_native_pairs(run_dir, similar_seqs_file, evalue_exponent)
+
+    if backend == 'mysql-pool':
+        #Lease a database with the schema installed, which is emptied on return, so loads are never reused
+        dbname, installed = lease_database()
+        try:
+            if not installed:
+                _step4_orthomcl_install_schema(run_dir, get_configuration_file(run_dir, dbname, 0))
+            _step9_mysql_load_blast(similar_seqs_file, dbname)
+            config_file = get_configuration_file(run_dir, dbname, evalue_exponent)
+            _step10_orthomcl_pairs(run_dir, config_file)
+            return _step11_orthomcl_dump_pairs(run_dir, config_file)
+        finally:
+            return_database(dbname)
+
+    load_parameters = {'backend': backend}
+    reused = manifest.is_complete('load_blast', [similar_seqs_file], load_parameters)
+    if backend == 'sqlite':
+        #Load similar sequences into and find pairs in a database file of our own, without any server round trips
+        database_file = manifest.run_step('load_blast', partial(_step9_sqlite_load_blast, run_dir, similar_seqs_file),
+                                          [similar_seqs_file], load_parameters)['database_file']
+        return _step10_sqlite_pairs(run_dir, database_file, evalue_exponent)
+
+    #Create new database, install database schema in it and load similar sequences, unless loaded in an earlier run
+    dbname = manifest.run_step('load_blast', partial(_step9_mysql_create_and_load, run_dir, similar_seqs_file),
+                               [similar_seqs_file], load_parameters)['dbname']
+    config_file = get_configuration_file(run_dir, dbname, evalue_exponent)
+    if reused:
+        #Remove any pairs left over from an earlier attempt at finding pairs in this database
+        check_call([ORTHOMCL_PAIRS, config_file, os.path.join(run_dir, 'orthomclPairs_cleanup.log'), 'cleanup=all'])
+
+    #Steps that occur in database, and thus do little to produce output files
+    _step10_orthomcl_pairs(run_dir, config_file)
+    pairs_files = _step11_orthomcl_dump_pairs(run_dir, config_file)
+
+    #Trash database now that we're done with it
+    delete_database(dbname)
+    manifest.invalidate('load_blast')
+    return pairs_files
+
+
+def _step9_mysql_create_and_load(run_dir, similar_seqs_file):
+    """Create new database and install database schema in it, so individual runs do not interfere with each other, then
+    load similar sequences into it. Return the database name."""
+    dbname = create_database()
+    #The evalue exponent cutoff in the configuration file is only used when finding pairs, not in installing the schema
+    _step4_orthomcl_install_schema(run_dir, get_configuration_file(run_dir, dbname, 0))
+    _step9_mysql_load_blast(similar_seqs_file, dbname)  # Workaround: Perl can not load data local infile
+    #_step9_orthomcl_load_blast(similar_seqs_file, config_file)
+    return {'dbname': dbname}
+
+
+def _step9_sqlite_load_blast(run_dir, similar_seqs_file):
+    """Install the schema in a new SQLite database in run_dir and load similar sequences into it, as alternative to
+    steps 4 and 9 against a MySQL server. Return the database file."""
+    database_file = os.path.join(run_dir, 'orthomcl.sqlite')
+    connection = create_sqlite_database(database_file)
+    try:
+        load_similar_sequences(connection, similar_seqs_file)
+    finally:
+        connection.close()
+    return {'database_file': database_file}
+
+
+def _step10_sqlite_pairs(run_dir, database_file, evalue_exponent):
+    """Find pairs and dump pairs files from the SQLite database_file, as alternative to steps 10 and 11 against a MySQL
+    server. Return the same files as step 11."""
+    connection = open_sqlite_database(database_file)
+    try:
+        find_pairs(connection, evalue_exponent)
+        return dump_pairs_files(run_dir, connection)
+    finally:
+        connection.close()
+
+
+def _step12_mcl(run_dir, mcl_input_file, native=False, threads=None, prune_threshold=None, select=None, processes=None):
     """Markov Cluster Algorithm: http://www.micans.org/mcl/
 
     Input:
@@ -411,14 +717,29 @@ def _step12_mcl(run_dir, mcl_input_file):
         mclOutput file
 
     mcl my_orthomcl_dir/mclInput --abc -I 1.5 -o my_orthomcl_dir/mclOutput
+
+    When native is True the clusters are computed in process instead, with threads, prune_threshold and select
+    falling back to the defaults of the mcl module when not specified. When processes is given, connected components
+    of the graph are clustered independently across processes, which divide threads among them.
     """
-    #Run mcl
     mcl_dir = create_directory('mcl', inside_dir=run_dir)
     mcl_output_file = os.path.join(mcl_dir, 'mclOutput.tsv')
+    threads = threads or multiprocessing.cpu_count()
+    if processes:
+        #Clusters never span components, so cluster smaller graphs separately to lower peak memory use
+        from divergence.mcl_components import cluster_components
+        return cluster_components(mcl_input_file, mcl_output_file, processes, native, max(1, threads // processes),
+                                  prune_threshold, select)
+    if native:
+        #Cluster in process, so mcl need not be installed
+        from divergence.mcl import run_mcl, PRUNE_THRESHOLD, SELECT
+        return run_mcl(mcl_input_file, mcl_output_file, threads=threads,
+                       prune_threshold=prune_threshold or PRUNE_THRESHOLD, select=select or SELECT)
+
+    #Run mcl
     mcl_log = os.path.join(mcl_dir, 'mcl.log')
     with open(mcl_log, mode='w') as open_file:
-        threads = str(multiprocessing.cpu_count())
-        command = [MCL, mcl_input_file, '--abc', '-I', '1.5', '-o', mcl_output_file, '-te', threads]
+        command = [MCL, mcl_input_file, '--abc', '-I', '1.5', '-o', mcl_output_file, '-te', str(threads)]
         log.info('Executing: %s', ' '.join(command))
         check_call(command, stdout=open_file, stderr=STDOUT)
     return mcl_output_file
@@ -436,10 +757,53 @@ Usage: run_orthomcl.py
 --evalue-exponent=INT        filter OrthoMCL BLAST similarities with Expect value exponents greater than this value
 --poor-proteins=FILE         destination file path for filtered poor proteins
 --groups=FILE                destination file path for file listing groups of orthologous proteins
+--backend=NAME               where to find pairs: in a new mysql (default) database, a mysql-pool database leased
+                             from a pool of pre-installed databases, a sqlite database, or native in memory; the latter
+                             two run without a MySQL server [OPTIONAL]
+--native-parser              parse BLAST hits in process instead of with orthomclBlastParser [OPTIONAL]
+--native-mcl                 cluster in process instead of with the mcl binary [OPTIONAL]
+--mcl-threads=INT            number of threads to cluster with, defaults to the number of cores [OPTIONAL]
+--mcl-prune=FLOAT            drop values below this threshold after each expansion with --native-mcl [OPTIONAL]
+--mcl-select=INT             keep at most this many values per column after each expansion with --native-mcl [OPTIONAL]
+--mcl-processes=INT          cluster connected components independently across this many processes [OPTIONAL]
+--native-fasta               adjust and filter proteomes in process, so concurrent runs do not share output files in
+                             the working directory [OPTIONAL]
+--processes=INT              number of proteomes to adjust and filter in parallel with --native-fasta [OPTIONAL]
+--run-dir=DIR                persistent directory to keep intermediate files and a manifest of completed steps in
+                             [OPTIONAL]
+--resume                     skip steps completed in an earlier run in the same run-dir, such as the all-vs-all BLAST
+                             and loading the database [OPTIONAL]
+--dbsize=INT                 fixed effective database length for BLAST, so genomes can be added to the run later on
+                             [OPTIONAL]
+--incremental                add genomes to the completed run in the same run-dir with the same dbsize, blasting only
+                             added genomes against all genomes and all genomes against added genomes [OPTIONAL]
+--early-cutoffs              apply the evalue-exponent and percent match cutoffs while parsing BLAST hits, so fewer
+                             similar sequences are stored and loaded [OPTIONAL]
+--orthology-cache            project the groups of a cached run over a superset of the selected genomes, and cache the
+                             groups of runs over genomes not cached before [OPTIONAL]
+--recluster                  cluster projected groups that lost proteins of genomes left out again [OPTIONAL]
+--rbh                        find orthologs between exactly two genomes as reciprocal best hits, without any database
+                             or MCL [OPTIONAL]
+--deduplicate                blast only one of each set of identical proteins, and expand the hits to all identical
+                             proteins afterwards [OPTIONAL]
+--blast-cores=INT            blast locally using this many cores, divided over concurrent searches per genome, also
+                             for more than two genomes [OPTIONAL]
+--groups-store               also write the groups to a binary store next to the groups file, for faster lookups when
+                             extracting orthologs [OPTIONAL]
 """
-    options = ['protein-zip', 'ortholog-limiter=?', 'poor-protein-length', 'evalue-exponent', 'poor-proteins', 'groups']
-    protein_zipfile, limiter_file, poor_protein_length, evalue_exponent, target_poor_proteins, target_groups_path = \
-        parse_options(usage, options, args)
+    options = ['protein-zip', 'ortholog-limiter=?', 'poor-protein-length', 'evalue-exponent', 'poor-proteins', 'groups',
+               'backend=?', 'native-parser?', 'native-mcl?', 'mcl-threads=?', 'mcl-prune=?', 'mcl-select=?',
+               'native-fasta?', 'processes=?', 'run-dir=?', 'resume?', 'dbsize=?', 'incremental?',
+               'early-cutoffs?', 'mcl-processes=?', 'orthology-cache?', 'recluster?', 'rbh?',
+               'deduplicate?', 'blast-cores=?', 'groups-store?']
+    protein_zipfile, limiter_file, poor_protein_length, evalue_exponent, target_poor_proteins, target_groups_path, \
+        backend, native_parser, native_mcl, mcl_threads, mcl_prune, mcl_select, native_fasta, processes, run_dir, \
+        resume, dbsize, incremental, early_cutoffs, mcl_processes, orthology_cache, recluster, rbh, deduplicate, \
+        blast_cores, groups_store = parse_options(usage, options, args)
+    assert run_dir or not resume, 'Option --resume requires --run-dir'
+    assert run_dir and dbsize or not incremental, 'Option --incremental requires --run-dir and --dbsize'
+    backend = backend or 'mysql'
+    assert backend in BACKENDS, 'Backend should be one of {0}, not {1}'.format(', '.join(BACKENDS), backend)
 
     #Extract files from zip archive
     temp_dir = tempfile.mkdtemp(prefix='orthomcl_proteins_')
@@ -455,7 +819,15 @@ Usage: run_orthomcl.py
         proteome_files.append(translated_limiter)
 
     #Actually run orthomcl
-    run_orthomcl(proteome_files, poor_protein_length, evalue_exponent, target_poor_proteins, target_groups_path)
+    run_orthomcl(proteome_files, poor_protein_length, evalue_exponent, target_poor_proteins, target_groups_path,
+                 backend=backend, native_parser=native_parser, native_mcl=native_mcl,
+                 mcl_threads=mcl_threads and int(mcl_threads), mcl_prune=mcl_prune and float(mcl_prune),
+                 mcl_select=mcl_select and int(mcl_select), native_fasta=native_fasta,
+                 processes=processes and int(processes), run_dir=run_dir, resume=resume,
+                 dbsize=dbsize and int(dbsize), incremental=incremental, early_cutoffs=early_cutoffs,
+                 mcl_processes=mcl_processes and int(mcl_processes), orthology_cache=orthology_cache,
+                 recluster=recluster, rbh=rbh, deduplicate=deduplicate, blast_cores=blast_cores and int(blast_cores),
+                 groups_store=groups_store)
 
     #Remove unused files to free disk space
     shutil.rmtree(temp_dir)
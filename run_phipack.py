@@ -3,10 +3,14 @@
 
 from __future__ import division
 from Bio import SeqIO
-from divergence import create_directory, extract_archive_of_files, parse_options, get_most_recent_gene_name, \
-    find_cogs_in_sequence_records
+from divergence import create_directory, extract_archive_of_files, create_archive_of_files, parse_options, \
+    get_most_recent_gene_name, find_cogs_in_sequence_records
+from divergence.phi import phi_test_states, phi_profile, read_alignment, informative_sites, PERMUTATIONS, \
+    MIN_INFORMATIVE_SITES, SCAN_WINDOW, SCAN_STEP
+from divergence.result_cache import get_cache, content_hash
 from divergence.select_taxa import select_genomes_by_ids
 from divergence.versions import PHIPACK
+from StringIO import StringIO
 from subprocess import check_call, CalledProcessError
 import logging as log
 import os.path
@@ -21,7 +25,8 @@ __copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
 __license__ = "MIT"
 
 
-def _phipack_for_all_orthologs(run_dir, aligned_files, stats_file):
+def _phipack_for_all_orthologs(run_dir, aligned_files, stats_file, native=False, permutations=PERMUTATIONS, seed=None,
+                               min_informative_sites=MIN_INFORMATIVE_SITES):
     """Filter aligned fasta files where there is evidence of recombination when inspecting PhiPack values.
     Return two collections of aligned files, the first without recombination, the second with recombination."""
 
@@ -44,11 +49,14 @@ def _phipack_for_all_orthologs(run_dir, aligned_files, stats_file):
         genome_dicts = select_genomes_by_ids(genome_ids).values()
 
         #Assign ortholog files to the correct collection based on whether they show recombination
+        skipped = 0
         for ortholog_file in aligned_files:
             orth_name = os.path.split(ortholog_file)[1].split('.')[0]
 
             #Parse tree file to ensure all genome_ids_a & genome_ids_b group together in the tree
-            phipack_values = run_phipack(phipack_dir, ortholog_file)
+            phipack_values, prescreened = _run_phipack(phipack_dir, ortholog_file, native, permutations, seed,
+                                                       min_informative_sites)
+            skipped += prescreened
 
             #Write PhiPack values to line
             write_handle.write('{0}\t{1[PhiPack sites]}\t{1[Phi]}\t{1[Max Chi^2]}\t{1[NSS]}'.format(orth_name,
@@ -66,11 +74,54 @@ def _phipack_for_all_orthologs(run_dir, aligned_files, stats_file):
             #End line
             write_handle.write('\n')
 
+        #Report orthologs for which PhiPack was not run at all
+        write_handle.write('#Skipped {0} orthologs with fewer than {1} informative sites\n'.format(skipped,
+                                                                                              min_informative_sites))
+        log.info('Skipped PhiPack for %i orthologs with fewer than %i informative sites', skipped,
+                 min_informative_sites)
+
     #Nothing to return, the stats_file is the product
 
 
-def run_phipack(phipack_dir, dna_file):
-    """Run PhiPack and return the number of informative sites, PHI, Max Chi^2 and NSS."""
+def run_phipack(phipack_dir, dna_file, native=False, permutations=PERMUTATIONS, seed=None, min_informative_sites=None):
+    """Run PhiPack and return the number of informative sites, PHI, Max Chi^2 and NSS.
+
+    When native is True the same values are calculated in process with the given number of permutations instead, which
+    then also provide the p-value for PHI rather than the normal approximation used by PhiPack. Values are cached by
+    alignment contents, so each alignment is only tested once for recombination across workflow steps. When given,
+    alignments with fewer than min_informative_sites parsimony informative sites are not tested, and get None for all
+    but the sites."""
+    return _run_phipack(phipack_dir, dna_file, native, permutations, seed, min_informative_sites)[0]
+
+
+def _run_phipack(phipack_dir, dna_file, native, permutations, seed, min_informative_sites):
+    """Return the values of run_phipack, and whether dna_file was left untested for too few informative sites."""
+    with open(dna_file) as read_handle:
+        contents = read_handle.read()
+    parameters = 'native {0} {1}'.format(permutations, seed) if native else 'phipack'
+    cache_key = content_hash(contents, parameters)
+    cache = get_cache('phipack')
+    phipack_values = cache.get(cache_key)
+    if phipack_values is None:
+        #Parse the alignment from the contents already read, only when needed for the prescreen or native test
+        states = read_alignment(StringIO(contents)) if native or min_informative_sites else None
+        #Skip alignments with too few informative sites for PhiPack to produce any value, without caching the outcome
+        if min_informative_sites:
+            nr_sites = informative_sites(states).shape[1]
+            if nr_sites < min_informative_sites:
+                return {'PhiPack sites': nr_sites, 'Phi': None, 'Max Chi^2': None, 'NSS': None}, True
+        if native:
+            phipack_values = phi_test_states(states, permutations=permutations, seed=seed)
+        else:
+            phipack_values = _run_phipack_binary(phipack_dir, dna_file)
+        #Only cache values PhiPack actually produced, so failed runs are tried again next time
+        if phipack_values['PhiPack sites'] is not None:
+            cache.put(cache_key, phipack_values)
+    return phipack_values, False
+
+
+def _run_phipack_binary(phipack_dir, dna_file):
+    """Run the PhiPack binary and parse the number of informative sites, PHI, Max Chi^2 and NSS from its log file."""
     #Create directory for PhiPack to run in, so files get created there
     orth_name = os.path.split(dna_file)[1].split('.')[0]
     rundir = create_directory(orth_name, inside_dir=phipack_dir)
@@ -101,15 +152,60 @@ def run_phipack(phipack_dir, dna_file):
     return {'PhiPack sites': sites, 'Phi': phi, 'Max Chi^2': chi, 'NSS': nss}
 
 
+def write_recombination_profile(profiles_dir, dna_file, scan_window=SCAN_WINDOW, step=SCAN_STEP):
+    """Write Phi for windows of scan_window positions every step positions along the alignment in dna_file to a tab
+    separated profile file in profiles_dir, to show where in the ortholog recombination is concentrated."""
+    orth_name = os.path.split(dna_file)[1].split('.')[0]
+    profile_file = os.path.join(profiles_dir, orth_name + '.profile.tsv')
+    with open(profile_file, mode='w') as write_handle:
+        write_handle.write('#Start\tEnd\tInformative sites\tPhi\n')
+        for start, end, sites, phi in phi_profile(read_alignment(dna_file), scan_window, step):
+            #Write one based inclusive positions, and Phi rounded to keep profiles compact
+            phi = 'None' if phi is None else '{0:.4f}'.format(phi)
+            write_handle.write('{0}\t{1}\t{2}\t{3}\n'.format(start + 1, end, sites, phi))
+    return profile_file
+
+
+def read_phipack_stats(stats_file):
+    """Read stats_file as written by _phipack_for_all_orthologs, and return a dictionary mapping ortholog names to the
+    PhiPack values of each ortholog, for reuse in later steps without running PhiPack again."""
+    def _parse_value(value, convert):
+        """Convert value unless PhiPack failed to produce a value."""
+        return None if value == 'None' else convert(value)
+
+    values_per_orth = {}
+    with open(stats_file) as read_handle:
+        # Skip header line
+        next(read_handle)
+        for line in read_handle:
+            if line.startswith('#'):
+                continue
+            orth_name, sites, phi, chi, nss = line.rstrip('\n').split('\t')[:5]
+            values_per_orth[orth_name] = {'PhiPack sites': _parse_value(sites, int),
+                                          'Phi': _parse_value(phi, float),
+                                          'Max Chi^2': _parse_value(chi, float),
+                                          'NSS': _parse_value(nss, float)}
+    return values_per_orth
+
+
 def main(args):
     """Main function called when run from command line or as part of pipeline."""
     usage = """
 Usage: run_phipack.py
 --orthologs-zip=FILE     archive of orthologous genes in FASTA format
 --stats-file=FILE        destination file path for values found through PhiPack for each ortholog
-"""
-    options = ('orthologs-zip', 'stats-file')
-    orthologs_zip, stats_file = parse_options(usage, options, args)
+--native                 calculate PhiPack values in process instead of running the PhiPack binary [OPTIONAL]
+--permutations=INT       number of permutations used for p-values when calculating in process [OPTIONAL]
+--seed=INT               seed for the permutations when calculating in process [OPTIONAL]
+--min-informative-sites=INT  skip orthologs with fewer informative sites, by default {0} [OPTIONAL]
+--profiles-zip=FILE      destination file path for archive of Phi along sliding windows per ortholog [OPTIONAL]
+--scan-window=INT        width in alignment positions of the sliding windows, by default {1} [OPTIONAL]
+--scan-step=INT          step in alignment positions between sliding windows, by default {2} [OPTIONAL]
+""".format(MIN_INFORMATIVE_SITES, SCAN_WINDOW, SCAN_STEP)
+    options = ('orthologs-zip', 'stats-file', 'native?', 'permutations=?', 'seed=?', 'min-informative-sites=?',
+               'profiles-zip=?', 'scan-window=?', 'scan-step=?')
+    orthologs_zip, stats_file, native, permutations, seed, min_sites, profiles_zip, scan_window, scan_step = \
+        parse_options(usage, options, args)
 
     #Run filtering in a temporary folder, to prevent interference from simultaneous runs
     run_dir = tempfile.mkdtemp(prefix='run_phipack_')
@@ -119,13 +215,28 @@ Usage: run_phipack.py
     ortholog_files = extract_archive_of_files(orthologs_zip, extraction_dir)
 
     #Find recombination in all ortholog_files
-    _phipack_for_all_orthologs(run_dir, ortholog_files, stats_file)
+    _phipack_for_all_orthologs(run_dir, ortholog_files, stats_file, native,
+                               int(permutations) if permutations else PERMUTATIONS,
+                               int(seed) if seed else None,
+                               int(min_sites) if min_sites else MIN_INFORMATIVE_SITES)
+    get_cache('phipack').flush()
+
+    #Optionally scan along each ortholog to locate recombination
+    if profiles_zip:
+        profiles_dir = create_directory('profiles', inside_dir=run_dir)
+        profile_files = [write_recombination_profile(profiles_dir, ortholog_file,
+                                                     int(scan_window) if scan_window else SCAN_WINDOW,
+                                                     int(scan_step) if scan_step else SCAN_STEP)
+                         for ortholog_file in ortholog_files]
+        create_archive_of_files(profiles_zip, profile_files)
 
     #Remove unused files to free disk space
     shutil.rmtree(run_dir)
 
     #Exit after a comforting log message
     log.info('Produced:\n%s', stats_file)
+    if profiles_zip:
+        log.info('%s', profiles_zip)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
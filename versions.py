@@ -32,6 +32,7 @@ BLASTN = NCBI_BLAST_DIR + 'blastn'
 
 #OrthoMCL
 MCL = SOFTWARE_DIR + 'mcl'
+MCXLOAD = SOFTWARE_DIR + 'mcxload'
 ORTHOMCL_DIR = SOFTWARE_DIR + ''
 ORTHOMCL_INSTALL_SCHEMA = ORTHOMCL_DIR + 'orthomclInstallSchema'
 ORTHOMCL_ADJUST_FASTA = ORTHOMCL_DIR + 'orthomclAdjustFasta'
@@ -56,6 +57,7 @@ PHIPACK = SOFTWARE_DIR + 'Phi'
 #Calculation
 PAML_DIR = SOFTWARE_DIR + ''
 CODEML = PAML_DIR + 'codeml'
+YN00 = PAML_DIR + 'yn00'
 
 
 def _call_program(*command):